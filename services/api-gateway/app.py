@@ -1,99 +1,188 @@
-from flask import Flask, jsonify, request
+from flask import Flask, jsonify, request, Response, stream_with_context
 import requests
 import os
+import threading
+import time
 # Disable security warnings for self-signed certificates
 from requests.packages.urllib3.exceptions import InsecureRequestWarning
 requests.packages.urllib3.disable_warnings(InsecureRequestWarning)
 
+from routing import (
+    PROXY_METHODS, ROUTES, SERVICES, STREAM_CHUNK_SIZE, build_url, caller_independent, end_to_end_headers,
+    forward_headers, is_small_body, wants_event_stream
+)
+from edge_auth import TokenVerifier
+from response_cache import STALE, ResponseCache
+from singleflight import BufferedResponse, SingleFlight, coalesce_key
+from upstream import STREAM_READ_TIMEOUT, Upstreams
+
 app = Flask(__name__)
 debug_mode = os.environ.get('FLASK_DEBUG', 'False').lower() == 'true'
 
 
-# Map of services UPDATED TO HTTPS
-SERVICES = {
-    "auth": "https://auth-service:5000",
-    "cards": "https://cards-service:5000",
-    "player": "https://player-service:5000",
-    "match": "https://match-service:5000",
-    "history": "https://history-service:5000"
-}
+# Keep-alive pool per service (see upstream.py)
+upstreams = Upstreams(SERVICES)
+# Cached GET routes (see response_cache.py)
+response_cache = ResponseCache()
+# Bearer tokens verified here, identity forwarded as X-Auth-* (see edge_auth.py)
+token_verifier = TokenVerifier()
+# Identical concurrent GETs share one upstream call (see singleflight.py)
+singleflight = SingleFlight()
+# An event stream holds a gthread thread for its whole life: past this many
+# per worker it is answered 503 (the clients poll), so short requests still
+# find a thread. Keep it below --threads; asgi_app.py has no such limit.
+MAX_EVENT_STREAMS = int(os.environ.get('GATEWAY_MAX_STREAMS', '24'))
+stream_slots = threading.BoundedSemaphore(MAX_EVENT_STREAMS)
 
 @app.route('/health', methods=['GET'])
 def gateway_health():
     return jsonify({"status": "gateway running (secure)"}), 200
 
+@app.route('/gateway/admin/upstreams', methods=['GET'])
+def upstream_stats():
+    # Counters of this worker process only: each gunicorn worker has its own pools
+    return jsonify({"pid": os.getpid(), "services": upstreams.snapshot(),
+                    "coalescing": singleflight.stats()}), 200
+
+@app.route('/gateway/admin/cache', methods=['GET'])
+def cache_stats():
+    # LRU counters of this worker process; the Redis tier is shared
+    return jsonify({"pid": os.getpid(), **response_cache.stats()}), 200
+
+@app.route('/gateway/admin/auth', methods=['GET'])
+def auth_stats():
+    return jsonify({"pid": os.getpid(), **token_verifier.stats()}), 200
+
 # --- HELPER ---
-def build_url(service_url, service_prefix, path):
-    if path:
-        return f"{service_url}/{service_prefix}/{path}"
-    return f"{service_url}/{service_prefix}"
+def read_whole(resp):
+    """Relayed headers and raw body of a small response; the connection goes back to the pool."""
+    return end_to_end_headers(resp.headers.items()), resp.raw.read(decode_content=False)
+
+def relay_response(resp):
+    """Flask response relaying `resp` (opened with stream=True) to the client."""
+    if is_small_body(resp.headers):
+        headers, body = read_whole(resp)
+        return Response(body, status=resp.status_code, headers=headers)
+    headers = end_to_end_headers(resp.headers.items())
+
+    def generate():
+        try:
+            yield from resp.raw.stream(STREAM_CHUNK_SIZE, decode_content=False)
+        finally:
+            # Back to the pool when fully read, closed if the client went away
+            resp.close()
+
+    return Response(stream_with_context(generate()), status=resp.status_code, headers=headers)
+
+def fetch_get(service_name, url, headers, params):
+    """GET upstream: a BufferedResponse when the body is small, else the open response."""
+    resp = upstreams.request(service_name, method='GET', url=url, headers=headers, params=params, stream=True)
+    if not is_small_body(resp.headers):
+        return resp
+    relay_headers, body = read_whole(resp)
+    return BufferedResponse(resp.status_code, relay_headers, body)
+
+def fetch_coalesced(key, service_name, url, headers, params):
+    """fetch_get shared with the identical requests in flight: (result, shared)."""
+    result, shared = singleflight.do(key, lambda: fetch_get(service_name, url, headers, params))
+    if shared and not isinstance(result, BufferedResponse):
+        # The leader is streaming that response to its own client
+        singleflight.count_not_shared()
+        return fetch_get(service_name, url, headers, params), False
+    return result, shared
+
+def respond(result, extra_headers=()):
+    if isinstance(result, BufferedResponse):
+        return Response(result.body, status=result.status, headers=result.headers + list(extra_headers))
+    return relay_response(result)
+
+def refresh_cached(policy, key, service_name, url, headers, params):
+    """Background refresh of a stale cache entry."""
+    ok = False
+    try:
+        resp = upstreams.request(service_name, method='GET', url=url, headers=headers, params=params, stream=True)
+        with resp:
+            if is_small_body(resp.headers):
+                ok = response_cache.put(policy, key, resp.status_code, *read_whole(resp))
+    except requests.exceptions.RequestException as e:
+        print(f"Cache refresh of {url} failed: {e}")
+    finally:
+        response_cache.end_refresh(key, ok)
+
+def forward_cached(policy, service_name, url, headers, params):
+    """forward_request for a route with a cache policy: answers from the cache when it can."""
+    key = response_cache.key(policy, request.path, request.query_string.decode(), request.headers)
+    if 'no-cache' not in request.headers.get('Cache-Control', ''):
+        entry, state = response_cache.get(policy, key)
+        if entry is not None:
+            if state == STALE and response_cache.start_refresh(key):
+                threading.Thread(target=refresh_cached, args=(policy, key, service_name, url, headers, params),
+                                 daemon=True).start()
+            return Response(entry.body, status=entry.status, headers=entry.relay_headers(time.time(), state))
+
+    flight = coalesce_key('GET', request.path, request.query_string.decode(), headers, policy.shared)
+    result, shared = fetch_coalesced(flight, service_name, url, headers, params)
+    if isinstance(result, BufferedResponse) and not shared:
+        response_cache.put(policy, key, *result)
+    return respond(result, [('X-Cache', 'MISS')])
 
 def forward_request(service_name, service_prefix, path):
     """Funzione helper centralizzata per l'inoltro"""
     url = build_url(SERVICES[service_name], service_prefix, path)
     params = request.args
-    headers = {key: value for key, value in request.headers if key != 'Host'}
-    
+    headers = token_verifier.forward(forward_headers(request.headers.items()))
+
     try:
-        # verify=False is crucial for self-signed certificates
-        resp = requests.request(
-            method=request.method,
-            url=url,
-            json=request.get_json() if request.is_json else None,
-            headers=headers,
-            params=params,
-            verify=False 
-        )
-        return (resp.content, resp.status_code, resp.headers.items())
+        if request.method == 'GET' and not request.is_json and not wants_event_stream(request.headers):
+            policy = response_cache.policy_for(request.method, request.path)
+            if policy is not None:
+                return forward_cached(policy, service_name, url, headers, list(params.items(multi=True)))
+            flight = coalesce_key('GET', request.path, request.query_string.decode(), headers,
+                                  caller_independent(request.path))
+            return respond(fetch_coalesced(flight, service_name, url, headers, list(params.items(multi=True)))[0])
+
+        event_stream = wants_event_stream(request.headers)
+        if event_stream and not stream_slots.acquire(blocking=False):
+            return jsonify({"error": "Too many open streams, poll instead"}), 503
+        try:
+            resp = upstreams.request(
+                service_name,
+                method=request.method,
+                url=url,
+                json=request.get_json() if request.is_json else None,
+                headers=headers,
+                params=params,
+                stream=True,
+                # Event streams only send a heartbeat every few seconds
+                read_timeout=STREAM_READ_TIMEOUT if event_stream else None
+            )
+        except Exception:
+            if event_stream:
+                stream_slots.release()
+            raise
+        relayed = relay_response(resp)
+        if event_stream:
+            relayed.call_on_close(stream_slots.release)
+        return relayed
+    except requests.exceptions.Timeout:
+        return jsonify({"error": f"{service_name} Service timeout"}), 504
     except requests.exceptions.ConnectionError:
         return jsonify({"error": f"{service_name} Service down"}), 503
     except Exception as e:
         return jsonify({"error": str(e)}), 500
 
 # --- PROXIES ---
+# One rule pair per prefix of routing.ROUTES: /matches and /matches/<path>
+
+def make_proxy(service_name, service_prefix):
+    def proxy(path):
+        return forward_request(service_name, service_prefix, path)
+    return proxy
 
-@app.route('/auth', defaults={'path': ''}, methods=['GET', 'POST', 'PUT', 'DELETE'])
-@app.route('/auth/<path:path>', methods=['GET', 'POST', 'PUT', 'DELETE'])
-def proxy_auth(path):
-    return forward_request("auth", "auth", path)
-
-@app.route('/cards', defaults={'path': ''}, methods=['GET', 'POST', 'PUT', 'DELETE'])
-@app.route('/cards/<path:path>', methods=['GET', 'POST', 'PUT', 'DELETE'])
-def proxy_cards(path):
-    return forward_request("cards", "cards", path)
-
-@app.route('/players', defaults={'path': ''}, methods=['GET', 'POST', 'PUT', 'DELETE'])
-@app.route('/players/<path:path>', methods=['GET', 'POST', 'PUT', 'DELETE'])
-def proxy_players(path):
-    return forward_request("player", "players", path)
-
-@app.route('/matches', defaults={'path': ''}, methods=['GET', 'POST', 'PUT', 'DELETE'])
-@app.route('/matches/<path:path>', methods=['GET', 'POST', 'PUT', 'DELETE'])
-def proxy_matches(path):
-    return forward_request("match", "matches", path)
-
-@app.route('/history', defaults={'path': ''}, methods=['GET', 'POST', 'PUT', 'DELETE'])
-@app.route('/history/<path:path>', methods=['GET', 'POST', 'PUT', 'DELETE'])
-def proxy_history(path):
-    return forward_request("history", "history", path)
-
-@app.route('/invites', defaults={'path': ''}, methods=['GET', 'POST', 'PUT', 'DELETE'])
-@app.route('/invites/<path:path>', methods=['GET', 'POST', 'PUT', 'DELETE'])
-def proxy_invites(path):
-    return forward_request("match", "invites", path)
-
-@app.route('/friends', defaults={'path': ''}, methods=['GET', 'POST', 'PUT', 'DELETE'])
-@app.route('/friends/<path:path>', methods=['GET', 'POST', 'PUT', 'DELETE'])
-def proxy_friends(path):
-    return forward_request("player", "friends", path)
-
-# --- New route for matchmaking ---
-@app.route('/matchmaking', defaults={'path': ''}, methods=['GET', 'POST', 'PUT', 'DELETE'])
-@app.route('/matchmaking/<path:path>', methods=['GET', 'POST', 'PUT', 'DELETE'])
-def proxy_matchmaking(path):
-    # Forward to the MATCH service, but use the "matchmaking" prefix
-    # So the URL becomes: http://match-service:5000/matchmaking/join
-    return forward_request("match", "matchmaking", path)
+for _prefix, _service in ROUTES.items():
+    _view = make_proxy(_service, _prefix)
+    app.add_url_rule(f'/{_prefix}', f'proxy_{_prefix}', _view, defaults={'path': ''}, methods=PROXY_METHODS)
+    app.add_url_rule(f'/{_prefix}/<path:path>', f'proxy_{_prefix}', _view, methods=PROXY_METHODS)
 
 if __name__ == '__main__':
     app.run(debug=debug_mode, host='0.0.0.0', port=5000, ssl_context=('../certs/cert.pem', '../certs/key.pem'))
\ No newline at end of file
@@ -0,0 +1,302 @@
+import asyncio
+import os
+import time
+
+import httpx
+from quart import Quart, Response, jsonify, request
+
+from routing import (
+    PROXY_METHODS, ROUTES, SERVICES, build_url, caller_independent, end_to_end_headers, forward_headers,
+    is_small_body, wants_event_stream
+)
+from edge_auth import TokenVerifier
+from response_cache import STALE, ResponseCache
+from singleflight import AsyncSingleFlight, BufferedResponse, coalesce_key
+from upstream import (
+    CONNECT_TIMEOUT, IDEMPOTENT_METHODS, POOL_SIZE, READ_TIMEOUT, RETRIES, RETRY_BACKOFF, RETRY_STATUSES,
+    STREAM_READ_TIMEOUT, service_setting
+)
+
+# --- ASGI GATEWAY ---
+# Same route table (routing.py) and relay rules as app.py, served by an event
+# loop: a proxied request waiting on its service costs a coroutine and a
+# socket instead of a gunicorn thread, so one process can hold thousands of
+# event streams open.
+#
+#     hypercorn --bind 0.0.0.0:5000 --certfile certs/cert.pem --keyfile certs/key.pem asgi_app:app
+#
+# Every service has a concurrency limit, GATEWAY_CONCURRENCY (default 1000)
+# or GATEWAY_CONCURRENCY_<SERVICE>: a request holds a slot until its response
+# is relayed (a stream for its whole life) and one that cannot get a slot
+# within GATEWAY_QUEUE_TIMEOUT seconds is answered 503. Timeouts and retries
+# are the UPSTREAM_* settings of upstream.py.
+
+CONCURRENCY = int(os.environ.get('GATEWAY_CONCURRENCY', '1000'))
+QUEUE_TIMEOUT = float(os.environ.get('GATEWAY_QUEUE_TIMEOUT', '5'))
+
+app = Quart(__name__)
+
+
+class ServiceGate:
+    """Concurrency limit, HTTP client and counters of one service."""
+
+    def __init__(self, name):
+        self.name = name
+        self.limit = service_setting('GATEWAY_CONCURRENCY', name, CONCURRENCY)
+        self.read_timeout = service_setting('UPSTREAM_READ_TIMEOUT', name, READ_TIMEOUT)
+        self.slots = asyncio.Semaphore(self.limit)
+        limits = httpx.Limits(max_connections=self.limit,
+                              max_keepalive_connections=service_setting('UPSTREAM_POOL_SIZE', name, POOL_SIZE))
+        self.client = httpx.AsyncClient(
+            timeout=httpx.Timeout(self.read_timeout, connect=CONNECT_TIMEOUT),
+            # verify=False: self-signed certificates. Connection errors happen
+            # before anything is sent, so the transport retries them for any method
+            transport=httpx.AsyncHTTPTransport(verify=False, limits=limits, retries=RETRIES)
+        )
+        self.in_flight = 0
+        self.counters = {"requests": 0, "rejected": 0, "timeouts": 0, "errors": 0, "retries": 0, "peak_in_flight": 0}
+        self.latency_seconds = 0.0
+
+    async def acquire(self):
+        try:
+            await asyncio.wait_for(self.slots.acquire(), QUEUE_TIMEOUT)
+        except asyncio.TimeoutError:
+            self.counters["rejected"] += 1
+            return False
+        self.in_flight += 1
+        self.counters["peak_in_flight"] = max(self.counters["peak_in_flight"], self.in_flight)
+        return True
+
+    def release(self):
+        self.in_flight -= 1
+        self.slots.release()
+
+    async def send(self, method, url, read_timeout=None, **kwargs):
+        """Opens the response (stream), retrying idempotent methods on 502/503/504 and read errors."""
+        timeout = httpx.Timeout(read_timeout or self.read_timeout, connect=CONNECT_TIMEOUT)
+        started = time.perf_counter()
+        attempt = 0
+        while True:
+            retry = method in IDEMPOTENT_METHODS and attempt < RETRIES
+            try:
+                resp = await self.client.send(self.client.build_request(method, url, timeout=timeout, **kwargs),
+                                              stream=True)
+            except (httpx.ReadError, httpx.ReadTimeout, httpx.RemoteProtocolError) as e:
+                if not retry:
+                    self.counters["timeouts" if isinstance(e, httpx.TimeoutException) else "errors"] += 1
+                    raise
+            except httpx.HTTPError as e:
+                self.counters["timeouts" if isinstance(e, httpx.TimeoutException) else "errors"] += 1
+                raise
+            else:
+                if not (retry and resp.status_code in RETRY_STATUSES):
+                    self.counters["requests"] += 1
+                    self.counters["errors"] += int(resp.status_code >= 500)
+                    self.latency_seconds += time.perf_counter() - started
+                    return resp
+                await resp.aclose()
+            self.counters["retries"] += 1
+            await asyncio.sleep(RETRY_BACKOFF * 2 ** attempt)
+            attempt += 1
+
+    def snapshot(self):
+        requests_ = self.counters["requests"]
+        return dict(self.counters, in_flight=self.in_flight, limit=self.limit,
+                    avg_latency_ms=round(self.latency_seconds * 1000 / requests_, 2) if requests_ else 0.0)
+
+
+gates = {name: ServiceGate(name) for name in SERVICES}
+response_cache = ResponseCache()
+token_verifier = TokenVerifier()
+singleflight = AsyncSingleFlight()
+background_tasks = set()  # cache refreshes, responses left by a coalesced leader
+
+@app.after_serving
+async def close_clients():
+    for gate in gates.values():
+        await gate.client.aclose()
+
+@app.route('/health', methods=['GET'])
+async def gateway_health():
+    return jsonify({"status": "gateway running (secure)"}), 200
+
+@app.route('/gateway/admin/upstreams', methods=['GET'])
+async def upstream_stats():
+    return jsonify({"pid": os.getpid(), "services": {name: gate.snapshot() for name, gate in gates.items()},
+                    "coalescing": singleflight.stats()}), 200
+
+@app.route('/gateway/admin/cache', methods=['GET'])
+async def cache_stats():
+    return jsonify({"pid": os.getpid(), **response_cache.stats()}), 200
+
+@app.route('/gateway/admin/auth', methods=['GET'])
+async def auth_stats():
+    return jsonify({"pid": os.getpid(), **token_verifier.stats()}), 200
+
+# --- HELPER ---
+async def read_whole(resp, gate):
+    """Relayed headers and raw body of a small response; releases the gate's slot."""
+    try:
+        body = b"".join([chunk async for chunk in resp.aiter_raw()])
+    finally:
+        await resp.aclose()
+        gate.release()
+    return end_to_end_headers(resp.headers.multi_items()), body
+
+async def relay_response(resp, gate):
+    """Quart response relaying `resp` (opened with stream=True); releases the gate's slot when done."""
+    if is_small_body(resp.headers):
+        headers, body = await read_whole(resp, gate)
+        return Response(body, status=resp.status_code, headers=headers)
+    headers = end_to_end_headers(resp.headers.multi_items())
+
+    async def generate():
+        try:
+            # No chunk size: httpx would hold data back until a full chunk
+            # arrived, delaying events; each read is at most one network read
+            async for chunk in resp.aiter_raw():
+                yield chunk
+        finally:
+            await resp.aclose()
+            gate.release()
+
+    relayed = Response(generate(), status=resp.status_code, headers=headers)
+    # Event streams and large bodies last as long as the service keeps sending
+    relayed.timeout = None
+    return relayed
+
+async def cache_call(fn, *args):
+    # With the Redis tier a lookup or store is blocking I/O: off the loop
+    if response_cache.redis is not None:
+        return await asyncio.to_thread(fn, *args)
+    return fn(*args)
+
+class ServiceBusy(Exception):
+    """No slot of the service's gate within GATEWAY_QUEUE_TIMEOUT."""
+
+async def open_response(gate, method, url, **kwargs):
+    """gate.send holding one of the service's slots; the slot is released if it fails."""
+    if not await gate.acquire():
+        raise ServiceBusy(gate.name)
+    try:
+        return await gate.send(method, url, **kwargs)
+    except BaseException:
+        gate.release()
+        raise
+
+async def fetch_get(gate, url, headers, params):
+    """GET upstream: a BufferedResponse when the body is small, else the open response."""
+    resp = await open_response(gate, 'GET', url, headers=headers, params=params)
+    if not is_small_body(resp.headers):
+        return resp
+    status = resp.status_code
+    relay_headers, body = await read_whole(resp, gate)
+    return BufferedResponse(status, relay_headers, body)
+
+async def close_response(resp, gate):
+    await resp.aclose()
+    gate.release()
+
+def run_in_background(coro):
+    task = asyncio.create_task(coro)
+    background_tasks.add(task)
+    task.add_done_callback(background_tasks.discard)
+
+async def fetch_coalesced(key, gate, url, headers, params):
+    """fetch_get shared with the identical requests in flight: (result, shared)."""
+    def discard(result):
+        if not isinstance(result, BufferedResponse):
+            run_in_background(close_response(result, gate))
+
+    result, shared = await singleflight.do(key, lambda: fetch_get(gate, url, headers, params), discard)
+    if shared and not isinstance(result, BufferedResponse):
+        # The leader is streaming that response to its own client
+        singleflight.count_not_shared()
+        return await fetch_get(gate, url, headers, params), False
+    return result, shared
+
+async def respond(result, gate, extra_headers=()):
+    if isinstance(result, BufferedResponse):
+        return Response(result.body, status=result.status, headers=result.headers + list(extra_headers))
+    return await relay_response(result, gate)
+
+async def refresh_cached(policy, key, gate, url, headers, params):
+    """Background refresh of a stale cache entry."""
+    ok = False
+    try:
+        result = await fetch_get(gate, url, headers, params)
+        if isinstance(result, BufferedResponse):
+            ok = await cache_call(response_cache.put, policy, key, *result)
+        else:
+            await close_response(result, gate)
+    except (ServiceBusy, httpx.HTTPError) as e:
+        print(f"Cache refresh of {url} failed: {e!r}")
+    finally:
+        response_cache.end_refresh(key, ok)
+
+async def forward_cached(policy, gate, url, headers, params):
+    """forward_request for a route with a cache policy: answers from the cache when it can."""
+    key = response_cache.key(policy, request.path, request.query_string.decode(), request.headers)
+    if 'no-cache' not in request.headers.get('Cache-Control', ''):
+        entry, state = await cache_call(response_cache.get, policy, key)
+        if entry is not None:
+            if state == STALE and response_cache.start_refresh(key):
+                run_in_background(refresh_cached(policy, key, gate, url, headers, params))
+            return Response(entry.body, status=entry.status, headers=entry.relay_headers(time.time(), state))
+
+    flight = coalesce_key('GET', request.path, request.query_string.decode(), headers, policy.shared)
+    result, shared = await fetch_coalesced(flight, gate, url, headers, params)
+    if isinstance(result, BufferedResponse) and not shared:
+        await cache_call(response_cache.put, policy, key, *result)
+    return await respond(result, gate, [('X-Cache', 'MISS')])
+
+async def forward_request(service_name, service_prefix, path):
+    """Async counterpart of app.forward_request."""
+    gate = gates[service_name]
+    url = build_url(SERVICES[service_name], service_prefix, path)
+    headers = token_verifier.forward(forward_headers(request.headers.items()))
+    params = list(request.args.items(multi=True))
+    event_stream = wants_event_stream(request.headers)
+
+    try:
+        if request.method == 'GET' and not request.is_json and not event_stream:
+            policy = response_cache.policy_for(request.method, request.path)
+            if policy is not None:
+                return await forward_cached(policy, gate, url, headers, params)
+            flight = coalesce_key('GET', request.path, request.query_string.decode(), headers,
+                                  caller_independent(request.path))
+            return await respond((await fetch_coalesced(flight, gate, url, headers, params))[0], gate)
+
+        resp = await open_response(
+            gate,
+            request.method,
+            url,
+            json=(await request.get_json()) if request.is_json else None,
+            headers=headers,
+            params=params,
+            read_timeout=STREAM_READ_TIMEOUT if event_stream else None
+        )
+        return await relay_response(resp, gate)
+    except ServiceBusy:
+        return jsonify({"error": f"{service_name} Service busy"}), 503
+    except httpx.TimeoutException:
+        return jsonify({"error": f"{service_name} Service timeout"}), 504
+    except httpx.TransportError:
+        return jsonify({"error": f"{service_name} Service down"}), 503
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
+
+# --- PROXIES ---
+
+def make_proxy(service_name, service_prefix):
+    async def proxy(path):
+        return await forward_request(service_name, service_prefix, path)
+    return proxy
+
+for _prefix, _service in ROUTES.items():
+    _view = make_proxy(_service, _prefix)
+    app.add_url_rule(f'/{_prefix}', f'proxy_{_prefix}', _view, defaults={'path': ''}, methods=PROXY_METHODS)
+    app.add_url_rule(f'/{_prefix}/<path:path>', f'proxy_{_prefix}', _view, methods=PROXY_METHODS)
+
+if __name__ == '__main__':
+    app.run(host='0.0.0.0', port=5000, certfile='../certs/cert.pem', keyfile='../certs/key.pem')
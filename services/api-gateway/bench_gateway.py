@@ -0,0 +1,272 @@
+"""How many concurrent long polls one gateway process can hold: Flask vs ASGI.
+
+Starts a stand-in for the backend services (upstream_app below, over TLS
+with the repo certificates, like the real services) and, for every level,
+a fresh process of each gateway mode on plain HTTP, pointed at it through
+*_SERVICE_URL:
+
+  flask  gunicorn, 1 gthread worker with 32 threads (as in docker-compose)
+  asgi   hypercorn, 1 worker running asgi_app
+
+For each level, N clients open GET /matches/<id>/stream through the gateway,
+spread evenly over --ramp seconds; the stand-in answers with an event right
+away and a heartbeat every --heartbeat seconds until --hold seconds have
+passed. A stream counts as held when it answered 200 and its first event
+arrived within --open-timeout. While they are open, a probe client sends
+GET /cards/probe requests one after another, to show whether the gateway
+still answers short requests.
+
+    python bench_gateway.py --streams 32 256 1024 --ramp 10 --hold 30
+    python bench_gateway.py --target flask=http://host:5000 --streams 500
+
+Reported per level: streams held, probe latency and errors, and for the
+gateways started here their resident memory and CPU seconds (from /proc).
+The file descriptor limit is raised to its hard limit first; each held
+stream costs the gateway two sockets. Every stream also needs its own TLS
+connection to the service: opening a thousand at once on a single core
+hits UPSTREAM_CONNECT_TIMEOUT, hence the ramp. The ASGI gateway admits at
+most GATEWAY_CONCURRENCY (default 1000) requests per service.
+"""
+import argparse
+import asyncio
+import json
+import os
+import resource
+import subprocess
+import sys
+import time
+
+import httpx
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+CERTS = os.path.join(HERE, "..", "..", "certs")
+SERVICE_NAMES = ("AUTH", "CARDS", "PLAYER", "MATCH", "HISTORY")
+GATEWAYS = {
+    "flask": ["gunicorn", "--bind", "127.0.0.1:{port}", "--workers", "1",
+              "--worker-class", "gthread", "--threads", "32", "app:app"],
+    "asgi": ["hypercorn", "--bind", "127.0.0.1:{port}", "--workers", "1", "asgi_app:app"],
+}
+REQUEST_TIMEOUT = 10
+
+
+# --- STAND-IN SERVICE ---
+
+async def upstream_app(scope, receive, send):
+    """Minimal ASGI backend: event streams on .../stream, small JSON otherwise."""
+    if scope["type"] == "lifespan":
+        while True:
+            message = await receive()
+            if message["type"] == "lifespan.startup":
+                await send({"type": "lifespan.startup.complete"})
+            elif message["type"] == "lifespan.shutdown":
+                await send({"type": "lifespan.shutdown.complete"})
+                return
+    if not scope["path"].endswith("/stream"):
+        body = json.dumps({"path": scope["path"]}).encode()
+        await send({"type": "http.response.start", "status": 200,
+                    "headers": [(b"content-type", b"application/json"),
+                                (b"content-length", str(len(body)).encode())]})
+        await send({"type": "http.response.body", "body": body})
+        return
+
+    hold = float(os.environ.get("BENCH_HOLD", "15"))
+    heartbeat = float(os.environ.get("BENCH_HEARTBEAT", "5"))
+    await send({"type": "http.response.start", "status": 200,
+                "headers": [(b"content-type", b"text/event-stream"), (b"cache-control", b"no-cache")]})
+    await send({"type": "http.response.body", "body": b"event: open\ndata: {}\n\n", "more_body": True})
+    stop_at = time.monotonic() + hold
+    while time.monotonic() < stop_at:
+        await asyncio.sleep(min(heartbeat, max(0.0, stop_at - time.monotonic())))
+        await send({"type": "http.response.body", "body": b": heartbeat\n\n", "more_body": True})
+    await send({"type": "http.response.body", "body": b""})
+
+
+# --- PROCESSES ---
+
+def raise_fd_limit():
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if hard == resource.RLIM_INFINITY or hard > soft:
+        resource.setrlimit(resource.RLIMIT_NOFILE, (hard if hard != resource.RLIM_INFINITY else 65536, hard))
+    return resource.getrlimit(resource.RLIMIT_NOFILE)[0]
+
+
+def process_usage(pid):
+    """(RSS in MiB, CPU seconds) of a process and its children, Linux only."""
+    try:
+        with open(f"/proc/{pid}/stat") as f:
+            fields = f.read().rsplit(")", 1)[1].split()
+        cpu = (int(fields[11]) + int(fields[12])) / os.sysconf("SC_CLK_TCK")
+        rss = int(fields[21]) * os.sysconf("SC_PAGE_SIZE") / 2 ** 20
+        with open(f"/proc/{pid}/task/{pid}/children") as f:
+            children = [int(c) for c in f.read().split()]
+    except (OSError, ValueError):
+        return 0.0, 0.0
+    for child in children:
+        child_rss, child_cpu = process_usage(child)
+        rss, cpu = rss + child_rss, cpu + child_cpu
+    return rss, cpu
+
+
+def start(cmd, env):
+    return subprocess.Popen(cmd, env=env, cwd=HERE, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+
+def start_upstream(port, args):
+    env = dict(os.environ, BENCH_HOLD=str(args.hold), BENCH_HEARTBEAT=str(args.heartbeat))
+    return start(["hypercorn", "--bind", f"127.0.0.1:{port}", "--workers", "1",
+                  "--certfile", os.path.join(CERTS, "cert.pem"), "--keyfile", os.path.join(CERTS, "key.pem"),
+                  "bench_gateway:upstream_app"], env)
+
+
+def start_gateway(name, port, upstream_url):
+    env = dict(os.environ, **{f"{service}_SERVICE_URL": upstream_url for service in SERVICE_NAMES})
+    return start([part.format(port=port) for part in GATEWAYS[name]], env)
+
+
+# --- LOAD ---
+
+async def wait_ready(client, url, seconds=20):
+    deadline = time.monotonic() + seconds
+    while time.monotonic() < deadline:
+        try:
+            if (await client.get(f"{url}/health")).status_code == 200:
+                return
+        except httpx.HTTPError:
+            pass
+        await asyncio.sleep(0.2)
+    raise RuntimeError(f"{url} did not start")
+
+
+async def long_poll(client, url, index, delay, open_timeout, held, failed, done):
+    await asyncio.sleep(delay)
+    try:
+        async with client.stream("GET", f"{url}/matches/bench{index}/stream",
+                                 headers={"Accept": "text/event-stream"}) as resp:
+            if resp.status_code != 200:
+                failed.append(resp.status_code)
+                return
+            chunks = resp.aiter_raw()
+            await asyncio.wait_for(chunks.__anext__(), open_timeout)
+            held.append(time.monotonic())
+            await done.wait()
+    except (httpx.HTTPError, asyncio.TimeoutError, StopAsyncIteration) as e:
+        failed.append(type(e).__name__)
+
+
+async def probe(client, url, stop, latencies, errors):
+    while not stop.is_set():
+        started = time.perf_counter()
+        try:
+            resp = await client.get(f"{url}/cards/probe")
+            if resp.status_code == 200:
+                latencies.append(time.perf_counter() - started)
+            else:
+                errors.append(resp.status_code)
+        except httpx.HTTPError as e:
+            errors.append(type(e).__name__)
+        await asyncio.sleep(0.05)
+
+
+async def run_level(url, streams, args, pid=None):
+    limits = httpx.Limits(max_connections=streams + 10, max_keepalive_connections=10)
+    timeout = httpx.Timeout(REQUEST_TIMEOUT, read=args.hold + REQUEST_TIMEOUT)
+    async with httpx.AsyncClient(limits=limits, timeout=timeout) as client, \
+            httpx.AsyncClient(timeout=REQUEST_TIMEOUT) as probe_client:
+        held, failed, latencies, errors = [], [], [], []
+        done, stop = asyncio.Event(), asyncio.Event()
+        cpu_before = process_usage(pid)[1] if pid else 0.0
+        started = time.monotonic()
+        pollers = [asyncio.create_task(long_poll(client, url, i, args.ramp * i / streams, args.open_timeout,
+                                                 held, failed, done))
+                   for i in range(streams)]
+        prober = asyncio.create_task(probe(probe_client, url, stop, latencies, errors))
+        await asyncio.sleep(args.ramp + args.open_timeout + 1)
+        result = {"streams": streams, "held": len(held), "failed": len(failed)}
+        if held:
+            result["open_all_s"] = round(max(held) - started, 2)
+        if pid:
+            rss, cpu = process_usage(pid)
+            result["gateway_rss_mib"] = round(rss, 1)
+            result["gateway_cpu_s"] = round(cpu - cpu_before, 2)
+        stop.set()
+        done.set()
+        await prober
+        await asyncio.gather(*pollers, return_exceptions=True)
+        lat = sorted(latencies)
+        result["probe_ok"] = len(lat)
+        result["probe_errors"] = len(errors)
+        result["probe_p50_ms"] = round(lat[len(lat) // 2] * 1000, 1) if lat else None
+        result["probe_p99_ms"] = round(lat[min(len(lat) - 1, int(0.99 * len(lat)))] * 1000, 1) if lat else None
+    return result
+
+
+async def bench(targets, args, upstream_url=None):
+    """Runs the levels against each target; without a URL the gateway is started per level."""
+    report = {}
+    async with httpx.AsyncClient(timeout=REQUEST_TIMEOUT) as client:
+        for offset, (name, url) in enumerate(targets.items(), start=1):
+            report[name] = {}
+            for level in args.streams:
+                proc = None
+                if url is None:
+                    # A fresh process per level: a sync gateway would otherwise
+                    # still be working through the previous level's queue
+                    port = args.port + offset
+                    proc = start_gateway(name, port, upstream_url)
+                level_url = url or f"http://127.0.0.1:{port}"
+                try:
+                    await wait_ready(client, level_url)
+                    result = await run_level(level_url, level, args, proc.pid if proc else None)
+                finally:
+                    if proc:
+                        proc.terminate()
+                        proc.wait()
+                report[name][level] = result
+                extra = ""
+                if "gateway_rss_mib" in result:
+                    extra = f"  rss {result['gateway_rss_mib']} MiB  cpu {result['gateway_cpu_s']} s"
+                print(f"{name:6s} streams={level:<5d} held {result['held']:<5d} failed {result['failed']:<5d} "
+                      f"probe p50 {result['probe_p50_ms']} ms p99 {result['probe_p99_ms']} ms "
+                      f"errors {result['probe_errors']}{extra}")
+                # The stand-in notices a closed stream on its next heartbeat
+                await asyncio.sleep(args.heartbeat + 1)
+    return report
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Concurrent long polls held by one gateway process")
+    parser.add_argument("--streams", type=int, nargs="+", default=[32, 256, 1024])
+    parser.add_argument("--ramp", type=float, default=10, help="seconds over which the streams are opened")
+    parser.add_argument("--hold", type=float, default=30, help="seconds the stand-in keeps a stream open")
+    parser.add_argument("--heartbeat", type=float, default=5, help="seconds between heartbeats")
+    parser.add_argument("--open-timeout", type=float, default=5, help="seconds to get the first event")
+    parser.add_argument("--target", action="append", default=[], metavar="NAME=URL",
+                        help="benchmark running gateways instead of starting them")
+    parser.add_argument("--port", type=int, default=5200)
+    parser.add_argument("--json", help="write the report to this file")
+    args = parser.parse_args()
+    if args.hold < args.ramp + args.open_timeout + 2:
+        parser.error("--hold must outlast --ramp + --open-timeout by at least 2 seconds")
+
+    print(f"file descriptor limit: {raise_fd_limit()}")
+    upstream = None
+    if args.target:
+        targets = dict(t.split("=", 1) for t in args.target)
+    else:
+        upstream = start_upstream(args.port, args)
+        targets = dict.fromkeys(GATEWAYS)
+    try:
+        report = asyncio.run(bench(targets, args, f"https://127.0.0.1:{args.port}"))
+    finally:
+        if upstream:
+            upstream.terminate()
+            upstream.wait()
+
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(report, f, indent=2)
+    return report
+
+
+if __name__ == '__main__':
+    sys.exit(main() and 0)
@@ -0,0 +1,96 @@
+import hashlib
+import hmac
+import os
+import threading
+import time
+from collections import OrderedDict
+
+import jwt
+
+# --- EDGE AUTHENTICATION ---
+# The gateway verifies the bearer token of a request once and forwards the
+# identity to the services as X-Auth-* headers, so they do not decode the
+# JWT or look the user up to know who is calling. Verified tokens are kept
+# in an LRU by SHA-256 digest until they expire: a client repeating its
+# token costs a hash, not a signature check.
+#
+# The headers are signed with the SECRET_KEY the tokens are signed with
+# (HMAC-SHA256 of user id, username and expiry), so a service checks them
+# with one hash and a caller inside the network cannot forge them. Any
+# X-Auth-* header sent by a client is dropped. The Authorization header is
+# still forwarded; an invalid or expired token just gets no identity and
+# the service answers as for an anonymous request.
+
+SECRET_KEY = os.environ.get('SECRET_KEY', 'super_secret_key')
+TOKEN_CACHE_SIZE = int(os.environ.get('GATEWAY_TOKEN_CACHE_SIZE', '10000'))
+
+IDENTITY_HEADERS = ('X-Auth-User-Id', 'X-Auth-Username', 'X-Auth-Expires', 'X-Auth-Signature')
+IDENTITY_PREFIX = 'x-auth-'
+
+
+def sign_identity(user_id, username, expires):
+    message = f"{user_id}\n{username}\n{expires}".encode()
+    return hmac.new(SECRET_KEY.encode(), message, hashlib.sha256).hexdigest()
+
+
+def bearer_token(authorization):
+    scheme, _, token = (authorization or '').partition(' ')
+    return token.strip() if scheme.lower() == 'bearer' else ''
+
+
+class TokenVerifier:
+    def __init__(self, max_entries=TOKEN_CACHE_SIZE):
+        self.max_entries = max_entries
+        self._verified = OrderedDict()  # token digest -> (expires, identity headers)
+        self._lock = threading.Lock()
+        self.counters = {"verified": 0, "cache_hits": 0, "invalid": 0, "anonymous": 0, "evictions": 0}
+
+    def identity(self, authorization):
+        """Signed identity headers for a valid bearer token, {} otherwise."""
+        token = bearer_token(authorization)
+        if not token:
+            self._count("anonymous")
+            return {}
+        digest = hashlib.sha256(token.encode()).digest()
+        now = time.time()
+        with self._lock:
+            cached = self._verified.get(digest)
+            if cached is not None and cached[0] > now:
+                self._verified.move_to_end(digest)
+                self.counters["cache_hits"] += 1
+                return cached[1]
+
+        try:
+            claims = jwt.decode(token, SECRET_KEY, algorithms=['HS256'],
+                                options={"require": ["exp", "user_id", "username"]})
+        except jwt.InvalidTokenError:
+            self._count("invalid")
+            return {}
+        expires = int(claims['exp'])
+        headers = dict(zip(IDENTITY_HEADERS, (
+            str(claims['user_id']), claims['username'], str(expires),
+            sign_identity(claims['user_id'], claims['username'], expires)
+        )))
+        with self._lock:
+            self.counters["verified"] += 1
+            self._verified[digest] = (expires, headers)
+            self._verified.move_to_end(digest)
+            while len(self._verified) > self.max_entries:
+                self._verified.popitem(last=False)
+                self.counters["evictions"] += 1
+        return headers
+
+    def forward(self, headers):
+        """Upstream headers: client X-Auth-* dropped, the verified identity added."""
+        forwarded = {k: v for k, v in headers.items() if not k.lower().startswith(IDENTITY_PREFIX)}
+        authorization = next((v for k, v in headers.items() if k.lower() == 'authorization'), None)
+        forwarded.update(self.identity(authorization))
+        return forwarded
+
+    def _count(self, name):
+        with self._lock:
+            self.counters[name] += 1
+
+    def stats(self):
+        with self._lock:
+            return dict(self.counters, size=len(self._verified), max_entries=self.max_entries)
@@ -0,0 +1,299 @@
+import hashlib
+import json
+import os
+import re
+import threading
+import time
+from collections import OrderedDict, namedtuple
+
+import redis
+
+# --- RESPONSE CACHE ---
+# Caches whole GET responses of the routes listed in CACHE_POLICIES, so a
+# catalog that never changes does not cost a hop to its service and a
+# Postgres query per call. Two tiers: a per-process LRU bounded by entries
+# and bytes, and, when GATEWAY_CACHE_REDIS_URL is set, a Redis tier shared
+# by all gateway processes (an LRU miss looks there before the service).
+#
+# An entry is fresh for `ttl` seconds, then stale for `stale` more seconds:
+# a stale entry is still served (X-Cache: STALE) while one background
+# request per key refreshes it (stale-while-revalidate). Only 200 answers
+# small enough to be read whole (routing.is_small_body) are stored, never
+# ones with Set-Cookie or Cache-Control no-store/private; a request with
+# Cache-Control no-cache skips the lookup and refreshes the entry.
+#
+# The key holds the path, the query string, Accept-Encoding (bodies are
+# relayed as the service encoded them) and the auth context: a digest of
+# the Authorization header, so a user never gets an entry filled with
+# someone else's credentials. A policy with shared=True drops the auth
+# context, for routes that answer the same to everyone.
+#
+# Targeted invalidation: a message on PURGE_CHANNEL, {"policy": name,
+# "prefix": path}, drops the entries of that policy whose path starts with
+# the prefix from the LRU of every gateway process and from the Redis tier.
+# The outbox worker of match-service sends one after it delivers stats
+# (leaderboard) and history records (history_match); by hand:
+#   redis-cli PUBLISH gwcache:purge '{"policy": "leaderboard"}'
+# Purges need the Redis tier. A process that loses its subscription empties
+# its LRU, since it may have missed one.
+
+CachePolicy = namedtuple('CachePolicy', 'name pattern ttl stale shared')
+
+def cache_setting(name, default):
+    return int(os.environ.get(f'GATEWAY_CACHE_{name}', default))
+
+CACHE_POLICIES = [
+    # The card catalog is static
+    CachePolicy('cards', re.compile(r'/cards/cards(/\d+)?'),
+                cache_setting('TTL_CARDS', 3600), cache_setting('STALE_CARDS', 86400), True),
+    # Changes when a match ends; a few seconds behind is fine
+    CachePolicy('leaderboard', re.compile(r'/players/leaderboard/top'),
+                cache_setting('TTL_LEADERBOARD', 30), cache_setting('STALE_LEADERBOARD', 300), True),
+    # Archived matches never change
+    CachePolicy('history_match', re.compile(r'/history/match/[^/]+(/replay)?'),
+                cache_setting('TTL_HISTORY_MATCH', 3600), cache_setting('STALE_HISTORY_MATCH', 86400), True),
+]
+
+CACHE_ENTRIES = cache_setting('ENTRIES', 1000)
+CACHE_MAX_BYTES = cache_setting('MAX_BYTES', 32 * 1024 * 1024)
+REDIS_KEY_PREFIX = "gwcache:"
+
+PURGE_CHANNEL = "gwcache:purge"
+RECONNECT_SECONDS = 1
+
+FRESH, STALE = 'fresh', 'stale'
+
+
+class CachedResponse:
+    __slots__ = ('status', 'headers', 'body', 'stored_at', 'fresh_until', 'stale_until')
+
+    def __init__(self, status, headers, body, stored_at, ttl, stale):
+        self.status = status
+        self.headers = headers
+        self.body = body
+        self.stored_at = stored_at
+        self.fresh_until = stored_at + ttl
+        self.stale_until = stored_at + ttl + stale
+
+    def state(self, now):
+        if now < self.fresh_until:
+            return FRESH
+        return STALE if now < self.stale_until else None
+
+    def relay_headers(self, now, cache_state):
+        return self.headers + [('Age', str(int(now - self.stored_at))), ('X-Cache', cache_state.upper())]
+
+    def dumps(self):
+        meta = {"status": self.status, "headers": self.headers, "stored_at": self.stored_at,
+                "ttl": self.fresh_until - self.stored_at, "stale": self.stale_until - self.fresh_until}
+        return json.dumps(meta).encode() + b"\n" + self.body
+
+    @classmethod
+    def loads(cls, raw):
+        meta, body = raw.split(b"\n", 1)
+        meta = json.loads(meta)
+        return cls(meta["status"], [tuple(h) for h in meta["headers"]], body,
+                   meta["stored_at"], meta["ttl"], meta["stale"])
+
+
+def glob_escape(text):
+    return ''.join('\\' + c if c in '*?[]\\' else c for c in text)
+
+
+def is_storable(status, headers):
+    if status != 200:
+        return False
+    names = {k.lower(): v.lower() for k, v in headers}
+    cache_control = names.get('cache-control', '')
+    return 'set-cookie' not in names and 'no-store' not in cache_control and 'private' not in cache_control
+
+
+class ResponseCache:
+    def __init__(self, policies=CACHE_POLICIES, max_entries=CACHE_ENTRIES, max_bytes=CACHE_MAX_BYTES,
+                 redis_url=os.environ.get('GATEWAY_CACHE_REDIS_URL')):
+        self.policies = policies
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.redis_url = redis_url
+        self.redis = redis.Redis.from_url(redis_url, socket_timeout=0.2) if redis_url else None
+        self._entries = OrderedDict()   # key -> CachedResponse
+        self._bytes = 0
+        self._refreshing = set()        # keys with a background refresh in flight
+        self._lock = threading.Lock()
+        self._listening = False         # subscribed to PURGE_CHANNEL
+        self._listener_started = False
+        self.counters = {"hits": 0, "stale_hits": 0, "misses": 0, "redis_hits": 0, "stores": 0,
+                         "refreshes": 0, "refresh_errors": 0, "evictions": 0, "redis_errors": 0,
+                         "purges": 0, "purged": 0}
+        self.by_policy = {p.name: {"hits": 0, "stale_hits": 0, "misses": 0} for p in policies}
+
+    # --- keys ---
+    def policy_for(self, method, path):
+        if method != 'GET' or self.max_entries <= 0:
+            return None
+        return next((p for p in self.policies if p.pattern.fullmatch(path)), None)
+
+    def key(self, policy, path, query_string, headers):
+        auth = '' if policy.shared else headers.get('Authorization', '')
+        auth_context = hashlib.sha256(auth.encode()).hexdigest()[:32] if auth else '-'
+        encoding = headers.get('Accept-Encoding', '').replace(' ', '')
+        return f"{policy.name}|{path}?{query_string}|{encoding}|{auth_context}"
+
+    # --- lookups ---
+    def get(self, policy, key):
+        """(entry, FRESH or STALE), or (None, None) on a miss; counts the lookup."""
+        self._ensure_listener()
+        now = time.time()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._entries.move_to_end(key)
+        if entry is None or entry.state(now) is None:
+            entry = self._redis_get(key)
+        state = entry.state(now) if entry is not None else None
+        counter = {FRESH: "hits", STALE: "stale_hits", None: "misses"}[state]
+        with self._lock:
+            self.counters[counter] += 1
+            self.by_policy[policy.name][counter] += 1
+        return (entry, state) if state else (None, None)
+
+    def _redis_get(self, key):
+        if self.redis is None:
+            return None
+        try:
+            raw = self.redis.get(REDIS_KEY_PREFIX + key)
+        except redis.RedisError:
+            self._count_redis_error()
+            return None
+        if raw is None:
+            return None
+        entry = CachedResponse.loads(raw)
+        with self._lock:
+            self.counters["redis_hits"] += 1
+        self._remember(key, entry)
+        return entry
+
+    # --- stores ---
+    def put(self, policy, key, status, headers, body):
+        """Stores a response if it may be cached; returns whether it was."""
+        if not is_storable(status, headers) or len(body) > self.max_bytes:
+            return False
+        entry = CachedResponse(status, headers, body, time.time(), policy.ttl, policy.stale)
+        self._remember(key, entry)
+        with self._lock:
+            self.counters["stores"] += 1
+        if self.redis is not None:
+            try:
+                self.redis.set(REDIS_KEY_PREFIX + key, entry.dumps(), ex=policy.ttl + policy.stale)
+            except redis.RedisError:
+                self._count_redis_error()
+        return True
+
+    def _count_redis_error(self):
+        # The Redis tier is optional: an unreachable Redis only costs the lookups
+        with self._lock:
+            self.counters["redis_errors"] += 1
+
+    def _remember(self, key, entry):
+        with self._lock:
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self._bytes -= len(old.body)
+            self._entries[key] = entry
+            self._bytes += len(entry.body)
+            while len(self._entries) > self.max_entries or self._bytes > self.max_bytes:
+                _, evicted = self._entries.popitem(last=False)
+                self._bytes -= len(evicted.body)
+                self.counters["evictions"] += 1
+
+    # --- targeted invalidation ---
+    def purge(self, policy_name, prefix=''):
+        """Drops the entries of a policy whose path starts with `prefix`, in both tiers."""
+        start = f"{policy_name}|{prefix}"
+        with self._lock:
+            keys = [key for key in self._entries if key.startswith(start)]
+            for key in keys:
+                self._bytes -= len(self._entries.pop(key).body)
+            self.counters["purges"] += 1
+            self.counters["purged"] += len(keys)
+        if self.redis is not None:
+            try:
+                tier_keys = list(self.redis.scan_iter(match=glob_escape(REDIS_KEY_PREFIX + start) + '*', count=500))
+                if tier_keys:
+                    self.redis.delete(*tier_keys)
+            except redis.RedisError:
+                self._count_redis_error()
+        return len(keys)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._bytes = 0
+
+    def _ensure_listener(self):
+        # Started lazily so every worker process gets its own thread after fork
+        if self.redis is None or self._listener_started:
+            return
+        with self._lock:
+            if self._listener_started:
+                return
+            self._listener_started = True
+        threading.Thread(target=self._listen, daemon=True, name="response-cache-purge").start()
+
+    def _listen(self):
+        # No socket timeout: the subscription is idle between purges
+        client = redis.Redis.from_url(self.redis_url)
+        while True:
+            pubsub = client.pubsub()
+            try:
+                pubsub.subscribe(PURGE_CHANNEL)
+                for message in pubsub.listen():
+                    if message['type'] == 'subscribe':
+                        self._listening = True
+                    elif message['type'] == 'message':
+                        self._on_purge(message['data'])
+            except redis.RedisError as e:
+                print(f"Response cache lost its purge subscription: {e}")
+            finally:
+                self._listening = False
+                self.clear()
+                pubsub.close()
+            time.sleep(RECONNECT_SECONDS)
+
+    def _on_purge(self, data):
+        try:
+            message = json.loads(data)
+            policy_name, prefix = message['policy'], message.get('prefix', '')
+        except (ValueError, KeyError, TypeError):
+            policy_name = prefix = None
+        if not isinstance(prefix, str) or not any(p.name == policy_name for p in self.policies):
+            print(f"Ignoring purge message: {data!r}")
+            return
+        self.purge(policy_name, prefix)
+
+    # --- stale-while-revalidate ---
+    def start_refresh(self, key):
+        """True if the caller should refresh `key` (no other refresh of it in flight)."""
+        with self._lock:
+            if key in self._refreshing:
+                return False
+            self._refreshing.add(key)
+            self.counters["refreshes"] += 1
+            return True
+
+    def end_refresh(self, key, ok=True):
+        with self._lock:
+            self._refreshing.discard(key)
+            self.counters["refresh_errors"] += int(not ok)
+
+    def stats(self):
+        with self._lock:
+            counters = dict(self.counters)
+            by_policy = {name: dict(c) for name, c in self.by_policy.items()}
+            size, size_bytes = len(self._entries), self._bytes
+        for c in [counters] + list(by_policy.values()):
+            lookups = c["hits"] + c["stale_hits"] + c["misses"]
+            c["hit_ratio"] = round((c["hits"] + c["stale_hits"]) / lookups, 4) if lookups else 0.0
+        return dict(counters, size=size, bytes=size_bytes, max_entries=self.max_entries,
+                    max_bytes=self.max_bytes, redis_tier=self.redis is not None,
+                    purge_listener=self._listening, policies=by_policy)
@@ -0,0 +1,82 @@
+import os
+import re
+
+# --- ROUTE TABLE ---
+# Shared by app.py (Flask) and asgi_app.py (asyncio), so both gateway modes
+# proxy the same paths to the same services with the same header rules.
+
+# Map of services UPDATED TO HTTPS (<NAME>_SERVICE_URL overrides one, e.g. for a local run)
+SERVICES = {
+    name: os.environ.get(f'{name.upper()}_SERVICE_URL', url)
+    for name, url in {
+        "auth": "https://auth-service:5000",
+        "cards": "https://cards-service:5000",
+        "player": "https://player-service:5000",
+        "match": "https://match-service:5000",
+        "history": "https://history-service:5000"
+    }.items()
+}
+
+# Path prefix -> service. The prefix is kept in the upstream URL, so
+# /matchmaking/join goes to https://match-service:5000/matchmaking/join
+ROUTES = {
+    "auth": "auth",
+    "cards": "cards",
+    "players": "player",
+    "matches": "match",
+    "history": "history",
+    "invites": "match",
+    "friends": "player",
+    "matchmaking": "match",
+}
+PROXY_METHODS = ['GET', 'POST', 'PUT', 'DELETE']
+
+# GETs that answer the same whoever asks: match-service reads no identity
+# headers and takes the viewer from ?player=, which is part of the request
+# key. Identical requests on these paths are coalesced across users (see
+# singleflight.py); a path whose service starts reading the caller's
+# identity must be removed from here.
+CALLER_INDEPENDENT_PATHS = [
+    re.compile(r'/matches'),
+    re.compile(r'/matches/[^/]+'),
+    re.compile(r'/matches/[^/]+/reactions'),
+]
+
+def caller_independent(path):
+    return any(pattern.fullmatch(path) for pattern in CALLER_INDEPENDENT_PATHS)
+
+def build_url(service_url, service_prefix, path):
+    if path:
+        return f"{service_url}/{service_prefix}/{path}"
+    return f"{service_url}/{service_prefix}"
+
+# --- RELAY ---
+# Responses are relayed as raw bytes (still compressed if the service
+# compressed them), so Content-Length and Content-Encoding stay valid
+# end to end; only hop-by-hop headers are dropped (RFC 9110 7.6.1).
+# A body up to STREAM_THRESHOLD bytes is read whole, which hands the
+# connection back to the pool at once; a bigger body, or one of unknown
+# length such as an event stream, is relayed chunk by chunk as it arrives,
+# so the gateway never holds more than one chunk of it in memory.
+HOP_BY_HOP_HEADERS = {'connection', 'keep-alive', 'proxy-authenticate', 'proxy-authorization',
+                      'proxy-connection', 'te', 'trailer', 'transfer-encoding', 'upgrade'}
+STREAM_THRESHOLD = int(os.environ.get('GATEWAY_STREAM_THRESHOLD', str(64 * 1024)))
+STREAM_CHUNK_SIZE = int(os.environ.get('GATEWAY_STREAM_CHUNK_SIZE', str(16 * 1024)))
+
+def end_to_end_headers(items):
+    """(name, value) pairs without the hop-by-hop ones, including those named by Connection."""
+    items = list(items)
+    named = {token.strip().lower() for name, value in items if name.lower() == 'connection'
+             for token in value.split(',')}
+    return [(k, v) for k, v in items if k.lower() not in HOP_BY_HOP_HEADERS | named]
+
+def forward_headers(items):
+    """Client headers to send upstream: end to end ones, without Host."""
+    return {k: v for k, v in end_to_end_headers(items) if k.lower() != 'host'}
+
+def is_small_body(headers):
+    length = headers.get('Content-Length')
+    return length is not None and length.isdigit() and int(length) <= STREAM_THRESHOLD
+
+def wants_event_stream(headers):
+    return 'text/event-stream' in headers.get('Accept', '')
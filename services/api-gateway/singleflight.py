@@ -0,0 +1,131 @@
+import asyncio
+import hashlib
+import threading
+from collections import namedtuple
+
+# --- REQUEST COALESCING ---
+# Identical GETs in flight at the same time share one upstream call: the
+# first one (the leader) goes to the service, the others wait for its
+# result. The spectators of a match and the dashboard fan-out ask for the
+# same resources within milliseconds of each other.
+#
+# Requests are identical when method, path, query string, the headers that
+# change the answer (VARY_HEADERS) and the auth context match. The auth
+# context is the user the gateway verified (X-Auth-User-Id), a digest of an
+# Authorization header it could not verify, or nobody; routes that answer
+# the same to everyone (shared cache policies, CALLER_INDEPENDENT_PATHS in
+# routing.py) ignore it. The two players of a match still make separate
+# calls: each asks with its own ?player= and gets its own view. Only a response
+# that was read whole can be shared; when the leader had to stream its
+# answer, the others make their own call.
+
+VARY_HEADERS = ('accept', 'accept-encoding', 'if-none-match', 'if-modified-since', 'cookie')
+COALESCED_METHODS = frozenset({'GET'})
+
+# A response read whole, safe to hand to several clients
+BufferedResponse = namedtuple('BufferedResponse', 'status headers body')
+
+
+def coalesce_key(method, path, query_string, headers, shared=False):
+    """Key of a request from its upstream headers (identity already added), or None."""
+    if method not in COALESCED_METHODS:
+        return None
+    lowered = {k.lower(): v for k, v in headers.items()}
+    if shared:
+        auth_context = '-'
+    elif 'x-auth-user-id' in lowered:
+        auth_context = 'user:' + lowered['x-auth-user-id']
+    elif 'authorization' in lowered:
+        auth_context = 'token:' + hashlib.sha256(lowered['authorization'].encode()).hexdigest()
+    else:
+        auth_context = '-'
+    vary = '\n'.join(lowered.get(name, '') for name in VARY_HEADERS)
+    digest = hashlib.sha256(f"{auth_context}\n{vary}".encode()).hexdigest()[:32]
+    return f"{method} {path}?{query_string} {digest}"
+
+
+class _Call:
+    __slots__ = ('done', 'result', 'error')
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class SingleFlight:
+    """Thread version, for the gthread workers of app.py."""
+
+    def __init__(self):
+        self._calls = {}
+        self._lock = threading.Lock()
+        self.counters = {"leaders": 0, "coalesced": 0, "not_shared": 0}
+
+    def do(self, key, fetch):
+        """(fetch() result, whether it came from another request's call); errors are shared too."""
+        if key is None:
+            return fetch(), False
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = _Call()
+                self.counters["leaders"] += 1
+            else:
+                self.counters["coalesced"] += 1
+
+        if leader:
+            try:
+                call.result = fetch()
+            except Exception as e:
+                call.error = e
+            finally:
+                with self._lock:
+                    del self._calls[key]
+                call.done.set()
+        else:
+            call.done.wait()
+
+        if call.error is not None:
+            raise call.error
+        return call.result, not leader
+
+    def count_not_shared(self):
+        # A waiter that got a streamed result and made its own call after all
+        with self._lock:
+            self.counters["coalesced"] -= 1
+            self.counters["not_shared"] += 1
+
+    def stats(self):
+        with self._lock:
+            counters = dict(self.counters, in_flight=len(self._calls))
+        requests_ = counters["leaders"] + counters["coalesced"] + counters["not_shared"]
+        counters["coalesced_ratio"] = round(counters["coalesced"] / requests_, 4) if requests_ else 0.0
+        return counters
+
+
+class AsyncSingleFlight(SingleFlight):
+    """Event-loop version, for asgi_app.py.
+
+    The leader's call runs as its own task, so a leader whose client goes
+    away does not cancel it for the others; `discard` then gets its result,
+    which nobody relays.
+    """
+
+    async def do(self, key, fetch, discard=None):
+        if key is None:
+            return await fetch(), False
+        task = self._calls.get(key)
+        leader = task is None
+        if leader:
+            task = self._calls[key] = asyncio.ensure_future(fetch())
+            task.add_done_callback(lambda _: self._calls.pop(key, None))
+            self.counters["leaders"] += 1
+        else:
+            self.counters["coalesced"] += 1
+        try:
+            return await asyncio.shield(task), not leader
+        except asyncio.CancelledError:
+            if leader and discard is not None:
+                task.add_done_callback(lambda t: t.cancelled() or t.exception() or discard(t.result()))
+            raise
@@ -5,7 +5,10 @@ import bcrypt
 import jwt
 import datetime
 from functools import wraps
+import hashlib
+import hmac
 import re
+import time
 
 app = Flask(__name__)
 debug_mode = os.environ.get('FLASK_DEBUG', 'False').lower() == 'true'
@@ -47,25 +50,46 @@ with app.app_context():
 
 # --- FUNCTIONS HELPER ---
 
+def gateway_identity():
+    """Identity the api-gateway verified (signed X-Auth-* headers), or None."""
+    user_id = request.headers.get('X-Auth-User-Id')
+    username = request.headers.get('X-Auth-Username')
+    expires = request.headers.get('X-Auth-Expires', '')
+    signature = request.headers.get('X-Auth-Signature', '')
+    if not user_id or not username or not expires.isdigit() or int(expires) < time.time():
+        return None
+    message = f"{user_id}\n{username}\n{expires}".encode()
+    expected = hmac.new(app.config['SECRET_KEY'].encode(), message, hashlib.sha256).hexdigest()
+    if not hmac.compare_digest(signature, expected):
+        return None
+    return {"user_id": int(user_id), "username": username}
+
 def token_required(f):
+    """Passes the caller's identity ({"user_id", "username"}) to the view.
+
+    Behind the gateway the identity comes from its signed headers; a direct
+    call still has its token decoded here. Neither needs the database.
+    """
     @wraps(f)
     def decorated(*args, **kwargs):
-        token = None
-        if 'Authorization' in request.headers:
-            auth_header = request.headers['Authorization']
-            if "Bearer " in auth_header:
-                token = auth_header.split(" ")[1]
-        
-        if not token:
-            return jsonify({'message': 'Token is missing!'}), 401
-        
-        try:
-            data = jwt.decode(token, app.config['SECRET_KEY'], algorithms=['HS256'])
-            current_user = User.query.get(data['user_id'])
-        except Exception as e:
-            return jsonify({'message': 'Token is invalid!'}), 401
-            
-        return f(current_user, *args, **kwargs)
+        identity = gateway_identity()
+        if identity is None:
+            token = None
+            if 'Authorization' in request.headers:
+                auth_header = request.headers['Authorization']
+                if "Bearer " in auth_header:
+                    token = auth_header.split(" ")[1]
+
+            if not token:
+                return jsonify({'message': 'Token is missing!'}), 401
+
+            try:
+                data = jwt.decode(token, app.config['SECRET_KEY'], algorithms=['HS256'])
+                identity = {"user_id": data['user_id'], "username": data['username']}
+            except Exception as e:
+                return jsonify({'message': 'Token is invalid!'}), 401
+
+        return f(identity, *args, **kwargs)
     return decorated
 
 def validate_password_complexity(password):
@@ -152,12 +176,18 @@ def validate_token():
 
 @app.route('/auth/me', methods=['GET'])
 @token_required
-def get_me(current_user):
+def get_me(identity):
+    current_user = User.query.get(identity['user_id'])
+    if not current_user:
+        return jsonify({'message': 'User not found'}), 404
     return jsonify(current_user.to_dict()), 200
 
 @app.route('/auth/update', methods=['PUT'])
 @token_required
-def update_user(current_user):
+def update_user(identity):
+    current_user = User.query.get(identity['user_id'])
+    if not current_user:
+        return jsonify({'message': 'User not found'}), 404
     data = request.get_json()
     if 'email' in data and data['email']:
         existing = User.query.filter_by(email=data['email']).first()
@@ -1,7 +1,8 @@
-from flask import Flask, render_template, request, redirect, url_for, session, flash
+from flask import Flask, render_template, request, redirect, url_for, session, flash, Response, stream_with_context
 import requests
 import logging
 import os
+import threading
 from requests.packages.urllib3.exceptions import InsecureRequestWarning
 requests.packages.urllib3.disable_warnings(InsecureRequestWarning)
 
@@ -12,12 +13,21 @@ debug_mode = os.environ.get('FLASK_DEBUG', 'False').lower() == 'true'
 
 API_GATEWAY = "https://api-gateway:5000"
 
+# Relayed event streams are served by gevent workers (see docker-compose.yml),
+# where an open stream costs a greenlet and a socket, not a thread. Past this
+# many per worker the browser gets a 503 and polls instead, so page loads and
+# moves still find a connection. Keep it below gunicorn's --worker-connections.
+SSE_MAX_STREAMS = int(os.environ.get('SSE_MAX_STREAMS', '800'))
+stream_slots = threading.BoundedSemaphore(SSE_MAX_STREAMS)
+
 # --- HELPERS ---
 
-def api_request(method, endpoint, data=None, params=None, token=None):
-    headers = {}
+def api_request(method, endpoint, data=None, params=None, token=None, stream=False, headers=None):
+    headers = dict(headers or {})
     if token:
         headers['Authorization'] = f"Bearer {token}"
+    if stream:
+        headers['Accept'] = 'text/event-stream'
     
     url = f"{API_GATEWAY}{endpoint}"
     
@@ -28,6 +38,7 @@ def api_request(method, endpoint, data=None, params=None, token=None):
             json=data, 
             params=params, 
             headers=headers, 
+            stream=stream,
             verify=False 
         )
         return response
@@ -51,6 +62,45 @@ def enrich_card_with_image(card):
     card['image_file'] = f"{prefix}_{suit_name}.png"
     return card
 
+def relay_event_stream(endpoint, params=None):
+    """Relays an event stream from the gateway to the browser as it arrives."""
+    if not stream_slots.acquire(blocking=False):
+        return {"error": "Too many open streams, poll instead"}, 503
+    resp = api_request("GET", endpoint, params=params, token=session['token'], stream=True)
+    if resp is None or resp.status_code != 200:
+        stream_slots.release()
+        if resp is None:
+            return {"error": "Stream unavailable"}, 503
+        return resp.json(), resp.status_code
+
+    def generate():
+        try:
+            for chunk in resp.iter_content(chunk_size=None):
+                yield chunk
+        finally:
+            resp.close()
+
+    relayed = Response(stream_with_context(generate()), mimetype='text/event-stream',
+                       headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+    relayed.call_on_close(stream_slots.release)
+    return relayed
+
+# Conditional GET validators relayed between the browser and the gateway
+VALIDATOR_HEADERS = ('ETag', 'Cache-Control')
+
+def conditional_headers():
+    inm = request.headers.get('If-None-Match')
+    return {'If-None-Match': inm} if inm else None
+
+def relay_conditional(resp):
+    """JSON response (or bare 304) carrying the upstream validators."""
+    if resp is None:
+        return {"error": "Service unavailable"}, 503
+    relay_headers = {k: resp.headers[k] for k in VALIDATOR_HEADERS if k in resp.headers}
+    if resp.status_code == 304:
+        return Response(status=304, headers=relay_headers)
+    return resp.json(), resp.status_code, relay_headers
+
 def send_heartbeat():
     if 'username' in session:
         api_request("POST", f"/players/{session['username']}/heartbeat", token=session.get('token'))
@@ -334,8 +384,18 @@ def surrender(match_id):
 @app.route('/api/proxy/match/<match_id>')
 def proxy_match_state(match_id):
     if 'token' not in session: return {"error": "Unauthorized"}, 401
-    resp = api_request("GET", f"/matches/{match_id}", params={"player": session['username']}, token=session['token'])
-    return resp.json(), resp.status_code
+    params = {"player": session['username']}
+    # The polling fallback of the game page asks for the new reactions too
+    if 'reactions_after' in request.args:
+        params['reactions_after'] = request.args['reactions_after']
+    resp = api_request("GET", f"/matches/{match_id}", params=params,
+                       token=session['token'], headers=conditional_headers())
+    return relay_conditional(resp)
+
+@app.route('/api/proxy/match/<match_id>/stream')
+def proxy_match_stream(match_id):
+    if 'token' not in session: return {"error": "Unauthorized"}, 401
+    return relay_event_stream(f"/matches/{match_id}/stream", params={"player": session['username']})
 
 @app.route('/api/proxy/play/<match_id>', methods=['POST'])
 def proxy_play(match_id):
@@ -376,6 +436,18 @@ def proxy_matchmaking_status():
     resp = api_request("GET", f"/matchmaking/status/{session['username']}", token=session['token'])
     return resp.json(), resp.status_code
 
+@app.route('/api/proxy/matchmaking/retry', methods=['POST'])
+def proxy_matchmaking_retry():
+    if 'token' not in session: return {"error": "Unauthorized"}, 401
+    resp = api_request("POST", "/matchmaking/retry", data={"player": session['username']}, token=session['token'])
+    if resp is None: return {"error": "Service unavailable"}, 503
+    return resp.json(), resp.status_code
+
+@app.route('/api/proxy/matchmaking/stream')
+def proxy_matchmaking_stream():
+    if 'token' not in session: return {"error": "Unauthorized"}, 401
+    return relay_event_stream(f"/matchmaking/stream/{session['username']}")
+
 @app.route('/matchmaking/cancel', methods=['POST'])
 def matchmaking_cancel():
     if 'token' not in session: return redirect(url_for('index'))
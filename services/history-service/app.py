@@ -1,5 +1,6 @@
 from flask import Flask, jsonify, request
 from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy import text
 from datetime import datetime
 import os
 import json
@@ -26,6 +27,7 @@ class MatchRecord(db.Model):
     winner = db.Column(db.String(50), nullable=True)
     final_score = db.Column(db.String(200)) # JSON string
     match_log = db.Column(db.Text) # JSON string
+    move_log = db.Column(db.Text) # JSON string, events of the match (see replay_moves)
 
     def to_dict(self):
         """Versione sintetica per la lista"""
@@ -51,10 +53,83 @@ class MatchRecord(db.Model):
             base["log"] = json.loads(self.match_log) if self.match_log else {}
         except:
             base["log"] = {}
+        base["moves"] = self.moves()
         return base
 
+    def moves(self):
+        try:
+            return json.loads(self.move_log) if self.move_log else []
+        except ValueError:
+            return []
+
+def record_from(data):
+    return MatchRecord(
+        id=data['match_id'],
+        player1=data['player1'],
+        player2=data['player2'],
+        winner=data.get('winner'),
+        final_score=json.dumps(data.get('score', {})),
+        match_log=json.dumps(data.get('log', [])),
+        move_log=json.dumps(data['moves']) if data.get('moves') else None
+    )
+
 with app.app_context():
     db.create_all()
+    # create_all does not add columns to a table that already exists
+    db.session.execute(text("ALTER TABLE match_history ADD COLUMN IF NOT EXISTS move_log TEXT"))
+    db.session.commit()
+
+# --- REPLAY ---
+# The move log written by match-service is a list of self-contained events
+# (see services/match-service/game_rules.py), so a state is rebuilt by
+# folding them in order, without the game rules.
+
+def replay_moves(moves, step=None):
+    """State of the match after the first `step` events (all of them by default)."""
+    if not moves or moves[0][0] != "start":
+        return None
+    _, player1, player2, hand1, hand2, table = moves[0]
+    names = [player1, player2]
+    hands = [set(hand1), set(hand2)]
+    captured = [set(), set()]
+    escobas = [0, 0]
+    table = set(table)
+    turn = 0
+    last_capture_by = None
+    surrendered = None
+
+    for event in moves[1:step]:
+        kind = event[0]
+        if kind == "play":
+            _, seat, card, taken, escoba = event
+            hands[seat].discard(card)
+            if taken:
+                table.difference_update(taken)
+                captured[seat].update(taken)
+                captured[seat].add(card)
+                last_capture_by = seat
+            else:
+                table.add(card)
+            escobas[seat] += escoba
+            turn = 1 - seat
+        elif kind == "deal":
+            hands = [set(event[1]), set(event[2])]
+        elif kind == "sweep":
+            captured[event[1]].update(event[2])
+            table.clear()
+        elif kind == "surrender":
+            surrendered = names[event[1]]
+
+    return {
+        "players": {
+            names[i]: {"hand": sorted(hands[i]), "captured": sorted(captured[i]), "escobas": escobas[i]}
+            for i in range(2)
+        },
+        "table": sorted(table),
+        "turn": names[turn],
+        "last_capture_by": names[last_capture_by] if last_capture_by is not None else None,
+        "surrendered": surrendered
+    }
 
 # --- ENDPOINTS ---
 
@@ -72,14 +147,7 @@ def save_match():
     if MatchRecord.query.get(data['match_id']):
         return jsonify({"message": "Match already saved"}), 200
 
-    new_record = MatchRecord(
-        id=data['match_id'],
-        player1=data['player1'],
-        player2=data['player2'],
-        winner=data.get('winner'),
-        final_score=json.dumps(data.get('score', {})),
-        match_log=json.dumps(data.get('log', []))
-    )
+    new_record = record_from(data)
     
     try:
         db.session.add(new_record)
@@ -89,6 +157,29 @@ def save_match():
         db.session.rollback()
         return jsonify({"error": str(e)}), 500
 
+@app.route('/history/matches/batch', methods=['POST'])
+def save_matches_batch():
+    """Archives several finished matches in one transaction (used by the match outbox)."""
+    data = request.get_json()
+    if not isinstance(data, list) or not all(isinstance(d, dict) and 'match_id' in d for d in data):
+        return jsonify({"error": "Invalid data"}), 400
+
+    ids = {d['match_id'] for d in data}
+    existing = {m.id for m in MatchRecord.query.filter(MatchRecord.id.in_(ids)).all()} if ids else set()
+    saved = 0
+    for d in data:
+        if d['match_id'] in existing: continue
+        existing.add(d['match_id'])
+        db.session.add(record_from(d))
+        saved += 1
+
+    try:
+        db.session.commit()
+        return jsonify({"message": "Matches archived", "saved": saved, "duplicates": len(data) - saved}), 200
+    except Exception as e:
+        db.session.rollback()
+        return jsonify({"error": str(e)}), 500
+
 @app.route('/history/<username>', methods=['GET'])
 def get_user_history(username):
     matches = MatchRecord.query.filter(
@@ -106,5 +197,27 @@ def get_match_details(match_id):
     
     return jsonify(match.to_full_dict()), 200
 
+@app.route('/history/match/<match_id>/replay', methods=['GET'])
+def replay_match(match_id):
+    """State of an archived match after `step` events (default: the end)."""
+    match = MatchRecord.query.get(match_id)
+    if not match:
+        return jsonify({"error": "Match not found"}), 404
+    moves = match.moves()
+    if not moves:
+        return jsonify({"error": "No move log for this match"}), 404
+
+    step = request.args.get('step', default=len(moves), type=int)
+    if step < 1 or step > len(moves):
+        return jsonify({"error": f"step must be between 1 and {len(moves)}"}), 400
+
+    return jsonify({
+        "match_id": match_id,
+        "step": step,
+        "total_steps": len(moves),
+        "event": moves[step - 1],
+        "state": replay_moves(moves, step)
+    }), 200
+
 if __name__ == '__main__':
     app.run(debug=debug_mode, host='0.0.0.0', port=5000)
\ No newline at end of file
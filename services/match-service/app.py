@@ -1,12 +1,26 @@
-from flask import Flask, jsonify, request
+from flask import Flask, jsonify, request, Response, stream_with_context
 import redis
 import json
-import uuid
-import random
 import os
-import itertools
+import threading
+import time
 import requests
-import datetime
+from atomic_moves import MoveCommitter, MOVE_MAX_ATTEMPTS, DEADLINES_KEY
+from matchmaking import Matchmaker, PENDING, matchmaking_channel
+from match_state import MatchState, load_record, peek_version
+from game_rules import deal_new_match
+from match_views import (
+    MATCH_TTL, INVITE_TTL, SSE_HEARTBEAT, SSE_MAX_SECONDS, SSE_MAX_STREAMS, MATCHMAKING_RETRY_SECONDS,
+    REACTIONS_MAXLEN, MEMORY_SAMPLE_KEYS,
+    match_key, active_index_key, received_index_key, sent_index_key, match_channel, reactions_key,
+    index_add, unindex_invite, queue_new_match, finalize_event, match_view, batch_views, pending_lists,
+    parse_match_ids, reaction_entry, sse_message, tally_memory, memory_report, memory_sample_size,
+    timer_report, reactions_limit, reactions_body, players_error, new_invite, invite_answer_error,
+    batch_ids_error, reaction_error, reactor_error, play_card_move, surrender_move, timeout_move
+)
+from turn_timer import TIMER_STATS_KEY, overdue_metrics
+from sharded_store import ShardedStore
+from hot_cache import HotMatchCache
 from requests.packages.urllib3.exceptions import InsecureRequestWarning
 
 requests.packages.urllib3.disable_warnings(InsecureRequestWarning)
@@ -15,300 +29,208 @@ app = Flask(__name__)
 debug_mode = os.environ.get('FLASK_DEBUG', 'False').lower() == 'true'
 
 redis_host = os.environ.get('REDIS_HOST', 'redis')
+# Main node: user indexes, matchmaking, worker stats
 r = redis.Redis(host=redis_host, port=6379, db=0, decode_responses=True)
-
-HISTORY_SERVICE_URL = "https://history-service:5000/history/matches"
-PLAYER_SERVICE_URL = "https://player-service:5000/players"
-
-MATCHMAKING_QUEUE_KEY = "matchmaking_queue"
+# Match states (binary codec in match_state.py) and every per-match key live
+# on the shard the match id hashes to, over REDIS_NODES (sharded_store.py)
+store = ShardedStore()
+moves = MoveCommitter(store)
+# Decoded states for GET /matches/<id>, invalidated through the match channels
+hot_cache = HotMatchCache(store)
+matchmaker = Matchmaker(r)
+# Open event streams of this worker, see SSE_MAX_STREAMS
+stream_slots = threading.BoundedSemaphore(SSE_MAX_STREAMS)
 
 # Per comunicazioni interne sicure (se necessario validare i cert)
 CERT_FILE = '/app/certs/cert.pem'
 
-# --- UTILS CARTE ---
-def get_initial_deck():
-    return list(range(1, 41))
-
-def get_card_value(card_id):
-    val = (card_id - 1) % 10 + 1
-    return val
-
-def is_oros(card_id):
-    return 1 <= card_id <= 10
-
-def is_settebello(card_id):
-    return card_id == 7
-
-def find_capture_combination(played_card_id, table_ids):
-    played_val = get_card_value(played_card_id)
-    target = 15 - played_val
-    if target <= 0: return []
-    
-    table_map = {cid: get_card_value(cid) for cid in table_ids}
-    valid_combinations = []
-    
-    for L in range(1, len(table_ids) + 1):
-        for subset in itertools.combinations(table_ids, L):
-            current_sum = sum(table_map[c] for c in subset)
-            if current_sum == target:
-                valid_combinations.append(list(subset))
-    
-    if not valid_combinations: return []
-    valid_combinations.sort(key=len, reverse=True)
-    return valid_combinations[0]
-
-def calculate_scores(state):
-    scores = {}
-    details = {}
-    if 'players' not in state: return {}, {}
-
-    for player, data in state['players'].items():
-        points = 0
-        captured = data['captured']
-        score_log = []
-
-        escobas = data['score_events'].count("ESCOBA")
-        points += escobas
-        if escobas > 0: score_log.append(f"{escobas} Escoba(s)")
-
-        if len(captured) > 20:
-            points += 1
-            score_log.append("Most Cards")
-        
-        oros_count = sum(1 for c in captured if is_oros(c))
-        if oros_count > 5:
-            points += 1
-            score_log.append("Most Coins")
-
-        if any(is_settebello(c) for c in captured):
-            points += 1
-            score_log.append("Settebello")
-            
-        scores[player] = points
-        details[player] = score_log
-    return scores, details
-
-def finalize_match(state, surrender_winner=None):
-    winner = None
-    final_scores = {}
-    score_details = {}
-
-    if surrender_winner:
-        winner = surrender_winner
-        p1, p2 = list(state['players'].keys())
-        final_scores = {p1: 0, p2: 0}
-        score_details = {winner: ["Opponent Surrendered"]}
-    else:
-        last_capturer = state.get('last_capture_by')
-        if last_capturer and state['table']:
-            state['players'][last_capturer]['captured'].extend(state['table'])
-            state['table'] = []
-
-        final_scores, score_details = calculate_scores(state)
-        p1, p2 = list(final_scores.keys())
-        if final_scores[p1] > final_scores[p2]: winner = p1
-        elif final_scores[p2] > final_scores[p1]: winner = p2
-        else: winner = "Draw"
-
-    try:
-        players_list = list(state['players'].keys())
-        history_payload = {
-            "match_id": state['match_id'],
-            "player1": players_list[0],
-            "player2": players_list[1],
-            "winner": winner if winner != "Draw" else None,
-            "score": final_scores,
-            "log": score_details
-        }
-        requests.post(HISTORY_SERVICE_URL, json=history_payload, timeout=2, verify=False)
-    except Exception as e:
-        print(f"Error contacting History Service: {e}")
-
-    for p in state['players'].keys():
-        if p == "CPU" or p == "Guest": continue
-        try:
-            is_winner = (p == winner)
-            points = final_scores.get(p, 0)
-            stats_payload = {"won": is_winner, "score_delta": points}
-            requests.put(f"{PLAYER_SERVICE_URL}/{p}/stats", json=stats_payload, timeout=2, verify=False)
-        except Exception as e:
-            print(f"Error contacting Player Service for {p}: {e}")
-
-    return {
-        "status": "finished",
-        "winner": winner,
-        "final_scores": final_scores,
-        "details": score_details
-    }
-
-def execute_cpu_turn(state):
-    cpu_hand = state['players']['CPU']['hand']
-    table = state['table']
-    move_card = None
-    captured = []
-    
-    for card in cpu_hand:
-        combo = find_capture_combination(card, table)
-        if combo:
-            move_card = card
-            captured = combo
-            break
-    
-    if not move_card:
-        cpu_hand.sort(key=get_card_value)
-        move_card = cpu_hand[0]
-        captured = []
-
-    state['players']['CPU']['hand'].remove(move_card)
-    
-    if captured:
-        for c in captured: state['table'].remove(c)
-        state['players']['CPU']['captured'].extend(captured + [move_card])
-        state['last_capture_by'] = "CPU"
-        if not state['table']:
-            state['players']['CPU']['score_events'].append("ESCOBA")
-    else:
-        state['table'].append(move_card)
-        
-    return state
-
-def handle_turn_change(state):
-    players_list = list(state['players'].keys())
-    current_turn = state['turn']
-    idx = players_list.index(current_turn)
-    next_player = players_list[(idx + 1) % 2]
-    
-    p1 = players_list[0]
-    p2 = players_list[1]
-    
-    p1_empty = len(state['players'][p1]['hand']) == 0
-    p2_empty = len(state['players'][p2]['hand']) == 0
-    
-    message = "Turn changed"
-    finished = False
-    
-    if p1_empty and p2_empty:
-        if len(state['deck']) > 0:
-            deal_count = 3
-            if len(state['deck']) < 6: deal_count = len(state['deck']) // 2
-            
-            for _ in range(deal_count):
-                state['players'][p1]['hand'].append(state['deck'].pop())
-                state['players'][p2]['hand'].append(state['deck'].pop())
-            message = "New hand dealt"
-            state['turn'] = next_player
-        else:
-            final_result = finalize_match(state)
-            state['status'] = 'finished'
-            state['result'] = final_result
-            message = "Match finished"
-            state['turn'] = None
-            finished = True
-    else:
-        state['turn'] = next_player
-        state['turn_start_time'] = datetime.datetime.utcnow().isoformat()
-        
-    return state, message, finished
-
 def start_real_match(player1, player2):
-    match_id = str(uuid.uuid4())
-    deck = get_initial_deck()
-    random.shuffle(deck)
-    p1_hand = [deck.pop() for _ in range(3)]
-    p2_hand = [deck.pop() for _ in range(3)]
-    table = [deck.pop() for _ in range(4)]
-
-    match_state = {
-        "match_id": match_id,
-        "players": {
-            player1: {"hand": p1_hand, "captured": [], "score_events": []},
-            player2: {"hand": p2_hand, "captured": [], "score_events": []}
-        },
-        "table": table,
-        "deck": deck,
-        "turn": player1,
-        "status": "active",
-        "last_capture_by": None,
-        "turn_start_time": datetime.datetime.utcnow().isoformat()
-    }
-    r.setex(f"match:{match_id}", 7200, json.dumps(match_state))
+    match_state = deal_new_match(player1, player2)
+    match_id = match_state.match_id
+    with store.pipeline(match_id) as pipe:
+        queue_new_match(pipe, match_state)
+        pipe.execute()
+    with r.pipeline() as pipe:
+        for player in (player1, player2):
+            index_add(pipe, player, active_index_key(player), match_id)
+        pipe.execute()
     return match_id
 
+# --- REDIS HELPERS ---
+
+def load_match(match_id):
+    """MatchState for games, plain dict for pending invites, None if missing."""
+    raw = store.client(match_id).get(match_key(match_id))
+    return load_record(raw) if raw else None
+
+def load_matches(match_ids):
+    """load_match for many ids: one MGET per shard, results in input order."""
+    return [load_record(raw) if raw else None for raw in store.mget(match_ids, match_key)]
+
+def commit_move(key, expected, state):
+    """CAS commit of a move (see atomic_moves.py). A finished match also
+    queues its outbox event and leaves the players' active indexes."""
+    if state.status != 'finished':
+        return moves.commit(key, expected, state, MATCH_TTL)
+    if not moves.commit(key, expected, state, MATCH_TTL, finalize_event(state)):
+        return False
+    # The indexes live on the main node, outside the match's shard; an id
+    # left behind is skipped by /matches/pending and dropped when it expires
+    with r.pipeline() as pipe:
+        for name in state.names():
+            pipe.srem(active_index_key(name), state.match_id)
+        pipe.execute()
+    return True
+
+def read_reactions(match_id, after, limit):
+    """Body of GET /matches/<id>/reactions: the reactions after `after`, else the latest `limit`."""
+    client = store.client(match_id)
+    if after:
+        entries = client.xrange(reactions_key(match_id), min=f"({after}", count=limit)
+    else:
+        entries = client.xrevrange(reactions_key(match_id), count=limit)[::-1]
+    return reactions_body(entries, after)
+
+def publish_match_event(match_id, event):
+    """Notifies stream subscribers of a match (state changes and reactions)."""
+    if event['type'] != 'reaction':
+        # The other workers drop their copy when the message arrives; this one
+        # does it now, so its next read already sees the write
+        hot_cache.invalidate(match_id)
+    store.client(match_id).publish(match_channel(match_id), json.dumps(event))
+
+def run_move(match_id, move, *args):
+    """Applies a match_views move to the stored match and commits it.
+
+    Optimistic concurrency: the move is computed locally and committed by a
+    Lua compare-and-set, retried a bounded number of times with backoff.
+    """
+    key = match_key(match_id)
+    client = store.client(match_id)
+    for attempt in range(MOVE_MAX_ATTEMPTS):
+        if attempt:
+            moves.backoff(attempt - 1)
+        raw = client.get(key)
+        outcome = move(load_record(raw) if raw else None, *args)
+        if outcome.state is None:
+            if outcome.deadline is None:
+                client.zrem(DEADLINES_KEY, match_id)
+            elif outcome.deadline is not False:
+                client.zadd(DEADLINES_KEY, {match_id: outcome.deadline})
+            return jsonify(outcome.body), outcome.status
+        if commit_move(key, raw, outcome.state):
+            publish_match_event(match_id, {"type": "state"})
+            return jsonify(outcome.body), outcome.status
+
+    moves.record_exhausted(match_id)
+    return jsonify({"error": "Match is busy, try again"}), 409
+
+def sse_response(generator, pubsub):
+    """Streams `generator`, or answers 503 when SSE_MAX_STREAMS streams are already open."""
+    if not stream_slots.acquire(blocking=False):
+        pubsub.close()
+        return jsonify({"error": "Too many open streams, poll instead"}), 503
+    resp = Response(stream_with_context(generator), mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+    resp.call_on_close(stream_slots.release)
+    return resp
+
 # --- ENDPOINTS ---
 
 @app.route('/matches/health', methods=['GET'])
 def health():
     try:
         r.ping()
+        for client in store.clients.values():
+            client.ping()
         db_status = "connected"
     except redis.ConnectionError:
         db_status = "disconnected"
     return jsonify({"status": "healthy", "service": "match-service", "redis": db_status}), 200
 
+@app.route('/matches/admin/moves', methods=['GET'])
+def move_stats():
+    return jsonify(moves.stats()), 200
+
+@app.route('/matches/admin/cache', methods=['GET'])
+def cache_stats():
+    """Hot match cache counters of the worker process that answers."""
+    return jsonify(hot_cache.stats()), 200
+
+def sample_memory(client, limit):
+    """(dbsize, used_memory, {pattern: [keys, bytes]}) of a node over up to `limit` sampled keys."""
+    keys = []
+    for key in client.scan_iter(count=500):
+        keys.append(key.decode() if isinstance(key, bytes) else key)
+        if len(keys) >= limit:
+            break
+    with client.pipeline(transaction=False) as pipe:
+        for key in keys:
+            pipe.memory_usage(key)
+        sizes = pipe.execute()
+    return client.dbsize(), client.info('memory')['used_memory'], tally_memory(keys, sizes)
+
+@app.route('/matches/admin/memory', methods=['GET'])
+def memory_stats():
+    """Redis memory per key pattern on every node, estimated from a MEMORY USAGE sample."""
+    limit = memory_sample_size(request.args.get('sample', default=MEMORY_SAMPLE_KEYS, type=int))
+    nodes = dict(store.clients)
+    main_node = f"{redis_host}:6379"
+    if main_node not in nodes:
+        nodes[main_node] = r
+    return jsonify(memory_report({node: sample_memory(client, limit) for node, client in nodes.items()})), 200
+
+@app.route('/matches/admin/timers', methods=['GET'])
+def timer_stats():
+    """Turn deadlines per shard: scheduled/overdue right now plus the timer worker's counters."""
+    shards = {}
+    for node, client in store.clients.items():
+        worker = {k.decode(): int(v) for k, v in client.hgetall(TIMER_STATS_KEY).items()}
+        shards[node] = {"now": overdue_metrics(client), "worker": worker}
+    return jsonify(timer_report(shards)), 200
+
 @app.route('/matches/pending/<username>', methods=['GET'])
 def get_pending_matches(username):
-    active_matches = []
-    invites_received = []
-    invites_sent = []
-    
-    for key in r.scan_iter("match:*"):
-        try:
-            state_json = r.get(key)
-            if not state_json: continue
-            state = json.loads(state_json)
-            status = state.get('status')
-            
-            if status == 'active' and username in state.get('players', {}):
-                players = list(state['players'].keys())
-                opponent = players[1] if players[0] == username else players[0]
-                current_scores, _ = calculate_scores(state)
-                active_matches.append({
-                    "match_id": state['match_id'],
-                    "opponent": opponent,
-                    "turn": state['turn'],
-                    "scores": current_scores
-                })
-            elif status == 'pending' and state.get('player2') == username:
-                invites_received.append({
-                    "match_id": state['match_id'],
-                    "challenger": state['player1']
-                })
-            elif status == 'pending' and state.get('player1') == username:
-                invites_sent.append({
-                    "match_id": state['match_id'],
-                    "opponent": state['player2']
-                })
-        except Exception as e:
-            print(f"Error reading match {key}: {e}")
-            
-    return jsonify({
-        "active": active_matches,
-        "invites_received": invites_received,
-        "invites_sent": invites_sent
-    }), 200
+    index_keys = [active_index_key(username), received_index_key(username), sent_index_key(username)]
+    match_ids = list(r.sunion(index_keys))
+    records = store.mget(match_ids, match_key)
+    body, expired = pending_lists(username, match_ids, records)
+
+    # Matches that expired through their TTL are dropped lazily from the index
+    if expired:
+        with r.pipeline() as pipe:
+            for index_key in index_keys:
+                pipe.srem(index_key, *expired)
+            pipe.execute()
+    return jsonify(body), 200
 
 @app.route('/invites', methods=['POST'])
 def create_invite():
     data = request.get_json()
     player1 = data.get('player1')
     player2 = data.get('player2')
-    if not player1 or not player2: return jsonify({"error": "Two players required"}), 400
-    match_id = str(uuid.uuid4())
-    invite_state = {"match_id": match_id, "player1": player1, "player2": player2, "status": "pending"}
-    r.setex(f"match:{match_id}", 86400, json.dumps(invite_state))
+    error = players_error(player1, player2)
+    if error: return jsonify(error[0]), error[1]
+    invite_state = new_invite(player1, player2)
+    match_id = invite_state['match_id']
+    store.client(match_id).setex(match_key(match_id), INVITE_TTL, json.dumps(invite_state))
+    with r.pipeline() as pipe:
+        index_add(pipe, player1, sent_index_key(player1), match_id)
+        index_add(pipe, player2, received_index_key(player2), match_id)
+        pipe.execute()
     return jsonify({"match_id": match_id, "message": "Invite sent"}), 201
 
 @app.route('/invites/<match_id>/accept', methods=['POST'])
 def accept_invite(match_id):
     data = request.get_json()
-    player_accepting = data.get('player')
-    state_json = r.get(f"match:{match_id}")
-    if not state_json: return jsonify({"error": "Invite not found"}), 404
-    state = json.loads(state_json)
-    if state['status'] != 'pending': return jsonify({"error": "Match already active"}), 400
-    if state['player2'] != player_accepting: return jsonify({"error": "Not authorized"}), 403
-
-    r.delete(f"match:{match_id}")
+    state = load_match(match_id)
+    error = invite_answer_error(state, data.get('player'), accepting=True)
+    if error: return jsonify(error[0]), error[1]
+
+    store.client(match_id).delete(match_key(match_id))
+    with r.pipeline() as pipe:
+        unindex_invite(pipe, state)
+        pipe.execute()
     new_match_id = start_real_match(state['player1'], state['player2'])
     
     return jsonify({"match_id": new_match_id, "message": "Match accepted"}), 200
@@ -316,45 +238,94 @@ def accept_invite(match_id):
 @app.route('/invites/<match_id>/reject', methods=['POST'])
 def reject_invite(match_id):
     data = request.get_json()
-    player_rejecting = data.get('player')
-    state_json = r.get(f"match:{match_id}")
-    if not state_json: return jsonify({"error": "Invite not found"}), 404
-    state = json.loads(state_json)
-    if state['player2'] != player_rejecting and state['player1'] != player_rejecting:
-        return jsonify({"error": "Not authorized"}), 403
-    r.delete(f"match:{match_id}")
+    state = load_match(match_id)
+    error = invite_answer_error(state, data.get('player'), accepting=False)
+    if error: return jsonify(error[0]), error[1]
+    store.client(match_id).delete(match_key(match_id))
+    with r.pipeline() as pipe:
+        unindex_invite(pipe, state)
+        pipe.execute()
     return jsonify({"message": "Invite rejected"}), 200
 
+def pair_or_queue(player, bucket, queued_only=False):
+    """Tries to pair a player; creates the match when an opponent is found.
+
+    If the match cannot be created, both players go back in the queue as they
+    were instead of staying "pending" until their result key expires.
+    """
+    pairing = matchmaker.try_pair(player, bucket, queued_only)
+    if not pairing: return None, None
+    try:
+        match_id = start_real_match(pairing.opponent, player)
+    except redis.RedisError as e:
+        print(f"Could not start the match of {pairing.opponent} and {player}: {e}")
+        matchmaker.requeue(pairing.entries)
+        return None, None
+    matchmaker.record_match(pairing.opponent, player, match_id)
+    return match_id, pairing.opponent
+
 @app.route('/matchmaking/join', methods=['POST'])
 def join_matchmaking():
     data = request.get_json()
     player = data.get('player')
-    opponent = r.lpop(MATCHMAKING_QUEUE_KEY)
+    if not player: return jsonify({"error": "Player required"}), 400
     
-    if opponent and opponent != player:
-        match_id = start_real_match(opponent, player)
-        r.setex(f"matchmaking:user:{opponent}", 60, match_id)
-        r.setex(f"matchmaking:user:{player}", 60, match_id)
+    matchmaker.clear_result(player)
+    match_id, opponent = pair_or_queue(player, matchmaker.rating_bucket(player))
+    
+    if match_id:
         return jsonify({"status": "matched", "match_id": match_id, "opponent": opponent}), 200
-    else:
-        r.lrem(MATCHMAKING_QUEUE_KEY, 0, player)
-        r.rpush(MATCHMAKING_QUEUE_KEY, player)
-        r.delete(f"matchmaking:user:{player}")
-        return jsonify({"status": "waiting"}), 200
+    return jsonify({"status": "waiting"}), 200
+
+def matchmaking_state(username):
+    """Status of a player's search, read from the result key and the queue (never pairs)."""
+    match_id = matchmaker.result(username)
+    if match_id == PENDING: return {"status": "waiting"}
+    if match_id: return {"status": "matched", "match_id": match_id}
+    if matchmaker.queued_bucket(username) is None: return {"status": "none"}
+    return {"status": "waiting"}
 
 @app.route('/matchmaking/status/<username>', methods=['GET'])
 def matchmaking_status(username):
-    match_id = r.get(f"matchmaking:user:{username}")
-    if match_id: return jsonify({"status": "matched", "match_id": match_id}), 200
-    queue = r.lrange(MATCHMAKING_QUEUE_KEY, 0, -1)
-    if username in queue: return jsonify({"status": "waiting"}), 200
-    return jsonify({"status": "none"}), 200
+    return jsonify(matchmaking_state(username)), 200
+
+@app.route('/matchmaking/retry', methods=['POST'])
+def retry_matchmaking():
+    """Retries the pairing of a waiting player, with the range widened by the time waited."""
+    data = request.get_json()
+    player = data.get('player')
+    if not player: return jsonify({"error": "Player required"}), 400
+    bucket = matchmaker.queued_bucket(player)
+    if bucket is not None:
+        pair_or_queue(player, bucket, queued_only=True)
+    return jsonify(matchmaking_state(player)), 200
+
+@app.route('/matchmaking/stream/<username>', methods=['GET'])
+def stream_matchmaking(username):
+    """Pushes the matchmaking status once it changes from "waiting"."""
+    pubsub = r.pubsub(ignore_subscribe_messages=True)
+    pubsub.subscribe(matchmaking_channel(username))
+
+    def generate():
+        deadline = time.monotonic() + SSE_MAX_SECONDS
+        try:
+            while time.monotonic() < deadline:
+                state = matchmaking_state(username)
+                yield sse_message("status", state)
+                if state['status'] != 'waiting':
+                    return
+                # Wakes up on a pairing notification, or to read the status again
+                pubsub.get_message(timeout=MATCHMAKING_RETRY_SECONDS)
+        finally:
+            pubsub.close()
+
+    return sse_response(generate(), pubsub)
 
 @app.route('/matchmaking/leave', methods=['POST'])
 def leave_matchmaking():
     data = request.get_json()
     player = data.get('player')
-    r.lrem(MATCHMAKING_QUEUE_KEY, 0, player)
+    matchmaker.leave(player)
     return jsonify({"message": "Left queue"}), 200
 
 @app.route('/matches', methods=['POST'])
@@ -362,154 +333,145 @@ def create_match():
     data = request.get_json()
     player1 = data.get('player1')
     player2 = data.get('player2')
-    
-    # --- FIX VALIDAZIONE ---
-    if not player1 or not player2:
-        return jsonify({"error": "Two players required"}), 400
-    # -----------------------
+    error = players_error(player1, player2)
+    if error: return jsonify(error[0]), error[1]
 
     match_id = start_real_match(player1, player2)
     return jsonify({"match_id": match_id, "message": "Match created", "turn": player1}), 201
 
+@app.route('/matches', methods=['GET'])
+def get_matches():
+    """Many matches in one round trip: ?ids=a,b,c (same views as GET /matches/<id>)."""
+    match_ids = parse_match_ids(request.args.get('ids'))
+    error = batch_ids_error(match_ids)
+    if error: return jsonify(error[0]), error[1]
+    return jsonify(batch_views(match_ids, load_matches(match_ids), request.args.get('player'))), 200
+
 @app.route('/matches/<match_id>', methods=['GET'])
 def get_match(match_id):
-    state_json = r.get(f"match:{match_id}")
-    if not state_json: return jsonify({"error": "Match not found"}), 404
-    state = json.loads(state_json)
-    if state.get('status') == 'pending': return jsonify(state), 200
-    if state['status'] == 'finished': return jsonify(state), 200
-    
-    requesting_player = request.args.get('player')
-    players = state['players']
-    
-    # Se è partita locale (Guest), NON nascondere le carte
-    is_local_game = "Guest" in players
-    
-    if not requesting_player and not is_local_game: return jsonify(state), 200
-    if requesting_player and requesting_player not in players and not is_local_game:
-        return jsonify({"error": "Player not in this match"}), 403
-
-    sanitized_state = state.copy()
-    sanitized_state['cards_remaining'] = len(state['deck'])
-    current_scores, _ = calculate_scores(state)
-    sanitized_state['current_scores'] = current_scores
-
-    if not is_local_game:
-        for p_name in players:
-            if p_name != requesting_player:
-                sanitized_state['players'][p_name]['hand'] = ["hidden"] * len(players[p_name]['hand'])
-                sanitized_state.pop('deck', None)
+    # ?reactions_after=<id> (the polling fallback of the game page) adds the
+    # reactions newer than id, so one request polls both; empty, only the
+    # latest one, to start from
+    after = request.args.get('reactions_after')
+    reactions = None
+    if after is not None:
+        try:
+            reactions = read_reactions(match_id, after or None, REACTIONS_MAXLEN if after else 1)
+        except redis.ResponseError:
+            return jsonify({"error": "Invalid reaction id"}), 400
 
-    return jsonify(sanitized_state), 200
+    if hot_cache.enabled:
+        record = hot_cache.get(match_id, lambda: load_match(match_id))
+        version = record.version if isinstance(record, MatchState) else None
+    else:
+        raw = store.client(match_id).get(match_key(match_id))
+        version = peek_version(raw) if raw else None
+        record = None
+    etag = str(version) if version is not None else None
+
+    # The client's copy is still current: answer without building the view
+    # (and, without the cache, from the record header alone)
+    if etag and request.if_none_match.contains(etag) and not (reactions and reactions['reactions']):
+        resp = Response(status=304)
+        resp.set_etag(etag)
+        return resp
+
+    if not hot_cache.enabled:
+        record = load_record(raw) if raw else None
+    body, status = match_view(record, request.args.get('player'))
+    if reactions is not None and status == 200:
+        body = dict(body, reactions=reactions)
+    resp = jsonify(body)
+    resp.status_code = status
+    if etag and status == 200:
+        resp.set_etag(etag)
+        resp.headers['Cache-Control'] = 'no-cache'
+    return resp
+
+@app.route('/matches/<match_id>/stream', methods=['GET'])
+def stream_match(match_id):
+    """Pushes the player's view of the match each time it changes, plus reactions."""
+    requesting_player = request.args.get('player')
+    pubsub = store.client(match_id).pubsub(ignore_subscribe_messages=True)
+    # Subscribe before reading the snapshot so no change can slip in between
+    pubsub.subscribe(match_channel(match_id))
+    body, status = match_view(load_match(match_id), requesting_player)
+    if status != 200:
+        pubsub.close()
+        return jsonify(body), status
+
+    def generate(body):
+        deadline = time.monotonic() + SSE_MAX_SECONDS
+        try:
+            yield sse_message("state", body)
+            while body.get('status') == 'active' and time.monotonic() < deadline:
+                message = pubsub.get_message(timeout=SSE_HEARTBEAT)
+                if message is None:
+                    yield ": keep-alive\n\n"
+                    continue
+                event = json.loads(message['data'])
+                if event['type'] == 'reaction':
+                    yield sse_message("reaction", event)
+                    continue
+                body, status = match_view(load_match(match_id), requesting_player)
+                if status != 200:
+                    yield sse_message("gone", body)
+                    return
+                yield sse_message("state", body)
+        finally:
+            pubsub.close()
+
+    return sse_response(generate(body), pubsub)
 
 @app.route('/matches/<match_id>/play', methods=['POST'])
 def play_card(match_id):
     data = request.get_json()
-    player = data.get('player')
-    card_id = data.get('card_id')
-    
-    match_key = f"match:{match_id}"
-    
-    # TRANSAZIONE REDIS PER EVITARE RACE CONDITIONS
-    with r.pipeline() as pipe:
-        while True:
-            try:
-                pipe.watch(match_key)
-                state_json = pipe.get(match_key)
-                
-                if not state_json:
-                    return jsonify({"error": "Match not found"}), 404
-                
-                state = json.loads(state_json)
-                
-                if state['status'] != 'active': return jsonify({"error": "Match finished/pending"}), 400
-                if state['turn'] != player: return jsonify({"error": "Not your turn"}), 400
-                if card_id not in state['players'][player]['hand']: return jsonify({"error": "Card not in hand"}), 400
-
-                captured_cards = find_capture_combination(card_id, state['table'])
-                escoba = False
-                state['players'][player]['hand'].remove(card_id)
-                
-                if captured_cards:
-                    for c in captured_cards: state['table'].remove(c)
-                    state['players'][player]['captured'].extend(captured_cards + [card_id])
-                    state['last_capture_by'] = player
-                    if not state['table']:
-                        escoba = True
-                        state['players'][player]['score_events'].append("ESCOBA")
-                else:
-                    state['table'].append(card_id)
-
-                state, message, finished = handle_turn_change(state)
-                
-                if not finished and state['turn'] == "CPU":
-                    state = execute_cpu_turn(state)
-                    state, cpu_msg, finished = handle_turn_change(state)
-                    message = "CPU played. Your turn."
-
-                pipe.multi()
-                pipe.setex(match_key, 7200, json.dumps(state))
-                pipe.execute()
-                
-                response = {
-                    "message": message, 
-                    "captured": captured_cards,
-                    "escoba": escoba,
-                    "state_snapshot": {"table": state['table'], "your_hand": state['players'][player]['hand']}
-                }
-                if state['status'] == 'finished':
-                    response['final_result'] = state['result']
-                return jsonify(response), 200
-                
-            except redis.WatchError:
-                continue
-            except Exception as e:
-                return jsonify({"error": str(e)}), 500
+    try:
+        return run_move(match_id, play_card_move, data.get('player'), data.get('card_id'))
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
 
 @app.route('/matches/<match_id>/surrender', methods=['POST'])
 def surrender_match(match_id):
     data = request.get_json()
-    player_surrendering = data.get('player')
-    match_key = f"match:{match_id}"
-    
-    state_json = r.get(match_key)
-    if not state_json: return jsonify({"error": "Match not found"}), 404
-    state = json.loads(state_json)
-    
-    if state['status'] != 'active': return jsonify({"error": "Match finished"}), 400
-    
-    players = list(state['players'].keys())
-    winner = players[1] if players[0] == player_surrendering else players[0]
-    
-    final_result = finalize_match(state, surrender_winner=winner)
-    state['status'] = 'finished'
-    state['result'] = final_result
-    
-    r.setex(match_key, 7200, json.dumps(state))
-    return jsonify({"message": "Match surrendered", "winner": winner}), 200
+    return run_move(match_id, surrender_move, data.get('player'))
+
+@app.route('/matches/<match_id>/timeout', methods=['POST'])
+def expire_turn(match_id):
+    """Called by turn_timer.py once the turn deadline passed: auto-plays or forfeits."""
+    return run_move(match_id, timeout_move, time.time())
 
 @app.route('/matches/<match_id>/react', methods=['POST'])
 def post_reaction(match_id):
+    """Appends a reaction (emote or short chat line); the match state is not rewritten."""
     data = request.get_json()
     player = data.get('player')
     reaction = data.get('reaction')
-    match_key = f"match:{match_id}"
-    
-    state_json = r.get(match_key)
-    if not state_json: return jsonify({"error": "Match not found"}), 404
-    state = json.loads(state_json)
-    
-    if state['status'] != 'active': return jsonify({"error": "Match finished/pending"}), 400
-    if player not in state['players']: return jsonify({"error": "Player not in this match"}), 403
-    
-    state['last_reaction'] = {
-        "player": player,
-        "content": reaction,
-        "timestamp": datetime.datetime.utcnow().isoformat()
-    }
-    
-    r.setex(match_key, 7200, json.dumps(state))
-    return jsonify({"message": "Reaction posted"}), 200
+    error = reaction_error(reaction)
+    if error: return jsonify(error[0]), error[1]
+
+    # Read-only check: the hot cache serves it without touching Redis
+    error = reactor_error(hot_cache.get(match_id, lambda: load_match(match_id)), player)
+    if error: return jsonify(error[0]), error[1]
+
+    entry = reaction_entry(player, reaction)
+    key = reactions_key(match_id)
+    with store.pipeline(match_id, transaction=False) as pipe:
+        pipe.xadd(key, entry, maxlen=REACTIONS_MAXLEN, approximate=True)
+        pipe.expire(key, MATCH_TTL)
+        entry_id = pipe.execute()[0].decode()
+    publish_match_event(match_id, {"type": "reaction", "id": entry_id, **entry})
+    return jsonify({"message": "Reaction posted", "id": entry_id}), 200
+
+@app.route('/matches/<match_id>/reactions', methods=['GET'])
+def get_reactions(match_id):
+    """Recent reactions, oldest first; `after` returns only the newer ones."""
+    after = request.args.get('after')
+    limit = reactions_limit(request.args.get('limit', default=REACTIONS_MAXLEN, type=int))
+    try:
+        return jsonify(read_reactions(match_id, after, limit)), 200
+    except redis.ResponseError:
+        return jsonify({"error": "Invalid reaction id"}), 400
 
 if __name__ == '__main__':
     app.run(debug=debug_mode, host='0.0.0.0', port=5000)
\ No newline at end of file
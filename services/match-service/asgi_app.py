@@ -0,0 +1,456 @@
+import asyncio
+import json
+import os
+import time
+
+import redis
+import redis.asyncio
+from quart import Quart, Response, jsonify, request
+
+from atomic_moves import AsyncMoveCommitter, MOVE_MAX_ATTEMPTS, DEADLINES_KEY
+from matchmaking import AsyncMatchmaker, PENDING, matchmaking_channel
+from match_state import MatchState, load_record, peek_version
+from game_rules import deal_new_match
+from match_views import (
+    MATCH_TTL, INVITE_TTL, SSE_HEARTBEAT, SSE_MAX_SECONDS, MATCHMAKING_RETRY_SECONDS,
+    REACTIONS_MAXLEN, MEMORY_SAMPLE_KEYS,
+    match_key, active_index_key, received_index_key, sent_index_key, match_channel, reactions_key,
+    index_add, unindex_invite, queue_new_match, finalize_event, match_view, batch_views, pending_lists,
+    parse_match_ids, reaction_entry, sse_message, tally_memory, memory_report, memory_sample_size,
+    timer_report, reactions_limit, reactions_body, players_error, new_invite, invite_answer_error,
+    batch_ids_error, reaction_error, reactor_error, play_card_move, surrender_move, timeout_move
+)
+from turn_timer import TIMER_STATS_KEY, overdue_metrics_async
+from sharded_store import AsyncShardedStore
+from hot_cache import AsyncHotMatchCache
+
+# --- ASGI MATCH SERVICE ---
+# Same routes and responses as app.py, served by an event loop: Redis calls
+# go through redis.asyncio and the rating lookup of matchmaking through httpx,
+# so a waiting request costs a coroutine instead of a gunicorn thread. The
+# request checks, moves, views, keys and settings come from match_views.py
+# and the Lua scripts are the ones app.py runs, so both variants can serve
+# the same Redis at once; only the I/O around them is written twice.
+#
+#     hypercorn --bind 0.0.0.0:5000 --workers 2 asgi_app:app
+#
+# The hot cache is AsyncHotMatchCache, whose listeners run on the loop. The
+# CPU's turn is computed in a worker thread so the search does not stall the
+# loop.
+
+app = Quart(__name__)
+
+redis_host = os.environ.get('REDIS_HOST', 'redis')
+# Main node: user indexes, matchmaking, worker stats
+r = redis.asyncio.Redis(host=redis_host, port=6379, db=0, decode_responses=True)
+store = AsyncShardedStore()
+moves = AsyncMoveCommitter(store)
+matchmaker = AsyncMatchmaker(r)
+# Decoded match states for the read endpoints (see hot_cache.py)
+hot_cache = AsyncHotMatchCache(store)
+
+@app.after_serving
+async def close_clients():
+    await hot_cache.close()
+    await matchmaker.session.aclose()
+    await store.close()
+    await r.aclose()
+
+async def start_real_match(player1, player2):
+    match_state = deal_new_match(player1, player2)
+    match_id = match_state.match_id
+    async with store.pipeline(match_id) as pipe:
+        queue_new_match(pipe, match_state)
+        await pipe.execute()
+    async with r.pipeline() as pipe:
+        for player in (player1, player2):
+            index_add(pipe, player, active_index_key(player), match_id)
+        await pipe.execute()
+    return match_id
+
+# --- REDIS HELPERS ---
+
+async def load_match(match_id):
+    """MatchState for games, plain dict for pending invites, None if missing."""
+    raw = await store.client(match_id).get(match_key(match_id))
+    return load_record(raw) if raw else None
+
+async def load_matches(match_ids):
+    return [load_record(raw) if raw else None for raw in await store.mget(match_ids, match_key)]
+
+async def commit_move(key, expected, state):
+    """CAS commit of a move, see app.commit_move."""
+    if state.status != 'finished':
+        return await moves.commit(key, expected, state, MATCH_TTL)
+    if not await moves.commit(key, expected, state, MATCH_TTL, finalize_event(state)):
+        return False
+    async with r.pipeline() as pipe:
+        for name in state.names():
+            pipe.srem(active_index_key(name), state.match_id)
+        await pipe.execute()
+    return True
+
+async def read_reactions(match_id, after, limit):
+    """Body of GET /matches/<id>/reactions, see app.read_reactions."""
+    client = store.client(match_id)
+    if after:
+        entries = await client.xrange(reactions_key(match_id), min=f"({after}", count=limit)
+    else:
+        entries = (await client.xrevrange(reactions_key(match_id), count=limit))[::-1]
+    return reactions_body(entries, after)
+
+async def publish_match_event(match_id, event):
+    """Notifies stream subscribers of a match, see app.publish_match_event."""
+    if event['type'] != 'reaction':
+        hot_cache.invalidate(match_id)
+    await store.client(match_id).publish(match_channel(match_id), json.dumps(event))
+
+def sse_response(generator):
+    resp = Response(generator, mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+    # Streams end by themselves after SSE_MAX_SECONDS
+    resp.timeout = None
+    return resp
+
+async def apply_move(move, record, *args):
+    """Runs a match_views move; with the CPU in the match it may search, so off the loop."""
+    if isinstance(record, MatchState) and "CPU" in record.names():
+        return await asyncio.to_thread(move, record, *args)
+    return move(record, *args)
+
+async def run_move(match_id, move, *args):
+    """Applies a match_views move to the stored match and commits it, see app.run_move."""
+    key = match_key(match_id)
+    client = store.client(match_id)
+    for attempt in range(MOVE_MAX_ATTEMPTS):
+        if attempt:
+            await moves.backoff(attempt - 1)
+        raw = await client.get(key)
+        outcome = await apply_move(move, load_record(raw) if raw else None, *args)
+        if outcome.state is None:
+            if outcome.deadline is None:
+                await client.zrem(DEADLINES_KEY, match_id)
+            elif outcome.deadline is not False:
+                await client.zadd(DEADLINES_KEY, {match_id: outcome.deadline})
+            return jsonify(outcome.body), outcome.status
+        if await commit_move(key, raw, outcome.state):
+            await publish_match_event(match_id, {"type": "state"})
+            return jsonify(outcome.body), outcome.status
+
+    await moves.record_exhausted(match_id)
+    return jsonify({"error": "Match is busy, try again"}), 409
+
+# --- ENDPOINTS ---
+
+@app.route('/matches/health', methods=['GET'])
+async def health():
+    try:
+        await r.ping()
+        for client in store.clients.values():
+            await client.ping()
+        db_status = "connected"
+    except redis.ConnectionError:
+        db_status = "disconnected"
+    return jsonify({"status": "healthy", "service": "match-service", "redis": db_status}), 200
+
+@app.route('/matches/admin/moves', methods=['GET'])
+async def move_stats():
+    return jsonify(await moves.stats()), 200
+
+@app.route('/matches/admin/cache', methods=['GET'])
+async def cache_stats():
+    return jsonify(hot_cache.stats()), 200
+
+async def sample_memory(client, limit):
+    keys = []
+    async for key in client.scan_iter(count=500):
+        keys.append(key.decode() if isinstance(key, bytes) else key)
+        if len(keys) >= limit:
+            break
+    async with client.pipeline(transaction=False) as pipe:
+        for key in keys:
+            pipe.memory_usage(key)
+        sizes = await pipe.execute()
+    return await client.dbsize(), (await client.info('memory'))['used_memory'], tally_memory(keys, sizes)
+
+@app.route('/matches/admin/memory', methods=['GET'])
+async def memory_stats():
+    limit = memory_sample_size(request.args.get('sample', default=MEMORY_SAMPLE_KEYS, type=int))
+    nodes = dict(store.clients)
+    main_node = f"{redis_host}:6379"
+    if main_node not in nodes:
+        nodes[main_node] = r
+    samples = await asyncio.gather(*(sample_memory(client, limit) for client in nodes.values()))
+    return jsonify(memory_report(dict(zip(nodes, samples)))), 200
+
+@app.route('/matches/admin/timers', methods=['GET'])
+async def timer_stats():
+    shards = {}
+    for node, client in store.clients.items():
+        worker = {k.decode(): int(v) for k, v in (await client.hgetall(TIMER_STATS_KEY)).items()}
+        shards[node] = {"now": await overdue_metrics_async(client), "worker": worker}
+    return jsonify(timer_report(shards)), 200
+
+@app.route('/matches/pending/<username>', methods=['GET'])
+async def get_pending_matches(username):
+    index_keys = [active_index_key(username), received_index_key(username), sent_index_key(username)]
+    match_ids = list(await r.sunion(index_keys))
+    records = await store.mget(match_ids, match_key)
+    body, expired = pending_lists(username, match_ids, records)
+
+    # Matches that expired through their TTL are dropped lazily from the index
+    if expired:
+        async with r.pipeline() as pipe:
+            for index_key in index_keys:
+                pipe.srem(index_key, *expired)
+            await pipe.execute()
+    return jsonify(body), 200
+
+@app.route('/invites', methods=['POST'])
+async def create_invite():
+    data = await request.get_json()
+    player1 = data.get('player1')
+    player2 = data.get('player2')
+    error = players_error(player1, player2)
+    if error: return jsonify(error[0]), error[1]
+    invite_state = new_invite(player1, player2)
+    match_id = invite_state['match_id']
+    await store.client(match_id).setex(match_key(match_id), INVITE_TTL, json.dumps(invite_state))
+    async with r.pipeline() as pipe:
+        index_add(pipe, player1, sent_index_key(player1), match_id)
+        index_add(pipe, player2, received_index_key(player2), match_id)
+        await pipe.execute()
+    return jsonify({"match_id": match_id, "message": "Invite sent"}), 201
+
+@app.route('/invites/<match_id>/accept', methods=['POST'])
+async def accept_invite(match_id):
+    data = await request.get_json()
+    state = await load_match(match_id)
+    error = invite_answer_error(state, data.get('player'), accepting=True)
+    if error: return jsonify(error[0]), error[1]
+
+    await store.client(match_id).delete(match_key(match_id))
+    async with r.pipeline() as pipe:
+        unindex_invite(pipe, state)
+        await pipe.execute()
+    new_match_id = await start_real_match(state['player1'], state['player2'])
+    return jsonify({"match_id": new_match_id, "message": "Match accepted"}), 200
+
+@app.route('/invites/<match_id>/reject', methods=['POST'])
+async def reject_invite(match_id):
+    data = await request.get_json()
+    state = await load_match(match_id)
+    error = invite_answer_error(state, data.get('player'), accepting=False)
+    if error: return jsonify(error[0]), error[1]
+    await store.client(match_id).delete(match_key(match_id))
+    async with r.pipeline() as pipe:
+        unindex_invite(pipe, state)
+        await pipe.execute()
+    return jsonify({"message": "Invite rejected"}), 200
+
+async def pair_or_queue(player, bucket, queued_only=False):
+    pairing = await matchmaker.try_pair(player, bucket, queued_only)
+    if not pairing: return None, None
+    try:
+        match_id = await start_real_match(pairing.opponent, player)
+    except redis.RedisError as e:
+        print(f"Could not start the match of {pairing.opponent} and {player}: {e}")
+        await matchmaker.requeue(pairing.entries)
+        return None, None
+    await matchmaker.record_match(pairing.opponent, player, match_id)
+    return match_id, pairing.opponent
+
+@app.route('/matchmaking/join', methods=['POST'])
+async def join_matchmaking():
+    data = await request.get_json()
+    player = data.get('player')
+    if not player: return jsonify({"error": "Player required"}), 400
+
+    await matchmaker.clear_result(player)
+    match_id, opponent = await pair_or_queue(player, await matchmaker.rating_bucket(player))
+
+    if match_id:
+        return jsonify({"status": "matched", "match_id": match_id, "opponent": opponent}), 200
+    return jsonify({"status": "waiting"}), 200
+
+async def matchmaking_state(username):
+    match_id = await matchmaker.result(username)
+    if match_id == PENDING: return {"status": "waiting"}
+    if match_id: return {"status": "matched", "match_id": match_id}
+    if await matchmaker.queued_bucket(username) is None: return {"status": "none"}
+    return {"status": "waiting"}
+
+@app.route('/matchmaking/status/<username>', methods=['GET'])
+async def matchmaking_status(username):
+    return jsonify(await matchmaking_state(username)), 200
+
+@app.route('/matchmaking/retry', methods=['POST'])
+async def retry_matchmaking():
+    data = await request.get_json()
+    player = data.get('player')
+    if not player: return jsonify({"error": "Player required"}), 400
+    bucket = await matchmaker.queued_bucket(player)
+    if bucket is not None:
+        await pair_or_queue(player, bucket, queued_only=True)
+    return jsonify(await matchmaking_state(player)), 200
+
+@app.route('/matchmaking/stream/<username>', methods=['GET'])
+async def stream_matchmaking(username):
+    pubsub = r.pubsub(ignore_subscribe_messages=True)
+    await pubsub.subscribe(matchmaking_channel(username))
+
+    async def generate():
+        deadline = time.monotonic() + SSE_MAX_SECONDS
+        try:
+            while time.monotonic() < deadline:
+                state = await matchmaking_state(username)
+                yield sse_message("status", state)
+                if state['status'] != 'waiting':
+                    return
+                await pubsub.get_message(timeout=MATCHMAKING_RETRY_SECONDS)
+        finally:
+            await pubsub.aclose()
+
+    return sse_response(generate())
+
+@app.route('/matchmaking/leave', methods=['POST'])
+async def leave_matchmaking():
+    data = await request.get_json()
+    await matchmaker.leave(data.get('player'))
+    return jsonify({"message": "Left queue"}), 200
+
+@app.route('/matches', methods=['POST'])
+async def create_match():
+    data = await request.get_json()
+    player1 = data.get('player1')
+    player2 = data.get('player2')
+    error = players_error(player1, player2)
+    if error: return jsonify(error[0]), error[1]
+    match_id = await start_real_match(player1, player2)
+    return jsonify({"match_id": match_id, "message": "Match created", "turn": player1}), 201
+
+@app.route('/matches', methods=['GET'])
+async def get_matches():
+    match_ids = parse_match_ids(request.args.get('ids'))
+    error = batch_ids_error(match_ids)
+    if error: return jsonify(error[0]), error[1]
+    return jsonify(batch_views(match_ids, await load_matches(match_ids), request.args.get('player'))), 200
+
+@app.route('/matches/<match_id>', methods=['GET'])
+async def get_match(match_id):
+    after = request.args.get('reactions_after')
+    reactions = None
+    if after is not None:
+        try:
+            reactions = await read_reactions(match_id, after or None, REACTIONS_MAXLEN if after else 1)
+        except redis.ResponseError:
+            return jsonify({"error": "Invalid reaction id"}), 400
+
+    if hot_cache.enabled:
+        record = await hot_cache.get(match_id, lambda: load_match(match_id))
+        version = record.version if isinstance(record, MatchState) else None
+    else:
+        raw = await store.client(match_id).get(match_key(match_id))
+        version = peek_version(raw) if raw else None
+        record = None
+    etag = str(version) if version is not None else None
+
+    if etag and request.if_none_match.contains(etag) and not (reactions and reactions['reactions']):
+        resp = Response("", status=304)
+        resp.set_etag(etag)
+        return resp
+
+    if not hot_cache.enabled:
+        record = load_record(raw) if raw else None
+    body, status = match_view(record, request.args.get('player'))
+    if reactions is not None and status == 200:
+        body = dict(body, reactions=reactions)
+    resp = jsonify(body)
+    resp.status_code = status
+    if etag and status == 200:
+        resp.set_etag(etag)
+        resp.headers['Cache-Control'] = 'no-cache'
+    return resp
+
+@app.route('/matches/<match_id>/stream', methods=['GET'])
+async def stream_match(match_id):
+    requesting_player = request.args.get('player')
+    pubsub = store.client(match_id).pubsub(ignore_subscribe_messages=True)
+    # Subscribe before reading the snapshot so no change can slip in between
+    await pubsub.subscribe(match_channel(match_id))
+    body, status = match_view(await load_match(match_id), requesting_player)
+    if status != 200:
+        await pubsub.aclose()
+        return jsonify(body), status
+
+    async def generate(body):
+        deadline = time.monotonic() + SSE_MAX_SECONDS
+        try:
+            yield sse_message("state", body)
+            while body.get('status') == 'active' and time.monotonic() < deadline:
+                message = await pubsub.get_message(timeout=SSE_HEARTBEAT)
+                if message is None:
+                    yield ": keep-alive\n\n"
+                    continue
+                event = json.loads(message['data'])
+                if event['type'] == 'reaction':
+                    yield sse_message("reaction", event)
+                    continue
+                body, status = match_view(await load_match(match_id), requesting_player)
+                if status != 200:
+                    yield sse_message("gone", body)
+                    return
+                yield sse_message("state", body)
+        finally:
+            await pubsub.aclose()
+
+    return sse_response(generate(body))
+
+@app.route('/matches/<match_id>/play', methods=['POST'])
+async def play_card(match_id):
+    data = await request.get_json()
+    try:
+        return await run_move(match_id, play_card_move, data.get('player'), data.get('card_id'))
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
+
+@app.route('/matches/<match_id>/surrender', methods=['POST'])
+async def surrender_match(match_id):
+    data = await request.get_json()
+    return await run_move(match_id, surrender_move, data.get('player'))
+
+@app.route('/matches/<match_id>/timeout', methods=['POST'])
+async def expire_turn(match_id):
+    return await run_move(match_id, timeout_move, time.time())
+
+@app.route('/matches/<match_id>/react', methods=['POST'])
+async def post_reaction(match_id):
+    data = await request.get_json()
+    player = data.get('player')
+    reaction = data.get('reaction')
+    error = reaction_error(reaction)
+    if error: return jsonify(error[0]), error[1]
+
+    error = reactor_error(await hot_cache.get(match_id, lambda: load_match(match_id)), player)
+    if error: return jsonify(error[0]), error[1]
+
+    entry = reaction_entry(player, reaction)
+    key = reactions_key(match_id)
+    async with store.pipeline(match_id, transaction=False) as pipe:
+        pipe.xadd(key, entry, maxlen=REACTIONS_MAXLEN, approximate=True)
+        pipe.expire(key, MATCH_TTL)
+        entry_id = (await pipe.execute())[0].decode()
+    await publish_match_event(match_id, {"type": "reaction", "id": entry_id, **entry})
+    return jsonify({"message": "Reaction posted", "id": entry_id}), 200
+
+@app.route('/matches/<match_id>/reactions', methods=['GET'])
+async def get_reactions(match_id):
+    after = request.args.get('after')
+    limit = reactions_limit(request.args.get('limit', default=REACTIONS_MAXLEN, type=int))
+    try:
+        return jsonify(await read_reactions(match_id, after, limit)), 200
+    except redis.ResponseError:
+        return jsonify({"error": "Invalid reaction id"}), 400
+
+if __name__ == '__main__':
+    app.run(host='0.0.0.0', port=5000)
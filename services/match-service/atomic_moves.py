@@ -0,0 +1,153 @@
+import asyncio
+import json
+import os
+import random
+import time
+
+from game_rules import turn_deadline
+
+# --- ATOMIC MOVE COMMIT ---
+# A move is computed in Python from the state read with GET, then written
+# back by a Lua script that only applies it if the stored state is still the
+# one the move was computed from (compare-and-set on the encoded record).
+# The check, the write and the bookkeeping happen inside Redis in one round
+# trip, replacing the WATCH/GET/MULTI/EXEC exchange. Every key the script
+# touches lives on the match's shard (see sharded_store.py).
+
+MOVE_MAX_ATTEMPTS = int(os.environ.get('MOVE_MAX_ATTEMPTS', '5'))
+MOVE_BACKOFF_BASE = float(os.environ.get('MOVE_BACKOFF_BASE', '0.005'))
+MOVE_BACKOFF_CAP = float(os.environ.get('MOVE_BACKOFF_CAP', '0.1'))
+
+STATS_KEY = "stats:moves"
+# Stream of side effects (history record, player stats) of finished matches.
+# Written in the same script as the state, drained by outbox_worker.py.
+OUTBOX_KEY = "outbox:finalize"
+OUTBOX_MAXLEN = 100000
+# Sorted set match id -> turn deadline (epoch seconds), kept in step with the
+# state by the commit script and consumed by turn_timer.py
+DEADLINES_KEY = "deadlines:turns"
+
+
+def move_log_key(match_id):
+    """Append-only stream of the events of one match (see game_rules.py).
+
+    Written with the state, archived to history-service by outbox_worker.py.
+    """
+    return f"match:{match_id}:moves"
+
+
+def encode_event(event):
+    return json.dumps(event, separators=(",", ":"))
+
+# KEYS[1]  match key
+# KEYS[2]  stats hash
+# KEYS[3]  outbox stream
+# KEYS[4]  move log stream of the match
+# KEYS[5]  turn deadlines sorted set
+# ARGV[1]  record the move was computed from
+# ARGV[2]  new record
+# ARGV[3]  ttl in seconds
+# ARGV[4]  match id
+# ARGV[5]  outbox event (JSON), empty when the move has no side effects
+# ARGV[6]  outbox max length
+# ARGV[7]  deadline of the new turn, empty when no turn is running
+# ARGV[8+] move log events (JSON)
+COMMIT_LUA = """
+local current = redis.call('GET', KEYS[1])
+if current ~= ARGV[1] then
+    redis.call('HINCRBY', KEYS[2], 'conflicts', 1)
+    return 0
+end
+redis.call('SETEX', KEYS[1], ARGV[3], ARGV[2])
+if ARGV[5] ~= '' then
+    redis.call('XADD', KEYS[3], 'MAXLEN', '~', ARGV[6], '*', 'event', ARGV[5])
+end
+if ARGV[7] == '' then
+    redis.call('ZREM', KEYS[5], ARGV[4])
+else
+    redis.call('ZADD', KEYS[5], ARGV[7], ARGV[4])
+end
+for i = 8, #ARGV do
+    redis.call('XADD', KEYS[4], '*', 'e', ARGV[i])
+end
+redis.call('EXPIRE', KEYS[4], ARGV[3])
+redis.call('HINCRBY', KEYS[2], 'commits', 1)
+return 1
+"""
+
+
+def commit_arguments(key, expected, state, ttl, outbox_event=None):
+    """KEYS and ARGV of COMMIT_LUA for writing `state` over `expected`."""
+    event = json.dumps(outbox_event, separators=(",", ":")) if outbox_event else ""
+    deadline = turn_deadline(state)
+    keys = [key, STATS_KEY, OUTBOX_KEY, move_log_key(state.match_id), DEADLINES_KEY]
+    args = [expected, state.encode(), ttl, state.match_id, event, OUTBOX_MAXLEN,
+            "" if deadline is None else deadline]
+    args += [encode_event(e) for e in state.pending_events]
+    return keys, args
+
+
+def backoff_delay(attempt):
+    """Full jitter delay before retry number `attempt` (0-based)."""
+    return random.uniform(0, min(MOVE_BACKOFF_CAP, MOVE_BACKOFF_BASE * (2 ** attempt)))
+
+
+class MoveCommitter:
+    def __init__(self, store):
+        self.store = store
+        # Script objects run on any client passed at call time
+        self.script = next(iter(store.clients.values())).register_script(COMMIT_LUA)
+
+    def commit(self, key, expected, state, ttl, outbox_event=None):
+        """Writes `state` if `key` still holds `expected`. Returns True on success.
+
+        `outbox_event` is appended to the outbox stream, the state's pending
+        events to its move log and its turn deadline (re)scheduled, atomically
+        with the write.
+        """
+        keys, args = commit_arguments(key, expected, state, ttl, outbox_event)
+        if self.script(keys=keys, args=args, client=self.store.client(state.match_id)) != 1:
+            return False
+        state.pending_events.clear()
+        return True
+
+    def backoff(self, attempt):
+        """Sleeps with full jitter before retry number `attempt` (0-based)."""
+        time.sleep(backoff_delay(attempt))
+
+    def record_exhausted(self, match_id):
+        self.store.client(match_id).hincrby(STATS_KEY, 'exhausted', 1)
+
+    def stats(self):
+        """Counters summed over every shard."""
+        totals = {}
+        for client in self.store.clients.values():
+            for k, v in client.hgetall(STATS_KEY).items():
+                k = k.decode() if isinstance(k, bytes) else k
+                totals[k] = totals.get(k, 0) + int(v)
+        return totals
+
+
+class AsyncMoveCommitter(MoveCommitter):
+    """MoveCommitter over an AsyncShardedStore: same script, awaited."""
+
+    async def commit(self, key, expected, state, ttl, outbox_event=None):
+        keys, args = commit_arguments(key, expected, state, ttl, outbox_event)
+        if await self.script(keys=keys, args=args, client=self.store.client(state.match_id)) != 1:
+            return False
+        state.pending_events.clear()
+        return True
+
+    async def backoff(self, attempt):
+        await asyncio.sleep(backoff_delay(attempt))
+
+    async def record_exhausted(self, match_id):
+        await self.store.client(match_id).hincrby(STATS_KEY, 'exhausted', 1)
+
+    async def stats(self):
+        totals = {}
+        for client in self.store.clients.values():
+            for k, v in (await client.hgetall(STATS_KEY)).items():
+                k = k.decode() if isinstance(k, bytes) else k
+                totals[k] = totals.get(k, 0) + int(v)
+        return totals
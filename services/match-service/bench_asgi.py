@@ -0,0 +1,246 @@
+"""Concurrent-request capacity of the Flask app vs the ASGI app, per core.
+
+Starts both variants on plain HTTP, each with one worker pinned to the same
+CPU core (taskset, when available), against the Redis of REDIS_HOST /
+REDIS_NODES, and drives them with the same load:
+
+  mix      N clients loop over GET /matches/<id> (half of them revalidating
+           with If-None-Match) and play a card when it is their turn.
+  streams  S clients hold a GET /matches/<id>/stream open while N clients
+           run the mix: shows how many idle connections a worker can keep
+           and what they cost the other requests.
+
+    python bench_asgi.py --concurrency 8 32 128 --duration 10
+    python bench_asgi.py --scenario streams --streams 200 --concurrency 16
+    python bench_asgi.py --target flask=http://host:5000 --target asgi=http://host:5001
+
+Throughput is reported per core (requests/s divided by --cores, 1 for the
+pinned servers started here) and, for the servers started here, per second
+of CPU time the server processes used (from /proc), which does not depend on
+how much of the core the load generator took. Pin the load generator to
+other cores when there are any (taskset -c 1-3 python bench_asgi.py --core 0):
+on a shared core the client's own cost dominates at high concurrency.
+Errors include timeouts: a sync worker whose threads are all busy makes new
+connections wait.
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import shutil
+import subprocess
+import sys
+import time
+
+import httpx
+
+SERVERS = {
+    "flask": ["gunicorn", "--bind", "127.0.0.1:{port}", "--workers", "1",
+              "--worker-class", "gthread", "--threads", "32", "app:app"],
+    "asgi": ["hypercorn", "--bind", "127.0.0.1:{port}", "--workers", "1", "asgi_app:app"],
+}
+PLAYERS = ("bench_a", "bench_b")
+REQUEST_TIMEOUT = 10
+PENDING_SLOT = None  # pool slot whose replacement match is being created
+
+
+def cpu_seconds(pid):
+    """User + system CPU time of a process and its children (gunicorn workers), Linux only."""
+    try:
+        with open(f"/proc/{pid}/stat") as f:
+            fields = f.read().rsplit(")", 1)[1].split()
+        total = (int(fields[11]) + int(fields[12])) / os.sysconf("SC_CLK_TCK")
+        with open(f"/proc/{pid}/task/{pid}/children") as f:
+            children = [int(c) for c in f.read().split()]
+    except (OSError, ValueError):
+        return 0.0
+    return total + sum(cpu_seconds(child) for child in children)
+
+
+def start_server(name, port, core):
+    cmd = [part.format(port=port) for part in SERVERS[name]]
+    if core is not None and shutil.which("taskset"):
+        cmd = ["taskset", "-c", str(core)] + cmd
+    env = dict(os.environ, SSE_MAX_SECONDS=os.environ.get('SSE_MAX_SECONDS', '600'))
+    return subprocess.Popen(cmd, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+                            cwd=os.path.dirname(os.path.abspath(__file__)))
+
+
+async def wait_ready(client, url, seconds=20):
+    deadline = time.monotonic() + seconds
+    while time.monotonic() < deadline:
+        try:
+            if (await client.get(f"{url}/matches/health")).status_code == 200:
+                return
+        except httpx.HTTPError:
+            pass
+        await asyncio.sleep(0.2)
+    raise RuntimeError(f"{url} did not start")
+
+
+async def create_matches(client, url, count):
+    ids = []
+    for _ in range(count):
+        resp = await client.post(f"{url}/matches", json={"player1": PLAYERS[0], "player2": PLAYERS[1]})
+        ids.append(resp.json()["match_id"])
+    return ids
+
+
+class Load:
+    def __init__(self):
+        self.latencies = []
+        self.errors = 0
+        self.statuses = {}
+
+    def record(self, started, status):
+        self.latencies.append(time.perf_counter() - started)
+        self.statuses[status] = self.statuses.get(status, 0) + 1
+
+    def summary(self, seconds, cores):
+        lat = sorted(self.latencies)
+        pct = lambda p: round(lat[min(len(lat) - 1, int(p * len(lat)))] * 1000, 2) if lat else None
+        return {
+            "requests": len(lat),
+            "errors": self.errors,
+            "rps_per_core": round(len(lat) / seconds / cores, 1),
+            "p50_ms": pct(0.50),
+            "p99_ms": pct(0.99),
+            "statuses": self.statuses
+        }
+
+
+async def mix_client(client, url, match_ids, stop_at, load, rng):
+    etags = {}
+    while time.monotonic() < stop_at:
+        match_id = rng.choice(match_ids)
+        if match_id == PENDING_SLOT:
+            continue
+        player = rng.choice(PLAYERS)
+        headers = {"If-None-Match": etags[match_id]} if match_id in etags and rng.random() < 0.5 else {}
+        started = time.perf_counter()
+        try:
+            resp = await client.get(f"{url}/matches/{match_id}", params={"player": player}, headers=headers)
+            load.record(started, resp.status_code)
+            if resp.status_code != 200:
+                continue
+            etags[match_id] = resp.headers.get("ETag")
+            state = resp.json()
+            if state.get("status") == "finished":
+                # Keep the pool playable: replace the finished match (once)
+                if match_id in match_ids:
+                    match_ids[match_ids.index(match_id)] = PENDING_SLOT
+                    created = await client.post(f"{url}/matches", json={"player1": PLAYERS[0], "player2": PLAYERS[1]})
+                    match_ids[match_ids.index(PENDING_SLOT)] = created.json()["match_id"]
+            elif state.get("turn") == player:
+                hand = state["players"][player]["hand"]
+                started = time.perf_counter()
+                resp = await client.post(f"{url}/matches/{match_id}/play",
+                                         json={"player": player, "card_id": rng.choice(hand)})
+                load.record(started, resp.status_code)
+        except httpx.HTTPError:
+            load.errors += 1
+
+
+async def stream_client(client, url, match_id, stop_at, opened):
+    try:
+        async with client.stream("GET", f"{url}/matches/{match_id}/stream",
+                                 params={"player": PLAYERS[0]}) as resp:
+            if resp.status_code == 200:
+                opened.append(match_id)
+            async for _ in resp.aiter_bytes():
+                if time.monotonic() >= stop_at:
+                    return
+    except httpx.HTTPError:
+        pass
+
+
+async def run_level(url, match_ids, concurrency, streams, duration, cores, seed, pid=None):
+    limits = httpx.Limits(max_connections=concurrency + streams + 10, max_keepalive_connections=concurrency + 10)
+    async with httpx.AsyncClient(limits=limits, timeout=REQUEST_TIMEOUT) as client:
+        stop_at = time.monotonic() + duration
+        opened, holders = [], []
+        for i in range(streams):
+            holders.append(asyncio.create_task(
+                stream_client(client, url, match_ids[i % len(match_ids)], stop_at, opened)))
+        if streams:
+            await asyncio.sleep(1)
+        load = Load()
+        rng = random.Random(seed)
+        started = time.monotonic()
+        cpu_before = cpu_seconds(pid) if pid else 0.0
+        await asyncio.gather(*(mix_client(client, url, match_ids, stop_at, load, random.Random(rng.random()))
+                               for _ in range(concurrency)))
+        result = load.summary(time.monotonic() - started, cores)
+        if pid:
+            cpu = cpu_seconds(pid) - cpu_before
+            result["server_cpu_s"] = round(cpu, 2)
+            result["rps_per_cpu_s"] = round(len(load.latencies) / cpu, 1) if cpu else None
+        if streams:
+            result["streams_open"] = len(opened)
+        for task in holders:
+            task.cancel()
+        await asyncio.gather(*holders, return_exceptions=True)
+    return result
+
+
+async def bench(targets, args, pids=None):
+    report = {}
+    async with httpx.AsyncClient(timeout=REQUEST_TIMEOUT) as client:
+        for name, url in targets.items():
+            await wait_ready(client, url)
+            match_ids = await create_matches(client, url, args.matches)
+            report[name] = {}
+            for level in args.concurrency:
+                result = await run_level(url, match_ids, level, args.streams if args.scenario == "streams" else 0,
+                                         args.duration, args.cores, args.seed, (pids or {}).get(name))
+                report[name][level] = result
+                extra = f", {result['streams_open']} streams open" if "streams_open" in result else ""
+                if result.get("rps_per_cpu_s"):
+                    extra += f", {result['rps_per_cpu_s']} req per server CPU-second"
+                print(f"{name:6s} c={level:<4d} {result['rps_per_core']:9.1f} req/s/core  "
+                      f"p50 {result['p50_ms']} ms  p99 {result['p99_ms']} ms  "
+                      f"errors {result['errors']}{extra}")
+    return report
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Flask vs ASGI match-service capacity per core")
+    parser.add_argument("--scenario", choices=("mix", "streams"), default="mix")
+    parser.add_argument("--concurrency", type=int, nargs="+", default=[8, 32, 128])
+    parser.add_argument("--streams", type=int, default=200, help="open SSE streams (streams scenario)")
+    parser.add_argument("--duration", type=float, default=10, help="seconds per level")
+    parser.add_argument("--matches", type=int, default=50, help="matches in the pool")
+    parser.add_argument("--target", action="append", default=[], metavar="NAME=URL",
+                        help="benchmark running servers instead of starting them")
+    parser.add_argument("--cores", type=float, default=1, help="cores of the servers, to normalize")
+    parser.add_argument("--core", type=int, default=0, help="core the started servers are pinned to")
+    parser.add_argument("--port", type=int, default=5100)
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--json", help="write the report to this file")
+    args = parser.parse_args()
+
+    servers = {}
+    if args.target:
+        targets = dict(t.split("=", 1) for t in args.target)
+    else:
+        targets = {}
+        for offset, name in enumerate(SERVERS):
+            port = args.port + offset
+            servers[name] = start_server(name, port, args.core)
+            targets[name] = f"http://127.0.0.1:{port}"
+    try:
+        report = asyncio.run(bench(targets, args, {name: proc.pid for name, proc in servers.items()}))
+    finally:
+        for proc in servers.values():
+            proc.terminate()
+            proc.wait()
+
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(report, f, indent=2)
+    return report
+
+
+if __name__ == '__main__':
+    sys.exit(main() and 0)
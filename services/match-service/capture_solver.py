@@ -0,0 +1,106 @@
+from functools import lru_cache
+
+# A capture must add up to 15 together with the played card, so the table
+# side of a capture never exceeds 14 points.
+CAPTURE_TOTAL = 15
+MAX_TABLE_SUM = CAPTURE_TOTAL - 1
+
+
+def get_card_value(card_id):
+    return (card_id - 1) % 10 + 1
+
+
+def value_counts(table_ids):
+    """Multiset of table values as a 10-slot tuple (index 0 -> value 1)."""
+    counts = [0] * 10
+    for cid in table_ids:
+        counts[get_card_value(cid) - 1] += 1
+    return tuple(counts)
+
+
+def _solver_key(counts, target):
+    """Only the values <= target matter, and only as many copies as fit in it.
+
+    Clipping keeps the key space tiny and the same no matter how big the
+    table grows, so the memo table fills up after a handful of games.
+    """
+    return tuple(min(counts[i], target // (i + 1)) for i in range(min(target, 10)))
+
+
+@lru_cache(maxsize=None)
+def _solve(counts, target):
+    """All ways to pick values from `counts` summing to target.
+
+    `counts` describes values 1..len(counts); each solution tells how many
+    copies of every value are used. Sub-problems are memoized too, so the
+    search is a subset-sum table filled lazily.
+    """
+    if target == 0:
+        return ((0,) * len(counts),)
+    if not counts:
+        return ()
+    value = len(counts)
+    head = counts[:-1]
+    solutions = []
+    for used in range(min(counts[-1], target // value) + 1):
+        for sol in _solve(head, target - used * value):
+            solutions.append(sol + (0,) * (value - 1 - len(sol)) + (used,))
+    return tuple(solutions)
+
+
+def solve(counts, target):
+    """Value-count solutions (10-slot tuples) for a table multiset."""
+    if target <= 0:
+        return ()
+    return tuple(sol + (0,) * (10 - len(sol)) for sol in _solve(_solver_key(counts, target), target))
+
+
+def _materialize(solution, table_ids):
+    """Turn a value-count solution into concrete table cards.
+
+    For every value the earliest cards on the table are used, which matches
+    the order the old brute-force search produced combinations in.
+    """
+    needed = list(solution)
+    picked = []
+    for cid in table_ids:
+        idx = get_card_value(cid) - 1
+        if needed[idx]:
+            needed[idx] -= 1
+            picked.append(cid)
+    return picked
+
+
+def _positions(capture, table_ids):
+    index = {cid: pos for pos, cid in enumerate(table_ids)}
+    return tuple(index[cid] for cid in capture)
+
+
+def all_captures(played_card_id, table_ids):
+    """Every legal capture for the played card, one per value combination.
+
+    Captures that only differ by swapping cards of the same value are
+    reported once (using the earliest of those cards on the table).
+    """
+    target = CAPTURE_TOTAL - get_card_value(played_card_id)
+    if target <= 0 or not table_ids:
+        return []
+    solutions = solve(value_counts(table_ids), target)
+    return [_materialize(sol, table_ids) for sol in solutions]
+
+
+def best_capture(played_card_id, table_ids):
+    """The capture the game applies: most cards taken, earliest cards first."""
+    target = CAPTURE_TOTAL - get_card_value(played_card_id)
+    if target <= 0 or not table_ids:
+        return []
+    solutions = solve(value_counts(table_ids), target)
+    if not solutions:
+        return []
+    most = max(sum(sol) for sol in solutions)
+    candidates = [_materialize(sol, table_ids) for sol in solutions if sum(sol) == most]
+    return min(candidates, key=lambda capture: _positions(capture, table_ids))
+
+
+def cache_info():
+    return _solve.cache_info()
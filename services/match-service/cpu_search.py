@@ -0,0 +1,163 @@
+import itertools
+import math
+import os
+import random
+import time
+
+import capture_solver
+from match_state import ALL_CARDS, OROS_MASK, SETTEBELLO_BIT, card_bit, cards_of, mask_of, popcount
+
+# --- SEARCH CPU ---
+# Perfect-information Monte Carlo: the unknown cards are dealt at random to
+# the opponent's hand (one "determinization" per sample), each sample is
+# solved exactly with negamax until the end of the current hand, and the
+# card with the best average value is played. Samples are drawn until the
+# time budget runs out, every distinct deal has been solved (then the
+# average is exact: with an empty deck there is only one), or the ranking
+# of the cards has not changed for CPU_STABLE_SAMPLES samples. Positions are shared between samples, moves and
+# requests through a transposition table, since many determinizations reach
+# the same (hands, table) positions.
+
+CPU_TIME_BUDGET_MS = float(os.environ.get('CPU_TIME_BUDGET_MS', '20'))
+TT_MAX_ENTRIES = int(os.environ.get('CPU_TT_MAX_ENTRIES', '200000'))
+CPU_STABLE_SAMPLES = int(os.environ.get('CPU_STABLE_SAMPLES', '50'))
+# Up to this many possible deals, each is solved once instead of sampled
+EXACT_MAX_DEALS = 256
+
+# Value of captured cards, in game points. Most cards (>20) and most oros
+# (>5) are majorities, so a single card is worth about one share of them.
+W_CARD = 1 / 21
+W_ORO = 1 / 6
+W_SETTEBELLO = 1.0
+W_ESCOBA = 1.0
+
+_table = {}
+_stats = {"hits": 0, "misses": 0, "searches": 0, "samples": 0, "exhausted": 0, "stable": 0}
+
+
+def capture_value(mask, escoba):
+    value = W_CARD * popcount(mask) + W_ORO * popcount(mask & OROS_MASK)
+    if mask & SETTEBELLO_BIT:
+        value += W_SETTEBELLO
+    if escoba:
+        value += W_ESCOBA
+    return value
+
+
+def _play(table, card):
+    """(new table, value gained, captured?) for playing `card` on `table`."""
+    captured = capture_solver.best_capture(card, cards_of(table))
+    if not captured:
+        return table | card_bit(card), 0.0, False
+    taken = mask_of(captured)
+    new_table = table & ~taken
+    return new_table, capture_value(taken | card_bit(card), not new_table), True
+
+
+def _negamax(me, opp, table, last_capture, final):
+    """Best value for the side to move until the current hand is played out.
+
+    me / opp are hand masks of the side to move and of the other side.
+    last_capture is 0 when the side to move captured last, 1 for the other
+    side and -1 for nobody; it only matters in the final hand, where the
+    cards left on the table go to the last capturer.
+    """
+    if not me and not opp:
+        if final and table and last_capture >= 0:
+            value = capture_value(table, False)
+            return value if last_capture == 0 else -value
+        return 0.0
+
+    key = (me, opp, table, last_capture if final else -1, final)
+    cached = _table.get(key)
+    if cached is not None:
+        _stats["hits"] += 1
+        return cached
+    _stats["misses"] += 1
+
+    if not me:
+        best = -_negamax(opp, me, table, _flip(last_capture), final)
+    else:
+        best = float("-inf")
+        for card in cards_of(me):
+            new_table, gain, captured = _play(table, card)
+            next_last = 1 if captured else _flip(last_capture)
+            value = gain - _negamax(opp, me & ~card_bit(card), new_table, next_last, final)
+            if value > best:
+                best = value
+
+    if len(_table) >= TT_MAX_ENTRIES:
+        _table.clear()
+    _table[key] = best
+    return best
+
+
+def _flip(last_capture):
+    return last_capture if last_capture < 0 else 1 - last_capture
+
+
+def _deals(unknown, size, rng):
+    """Opponent hands to solve: every distinct one in random order when there are
+    few (a cut by the deadline stays unbiased), else random samples without end."""
+    if math.comb(len(unknown), size) <= EXACT_MAX_DEALS:
+        deals = list(itertools.combinations(unknown, size))
+        rng.shuffle(deals)
+        for deal in deals:
+            yield mask_of(deal)
+        return
+    while True:
+        yield mask_of(rng.sample(unknown, size))
+
+
+def choose_card(state, seat, budget_ms=None, rng=random):
+    """Card the CPU in `seat` should play, within `budget_ms` milliseconds."""
+    me = state.players[seat]
+    opp = state.players[1 - seat]
+    hand = me.hand_cards()
+    if len(hand) == 1:
+        return hand[0]
+
+    budget = (CPU_TIME_BUDGET_MS if budget_ms is None else budget_ms) / 1000
+    deadline = time.perf_counter() + budget
+    final = not state.deck
+    if state.last_capture_by is None:
+        last_capture = -1
+    else:
+        last_capture = 0 if state.last_capture_by == seat else 1
+
+    # Cards the CPU cannot see: the opponent's hand and the deck
+    unknown = cards_of(ALL_CARDS & ~(me.hand | state.table | me.captured | opp.captured))
+    opp_size = popcount(opp.hand)
+
+    totals = dict.fromkeys(hand, 0.0)
+
+    def rank(card):
+        # Ties go to the lowest value card, like the greedy CPU
+        return totals[card], -capture_solver.get_card_value(card)
+
+    deals = _deals(unknown, opp_size, rng) if opp_size <= len(unknown) else iter([opp.hand])
+    ranking, unchanged = None, 0
+    samples = 0
+    _stats["searches"] += 1
+    for opp_hand in deals:
+        for card in hand:
+            new_table, gain, captured = _play(state.table, card)
+            next_last = 1 if captured else _flip(last_capture)
+            totals[card] += gain - _negamax(opp_hand, me.hand & ~card_bit(card), new_table, next_last, final)
+        samples += 1
+        previous, ranking = ranking, sorted(hand, key=rank)
+        unchanged = unchanged + 1 if ranking == previous else 0
+        if unchanged >= CPU_STABLE_SAMPLES:
+            _stats["stable"] += 1
+            break
+        if time.perf_counter() >= deadline:
+            break
+    else:
+        _stats["exhausted"] += 1
+    _stats["samples"] += samples
+
+    return max(hand, key=rank)
+
+
+def stats():
+    return dict(_stats, entries=len(_table))
@@ -0,0 +1,254 @@
+import os
+import random
+import uuid
+
+import capture_solver
+import cpu_search
+from match_state import MatchState, PlayerState, card_bit, mask_of, utc_timestamp
+
+# --- GAME RULES ---
+# Pure La Escoba rules on a MatchState: no Redis, no HTTP. Used by the Flask
+# app and by the headless simulator (simulate.py).
+#
+# Every change is also recorded with state.log_event, so the move log alone
+# rebuilds any intermediate state without these rules:
+#   ["start", player1, player2, hand1, hand2, table]
+#   ["play", seat, card, captured, escoba]
+#   ["deal", hand1, hand2]
+#   ["sweep", seat, cards]    (end of match, the table goes to the last capturer)
+#   ["surrender", seat]
+#   ["timeout", seat]         (the turn expired, followed by the automatic play)
+
+# Recompute scores from the captured piles and compare with the running
+# components (debugging aid; reads stay O(1) when disabled)
+SCORE_VERIFY = os.environ.get('SCORE_VERIFY', 'False').lower() == 'true'
+
+# "search" (cpu_search.py, bounded by CPU_TIME_BUDGET_MS) or "greedy"
+CPU_STRATEGY = os.environ.get('CPU_STRATEGY', 'search')
+
+# Time a player has for a move; an expired turn is played automatically and
+# after TURN_MAX_TIMEOUTS expired turns in a row the player forfeits
+TURN_TIMEOUT_SECONDS = int(os.environ.get('TURN_TIMEOUT_SECONDS', '90'))
+TURN_MAX_TIMEOUTS = int(os.environ.get('TURN_MAX_TIMEOUTS', '2'))
+
+# --- UTILS CARTE ---
+def get_initial_deck():
+    return list(range(1, 41))
+
+def get_card_value(card_id):
+    return capture_solver.get_card_value(card_id)
+
+def find_capture_combination(played_card_id, table_ids):
+    # Memoized subset-sum over the table values (see capture_solver.py)
+    return capture_solver.best_capture(played_card_id, table_ids)
+
+def verify_score_components(state):
+    """Full recomputation of the running score components, logging any drift."""
+    for player in state.players:
+        running = (player.cards, player.oros, player.settebello)
+        player.recount()
+        if running != (player.cards, player.oros, player.settebello):
+            print(f"Score drift in match {state.match_id} for {player.name}: "
+                  f"running {running}, recomputed {(player.cards, player.oros, player.settebello)}")
+
+def calculate_scores(state, verify=None):
+    scores = {}
+    details = {}
+    if verify is None: verify = SCORE_VERIFY
+    if verify: verify_score_components(state)
+
+    for player in state.players:
+        points = 0
+        score_log = []
+
+        escobas = player.escobas
+        points += escobas
+        if escobas > 0: score_log.append(f"{escobas} Escoba(s)")
+
+        if player.cards > 20:
+            points += 1
+            score_log.append("Most Cards")
+        
+        if player.oros > 5:
+            points += 1
+            score_log.append("Most Coins")
+
+        if player.settebello:
+            points += 1
+            score_log.append("Settebello")
+            
+        scores[player.name] = points
+        details[player.name] = score_log
+    return scores, details
+
+def finalize_match(state, surrender_winner=None):
+    winner = None
+    final_scores = {}
+    score_details = {}
+
+    if surrender_winner:
+        winner = surrender_winner
+        p1, p2 = state.names()
+        final_scores = {p1: 0, p2: 0}
+        score_details = {winner: ["Opponent Surrendered"]}
+    else:
+        if state.last_capture_by is not None and state.table:
+            state.log_event("sweep", state.last_capture_by, state.table_cards())
+            state.players[state.last_capture_by].capture(state.table)
+            state.table = 0
+
+        final_scores, score_details = calculate_scores(state)
+        p1, p2 = list(final_scores.keys())
+        if final_scores[p1] > final_scores[p2]: winner = p1
+        elif final_scores[p2] > final_scores[p1]: winner = p2
+        else: winner = "Draw"
+
+    return {
+        "status": "finished",
+        "winner": winner,
+        "final_scores": final_scores,
+        "details": score_details
+    }
+
+def apply_play(state, seat, card_id):
+    """Plays card_id from the hand of `seat`, capturing when possible."""
+    player = state.players[seat]
+    captured_cards = find_capture_combination(card_id, state.table_cards())
+    escoba = False
+    player.hand &= ~card_bit(card_id)
+
+    if captured_cards:
+        state.table &= ~mask_of(captured_cards)
+        player.capture(mask_of(captured_cards) | card_bit(card_id))
+        state.last_capture_by = seat
+        if not state.table:
+            escoba = True
+            player.escobas += 1
+    else:
+        state.table |= card_bit(card_id)
+
+    state.log_event("play", seat, card_id, captured_cards, int(escoba))
+    return captured_cards, escoba
+
+def greedy_cpu_card(state, seat):
+    cpu_hand = state.players[seat].hand_cards()
+    table = state.table_cards()
+
+    for card in cpu_hand:
+        if find_capture_combination(card, table):
+            return card
+    return min(cpu_hand, key=get_card_value)
+
+def execute_cpu_turn(state, seat=None, strategy=None):
+    if seat is None: seat = state.seat("CPU")
+    if (strategy or CPU_STRATEGY) == "search":
+        move_card = cpu_search.choose_card(state, seat)
+    else:
+        move_card = greedy_cpu_card(state, seat)
+
+    apply_play(state, seat, move_card)
+    return state
+
+def handle_turn_change(state):
+    next_seat = (state.turn + 1) % 2
+    p1, p2 = state.players
+    
+    message = "Turn changed"
+    finished = False
+    
+    if not p1.hand and not p2.hand:
+        if len(state.deck) > 0:
+            deal_count = 3
+            if len(state.deck) < 6: deal_count = len(state.deck) // 2
+            
+            for _ in range(deal_count):
+                p1.hand |= card_bit(state.deck.pop())
+                p2.hand |= card_bit(state.deck.pop())
+            state.log_event("deal", p1.hand_cards(), p2.hand_cards())
+            message = "New hand dealt"
+            state.turn = next_seat
+            state.turn_start_time = utc_timestamp()
+        else:
+            final_result = finalize_match(state)
+            state.status = 'finished'
+            state.result = final_result
+            message = "Match finished"
+            state.turn = None
+            finished = True
+    else:
+        state.turn = next_seat
+        state.turn_start_time = utc_timestamp()
+        
+    return state, message, finished
+
+def deal_new_match(player1, player2, match_id=None, rng=random):
+    """Shuffles a deck and deals the opening hands and table."""
+    deck = get_initial_deck()
+    rng.shuffle(deck)
+    p1_hand = [deck.pop() for _ in range(3)]
+    p2_hand = [deck.pop() for _ in range(3)]
+    table = [deck.pop() for _ in range(4)]
+
+    state = MatchState(
+        match_id or str(uuid.uuid4()),
+        [PlayerState(player1, hand=mask_of(p1_hand)), PlayerState(player2, hand=mask_of(p2_hand))],
+        table=mask_of(table),
+        deck=deck
+    )
+    state.log_event("start", player1, player2, sorted(p1_hand), sorted(p2_hand), sorted(table))
+    return state
+
+def surrender(state, seat):
+    """The player in `seat` gives up: the opponent wins."""
+    state.log_event("surrender", seat)
+    state.result = finalize_match(state, surrender_winner=state.players[1 - seat].name)
+    state.status = 'finished'
+    state.turn = None
+    return state.result
+
+def play_move(state, seat, card_id):
+    """One /play request: the move, the turn change and the CPU reply if due.
+
+    Returns (captured cards, escoba, message, finished).
+    """
+    captured_cards, escoba = apply_play(state, seat, card_id)
+    state.timeouts[seat] = 0
+    message, finished = end_turn(state)
+    return captured_cards, escoba, message, finished
+
+def end_turn(state):
+    """Turn change after a play, plus the CPU reply if it is the CPU's turn."""
+    state, message, finished = handle_turn_change(state)
+    
+    if not finished and state.turn_name == "CPU":
+        state = execute_cpu_turn(state)
+        state, cpu_msg, finished = handle_turn_change(state)
+        message = "CPU played. Your turn."
+
+    return message, finished
+
+# --- TURN DEADLINES ---
+
+def turn_deadline(state):
+    """Epoch seconds at which the current turn expires, None if nobody is waited for."""
+    if state.status != 'active' or state.turn is None or state.turn_name == "CPU":
+        return None
+    return state.turn_start_time + TURN_TIMEOUT_SECONDS
+
+def play_timeout(state):
+    """The player to move let the turn expire.
+
+    A card is played for them with the greedy CPU heuristic; after
+    TURN_MAX_TIMEOUTS expired turns in a row they forfeit instead.
+    Returns (message, finished, forfeited).
+    """
+    seat = state.turn
+    state.log_event("timeout", seat)
+    state.timeouts[seat] += 1
+    if state.timeouts[seat] >= TURN_MAX_TIMEOUTS:
+        surrender(state, seat)
+        return "Player forfeited on time", True, True
+
+    apply_play(state, seat, greedy_cpu_card(state, seat))
+    message, finished = end_turn(state)
+    return message, finished, False
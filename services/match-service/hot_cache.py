@@ -0,0 +1,211 @@
+import asyncio
+import json
+import os
+import threading
+import time
+from collections import OrderedDict
+
+import redis
+
+from match_state import MatchState
+
+# --- HOT MATCH CACHE ---
+# Per-process LRU of decoded match states for the read endpoints. Every
+# write to a match is followed by a message on match:{id}:events (see
+# publish_match_event in app.py); a listener thread per shard receives them
+# through a pattern subscription and drops the cached entry. While a
+# listener is not subscribed (startup, lost connection) the cache is
+# bypassed and emptied, so a missed message can never leave a stale entry
+# behind. Entries also expire after HOT_CACHE_TTL seconds.
+#
+# Cached states are shared between request threads: callers must not
+# mutate them (the write endpoints read Redis directly for their CAS).
+# AsyncHotMatchCache is the same cache for asgi_app.py, its listeners being
+# tasks on the event loop over the redis.asyncio clients.
+
+HOT_CACHE_SIZE = int(os.environ.get('HOT_CACHE_SIZE', '1000'))
+HOT_CACHE_TTL = float(os.environ.get('HOT_CACHE_TTL', '30'))
+
+EVENTS_PATTERN = "match:*:events"
+RECONNECT_SECONDS = 1
+
+
+def match_id_of(channel):
+    if isinstance(channel, bytes):
+        channel = channel.decode()
+    return channel[len("match:"):-len(":events")]
+
+
+def is_reaction(data):
+    # Reactions are published on the same channel but leave the state alone
+    try:
+        return json.loads(data).get('type') == 'reaction'
+    except ValueError:
+        return False
+
+
+class HotMatchCache:
+    def __init__(self, store, max_entries=HOT_CACHE_SIZE, ttl=HOT_CACHE_TTL):
+        self.store = store
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._entries = OrderedDict()   # match id -> (expires at, state)
+        self._filling = {}              # match id -> token of the read in flight
+        self._lock = threading.Lock()
+        self._live = set()              # shards whose listener is subscribed
+        self._started = False
+        self.counters = {"hits": 0, "misses": 0, "bypassed": 0, "invalidations": 0, "evictions": 0}
+
+    @property
+    def enabled(self):
+        return self.max_entries > 0
+
+    # --- reads ---
+    def get(self, match_id, loader):
+        """Cached state of a match, or loader() on a miss (cached if it is a MatchState)."""
+        hit, found = self._lookup(match_id)
+        if hit:
+            return found
+        record = loader()
+        self._fill(match_id, found, record)
+        return record
+
+    def _lookup(self, match_id):
+        """(True, cached state), or (False, token for _fill; None to bypass the cache)."""
+        if not self.enabled:
+            return False, None
+        self._ensure_listeners()
+        if len(self._live) < len(self.store.clients):
+            with self._lock:
+                self.counters["bypassed"] += 1
+            return False, None
+
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(match_id)
+            if entry is not None and entry[0] > now:
+                self._entries.move_to_end(match_id)
+                self.counters["hits"] += 1
+                return True, entry[1]
+            self.counters["misses"] += 1
+            # A new tuple per read: its identity marks the read, its item the start
+            token = self._filling[match_id] = (now,)
+        return False, token
+
+    def _fill(self, match_id, token, record):
+        if token is None:
+            return
+        with self._lock:
+            # An invalidation during the read removed the token: the record
+            # may predate the write, so it is returned but not cached
+            if self._filling.get(match_id) is token:
+                del self._filling[match_id]
+                if isinstance(record, MatchState):
+                    self._entries[match_id] = (token[0] + self.ttl, record)
+                    self._entries.move_to_end(match_id)
+                    while len(self._entries) > self.max_entries:
+                        self._entries.popitem(last=False)
+                        self.counters["evictions"] += 1
+
+    # --- invalidation ---
+    def invalidate(self, match_id):
+        with self._lock:
+            self._entries.pop(match_id, None)
+            self._filling.pop(match_id, None)
+            self.counters["invalidations"] += 1
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._filling.clear()
+
+    def _ensure_listeners(self):
+        # Started lazily so every gunicorn worker gets its own threads after fork
+        if self._started:
+            return
+        with self._lock:
+            if self._started:
+                return
+            self._started = True
+        for node, client in self.store.clients.items():
+            self._start_listener(node, client)
+
+    def _start_listener(self, node, client):
+        threading.Thread(target=self._listen, args=(node, client), daemon=True,
+                         name=f"hot-cache-{node}").start()
+
+    def _on_message(self, node, message):
+        if message['type'] == 'psubscribe':
+            self._live.add(node)
+        elif message['type'] == 'pmessage' and not is_reaction(message['data']):
+            self.invalidate(match_id_of(message['channel']))
+
+    def _lost(self, node, error):
+        print(f"Hot cache listener for {node} lost its subscription: {error}")
+
+    def _listen(self, node, client):
+        while True:
+            pubsub = client.pubsub()
+            try:
+                pubsub.psubscribe(EVENTS_PATTERN)
+                for message in pubsub.listen():
+                    self._on_message(node, message)
+            except redis.ConnectionError as e:
+                self._lost(node, e)
+            finally:
+                self._live.discard(node)
+                self.clear()
+                pubsub.close()
+            time.sleep(RECONNECT_SECONDS)
+
+    def stats(self):
+        with self._lock:
+            counters = dict(self.counters)
+            size = len(self._entries)
+        lookups = counters["hits"] + counters["misses"]
+        return dict(counters, size=size, max_entries=self.max_entries,
+                    hit_ratio=round(counters["hits"] / lookups, 4) if lookups else 0.0,
+                    live_shards=len(self._live), shards=len(self.store.clients))
+
+
+class AsyncHotMatchCache(HotMatchCache):
+    """HotMatchCache over an AsyncShardedStore: the loader is awaited, listeners are tasks."""
+
+    def __init__(self, store, max_entries=HOT_CACHE_SIZE, ttl=HOT_CACHE_TTL):
+        super().__init__(store, max_entries, ttl)
+        self._tasks = set()
+
+    async def get(self, match_id, loader):
+        """Cached state of a match, or await loader() on a miss (cached if it is a MatchState)."""
+        hit, found = self._lookup(match_id)
+        if hit:
+            return found
+        record = await loader()
+        self._fill(match_id, found, record)
+        return record
+
+    def _start_listener(self, node, client):
+        # Started from the first request, so on the loop that serves them
+        task = asyncio.get_running_loop().create_task(self._listen(node, client))
+        self._tasks.add(task)
+
+    async def _listen(self, node, client):
+        while True:
+            pubsub = client.pubsub()
+            try:
+                await pubsub.psubscribe(EVENTS_PATTERN)
+                async for message in pubsub.listen():
+                    self._on_message(node, message)
+            except redis.ConnectionError as e:
+                self._lost(node, e)
+            finally:
+                self._live.discard(node)
+                self.clear()
+                await pubsub.aclose()
+            await asyncio.sleep(RECONNECT_SECONDS)
+
+    async def close(self):
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks.clear()
@@ -0,0 +1,333 @@
+import datetime
+import json
+import struct
+
+# --- COMPACT MATCH STATE ---
+# The deck has 40 cards, so every pile (hand, table, captured) is a 40-bit
+# integer where bit (card_id - 1) is set when the card is in the pile.
+# Only the deck keeps its order, because dealing pops from its end.
+
+# v1: piles only; v2: running score components per player;
+# v3: state version (see MatchState.version) right after the codec byte
+CODEC_VERSION = 3
+MAGIC = 0xE5  # never a valid first byte of a JSON document
+
+ALL_CARDS = (1 << 40) - 1
+OROS_MASK = (1 << 10) - 1
+SETTEBELLO_BIT = 1 << 6
+
+STATUS_CODES = {"active": 1, "finished": 2}
+STATUS_NAMES = {code: name for name, code in STATUS_CODES.items()}
+NO_PLAYER = 0xFF
+
+_HEADER = struct.Struct(">BBIBBBd")  # magic, codec, version, status, turn, last_capture_by, turn_start_time
+_HEADER_V2 = struct.Struct(">BBBBBd")  # magic, codec, status, turn, last_capture_by, turn_start_time
+_VERSION = struct.Struct(">I")
+_VERSION_OFFSET = 2
+_PILES_V1 = struct.Struct(">QQB")    # hand, captured, escobas
+_PILES = struct.Struct(">QQBBBB")    # hand, captured, escobas, cards, oros, settebello
+_TABLE = struct.Struct(">QB")        # table, deck length
+_LEN16 = struct.Struct(">H")
+_LEN32 = struct.Struct(">I")
+
+
+def card_bit(card_id):
+    return 1 << (card_id - 1)
+
+
+def mask_of(card_ids):
+    mask = 0
+    for cid in card_ids:
+        mask |= card_bit(cid)
+    return mask
+
+
+def cards_of(mask):
+    """Card ids in a pile, lowest first."""
+    cards = []
+    while mask:
+        low = mask & -mask
+        cards.append(low.bit_length())
+        mask ^= low
+    return cards
+
+
+def popcount(mask):
+    return mask.bit_count()
+
+
+def utc_timestamp():
+    return datetime.datetime.now(datetime.timezone.utc).timestamp()
+
+
+def utc_isoformat(ts):
+    # Same naive UTC format the frontend timer already parses
+    return datetime.datetime.fromtimestamp(ts, datetime.timezone.utc).replace(tzinfo=None).isoformat()
+
+
+class PlayerState:
+    """One seat. cards/oros/settebello are running score components, kept in
+    step with `captured` by capture() so scoring never rescans the pile."""
+
+    __slots__ = ("name", "hand", "captured", "escobas", "cards", "oros", "settebello")
+
+    def __init__(self, name, hand=0, captured=0, escobas=0, cards=None, oros=None, settebello=None):
+        self.name = name
+        self.hand = hand
+        self.captured = captured
+        self.escobas = escobas
+        if cards is None:
+            self.recount()
+        else:
+            self.cards = cards
+            self.oros = oros
+            self.settebello = settebello
+
+    def capture(self, mask):
+        """Adds cards to the captured pile and updates the score components."""
+        new = mask & ~self.captured
+        self.captured |= new
+        self.cards += popcount(new)
+        self.oros += popcount(new & OROS_MASK)
+        if new & SETTEBELLO_BIT:
+            self.settebello = True
+
+    def recount(self):
+        """Rebuilds the score components from the captured pile."""
+        self.cards = popcount(self.captured)
+        self.oros = popcount(self.captured & OROS_MASK)
+        self.settebello = bool(self.captured & SETTEBELLO_BIT)
+
+    def hand_cards(self):
+        return cards_of(self.hand)
+
+    def to_dict(self):
+        return {
+            "hand": cards_of(self.hand),
+            "captured": cards_of(self.captured),
+            "score_events": ["ESCOBA"] * self.escobas
+        }
+
+
+class MatchState:
+    """Active or finished match. Players keep their seat order (player1 first)."""
+
+    __slots__ = ("match_id", "players", "table", "deck", "turn", "status",
+                 "last_capture_by", "turn_start_time", "result", "version",
+                 "timeouts", "pending_events")
+
+    def __init__(self, match_id, players, table=0, deck=None, turn=0, status="active",
+                 last_capture_by=None, turn_start_time=None, result=None,
+                 version=0, timeouts=None):
+        self.match_id = match_id
+        self.players = players
+        self.table = table
+        self.deck = deck if deck is not None else []
+        self.turn = turn
+        self.status = status
+        self.last_capture_by = last_capture_by
+        self.turn_start_time = turn_start_time if turn_start_time is not None else utc_timestamp()
+        self.result = result
+        # Monotonic, bumped by every move, surrender and expired turn; the ETag of the match
+        self.version = version
+        # Consecutive turns each seat let expire (see game_rules.play_timeout)
+        self.timeouts = list(timeouts) if timeouts else [0, 0]
+        # Move log entries produced since the state was loaded; not part of
+        # the record, they are appended to the match's move log on commit
+        self.pending_events = []
+
+    def log_event(self, *event):
+        self.pending_events.append(list(event))
+
+    def bump_version(self):
+        self.version += 1
+
+    def result_stub(self):
+        """What is kept of a finished match once it is archived: players and result, no piles."""
+        return MatchState(self.match_id, [PlayerState(p.name) for p in self.players],
+                          turn=None, status=self.status, turn_start_time=self.turn_start_time,
+                          result=self.result, version=self.version + 1)
+
+    # --- seats ---
+    def names(self):
+        return [p.name for p in self.players]
+
+    def seat(self, name):
+        """Seat index of a player, or None if the name is not in this match."""
+        for idx, p in enumerate(self.players):
+            if p.name == name:
+                return idx
+        return None
+
+    def player(self, name):
+        idx = self.seat(name)
+        return self.players[idx] if idx is not None else None
+
+    @property
+    def turn_name(self):
+        return self.players[self.turn].name if self.turn is not None else None
+
+    @property
+    def last_capture_name(self):
+        return self.players[self.last_capture_by].name if self.last_capture_by is not None else None
+
+    def table_cards(self):
+        return cards_of(self.table)
+
+    # --- JSON view (API boundary only) ---
+    def to_dict(self):
+        view = {
+            "match_id": self.match_id,
+            "players": {p.name: p.to_dict() for p in self.players},
+            "table": cards_of(self.table),
+            "deck": list(self.deck),
+            "turn": self.turn_name,
+            "status": self.status,
+            "last_capture_by": self.last_capture_name,
+            "turn_start_time": utc_isoformat(self.turn_start_time)
+        }
+        if self.result is not None:
+            view["result"] = self.result
+        return view
+
+    @classmethod
+    def from_dict(cls, doc):
+        """Upgrade a legacy JSON match document to the compact state."""
+        names = list(doc["players"].keys())
+        players = [
+            PlayerState(
+                name,
+                hand=mask_of(doc["players"][name]["hand"]),
+                captured=mask_of(doc["players"][name]["captured"]),
+                escobas=doc["players"][name]["score_events"].count("ESCOBA")
+            )
+            for name in names
+        ]
+        turn_start = doc.get("turn_start_time")
+        try:
+            ts = datetime.datetime.fromisoformat(turn_start).replace(tzinfo=datetime.timezone.utc).timestamp()
+        except (TypeError, ValueError):
+            ts = None
+        return cls(
+            doc["match_id"],
+            players,
+            table=mask_of(doc.get("table", [])),
+            deck=list(doc.get("deck", [])),
+            turn=names.index(doc["turn"]) if doc.get("turn") in names else None,
+            status=doc.get("status", "active"),
+            last_capture_by=names.index(doc["last_capture_by"]) if doc.get("last_capture_by") in names else None,
+            turn_start_time=ts,
+            result=doc.get("result")
+        )
+
+    # --- binary codec ---
+    def encode(self):
+        parts = [_HEADER.pack(
+            MAGIC, CODEC_VERSION, self.version,
+            STATUS_CODES[self.status],
+            NO_PLAYER if self.turn is None else self.turn,
+            NO_PLAYER if self.last_capture_by is None else self.last_capture_by,
+            self.turn_start_time
+        )]
+        parts.append(_pack_str(self.match_id))
+        for p in self.players:
+            parts.append(_pack_str(p.name))
+            parts.append(_PILES.pack(p.hand, p.captured, p.escobas, p.cards, p.oros, p.settebello))
+        parts.append(_TABLE.pack(self.table, len(self.deck)))
+        parts.append(bytes(self.deck))
+
+        extras = {}
+        if self.result is not None: extras["result"] = self.result
+        if any(self.timeouts): extras["timeouts"] = self.timeouts
+        blob = json.dumps(extras, separators=(",", ":")).encode("utf-8") if extras else b""
+        parts.append(_LEN32.pack(len(blob)))
+        parts.append(blob)
+        return b"".join(parts)
+
+    @classmethod
+    def decode(cls, raw):
+        magic, codec = raw[0], raw[1]
+        if magic != MAGIC:
+            raise ValueError("Not an encoded match state")
+        if codec > CODEC_VERSION:
+            raise ValueError(f"Unsupported match state codec {codec}")
+        if codec >= 3:
+            _, _, version, status, turn, last_capture, turn_start = _HEADER.unpack_from(raw, 0)
+            offset = _HEADER.size
+        else:
+            _, _, status, turn, last_capture, turn_start = _HEADER_V2.unpack_from(raw, 0)
+            version = 0
+            offset = _HEADER_V2.size
+        match_id, offset = _unpack_str(raw, offset)
+        players = []
+        for _ in range(2):
+            name, offset = _unpack_str(raw, offset)
+            if codec == 1:
+                # Score components did not exist yet: PlayerState recounts them
+                hand, captured, escobas = _PILES_V1.unpack_from(raw, offset)
+                offset += _PILES_V1.size
+                players.append(PlayerState(name, hand, captured, escobas))
+            else:
+                hand, captured, escobas, cards, oros, settebello = _PILES.unpack_from(raw, offset)
+                offset += _PILES.size
+                players.append(PlayerState(name, hand, captured, escobas, cards, oros, bool(settebello)))
+        table, deck_len = _TABLE.unpack_from(raw, offset)
+        offset += _TABLE.size
+        deck = list(raw[offset:offset + deck_len])
+        offset += deck_len
+        (extras_len,) = _LEN32.unpack_from(raw, offset)
+        offset += _LEN32.size
+        extras = json.loads(raw[offset:offset + extras_len]) if extras_len else {}
+        return cls(
+            match_id,
+            players,
+            table=table,
+            deck=deck,
+            turn=None if turn == NO_PLAYER else turn,
+            status=STATUS_NAMES[status],
+            last_capture_by=None if last_capture == NO_PLAYER else last_capture,
+            turn_start_time=turn_start,
+            result=extras.get("result"),
+            version=version,
+            timeouts=extras.get("timeouts")
+        )
+
+
+def _pack_str(value):
+    data = value.encode("utf-8")
+    return _LEN16.pack(len(data)) + data
+
+
+def _unpack_str(raw, offset):
+    (length,) = _LEN16.unpack_from(raw, offset)
+    offset += _LEN16.size
+    return bytes(raw[offset:offset + length]).decode("utf-8"), offset + length
+
+
+def is_encoded(raw):
+    return bool(raw) and raw[0] == MAGIC
+
+
+def peek_version(raw):
+    """State version of an encoded record without decoding it.
+
+    None for invites and records written before codec v3.
+    """
+    if len(raw) < _HEADER.size or raw[0] != MAGIC or raw[1] < 3:
+        return None
+    return _VERSION.unpack_from(raw, _VERSION_OFFSET)[0]
+
+
+def load_record(raw):
+    """Decode whatever lives under match:{id}.
+
+    Returns a MatchState for active/finished matches and the plain dict for
+    pending invites, which are still stored as small JSON documents.
+    Matches written before the binary codec are upgraded on read.
+    """
+    if is_encoded(raw):
+        return MatchState.decode(raw)
+    doc = json.loads(raw)
+    if "players" in doc:
+        return MatchState.from_dict(doc)
+    return doc
@@ -0,0 +1,381 @@
+import datetime
+import json
+import os
+import uuid
+from collections import namedtuple
+
+from atomic_moves import DEADLINES_KEY, encode_event, move_log_key
+from game_rules import calculate_scores, play_move, play_timeout, surrender, turn_deadline
+from match_state import MatchState, card_bit, load_record, utc_isoformat
+
+# --- SHARED VIEWS AND KEYS ---
+# Everything the Flask app (app.py) and the ASGI app (asgi_app.py) share:
+# settings, key names, request checks, the moves and the JSON views built at
+# the API boundary. No I/O here, so both the sync and the async clients can
+# use it; each app only loads, commits and publishes.
+
+MATCH_TTL = 7200
+INVITE_TTL = 86400
+# Per-user sets of match ids, so /matches/pending never scans all matches
+USER_INDEX_TTL = 86400
+UNINDEXED_PLAYERS = ("CPU", "Guest")
+
+# Server-sent events: idle streams send a comment every SSE_HEARTBEAT seconds
+# and are closed after SSE_MAX_SECONDS (EventSource reconnects by itself)
+SSE_HEARTBEAT = int(os.environ.get('SSE_HEARTBEAT', '15'))
+SSE_MAX_SECONDS = int(os.environ.get('SSE_MAX_SECONDS', '300'))
+# Streams open at once in one gthread worker of app.py: each holds a thread,
+# so past this many a stream is answered 503 and the client polls instead.
+# Keep it below gunicorn's --threads; the ASGI app has no such limit.
+SSE_MAX_STREAMS = int(os.environ.get('SSE_MAX_STREAMS', '24'))
+MATCHMAKING_RETRY_SECONDS = 5
+
+# Reactions and chat: a capped stream per match, next to the match on its shard
+REACTIONS_MAXLEN = int(os.environ.get('REACTIONS_MAXLEN', '50'))
+REACTION_MAX_LENGTH = 200
+
+# GET /matches?ids=...: at most this many ids per request
+MATCH_BATCH_MAX = int(os.environ.get('MATCH_BATCH_MAX', '100'))
+
+# /matches/admin/memory: keys sampled per node with MEMORY USAGE
+MEMORY_SAMPLE_KEYS = int(os.environ.get('MEMORY_SAMPLE_KEYS', '1000'))
+
+def finalize_event(state):
+    """Side effects of a finished match, queued in the outbox with the final state.
+
+    Delivered to history-service and player-service by outbox_worker.py.
+    """
+    result = state.result
+    winner = result['winner']
+    players_list = state.names()
+    return {
+        "match_id": state.match_id,
+        "history": {
+            "match_id": state.match_id,
+            "player1": players_list[0],
+            "player2": players_list[1],
+            "winner": winner if winner != "Draw" else None,
+            "score": result['final_scores'],
+            "log": result['details']
+        },
+        "stats": {
+            p: {"won": p == winner, "score_delta": result['final_scores'].get(p, 0)}
+            for p in players_list if p not in ("CPU", "Guest")
+        }
+    }
+
+def match_key(match_id):
+    return f"match:{match_id}"
+
+def active_index_key(username):
+    return f"user:{username}:matches:active"
+
+def received_index_key(username):
+    return f"user:{username}:invites:received"
+
+def sent_index_key(username):
+    return f"user:{username}:invites:sent"
+
+def index_add(pipe, username, index_key, match_id):
+    if username in UNINDEXED_PLAYERS: return
+    pipe.sadd(index_key, match_id)
+    pipe.expire(index_key, USER_INDEX_TTL)
+
+def match_channel(match_id):
+    return f"match:{match_id}:events"
+
+def reactions_key(match_id):
+    return f"match:{match_id}:reactions"
+
+def reaction_dict(entry_id, fields):
+    reaction = {k.decode(): v.decode() for k, v in fields.items()}
+    reaction["id"] = entry_id.decode()
+    return reaction
+
+def unindex_invite(pipe, invite):
+    pipe.srem(sent_index_key(invite['player1']), invite['match_id'])
+    pipe.srem(received_index_key(invite['player2']), invite['match_id'])
+
+def queue_new_match(pipe, match_state):
+    """Queues the writes of a new match (record, move log, deadline) on a pipeline of its shard."""
+    match_id = match_state.match_id
+    pipe.setex(match_key(match_id), MATCH_TTL, match_state.encode())
+    for event in match_state.pending_events:
+        pipe.xadd(move_log_key(match_id), {'e': encode_event(event)})
+    pipe.expire(move_log_key(match_id), MATCH_TTL)
+    deadline = turn_deadline(match_state)
+    if deadline is not None:
+        pipe.zadd(DEADLINES_KEY, {match_id: deadline})
+
+def reaction_entry(player, content):
+    return {
+        "player": player,
+        "content": content,
+        "timestamp": datetime.datetime.utcnow().isoformat()
+    }
+
+def sse_message(event, data):
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
+
+def key_pattern(key):
+    """Groups keys for memory accounting: ids and usernames become placeholders."""
+    parts = key.split(':')
+    if parts[0] == 'match' and len(parts) > 1:
+        parts[1] = '{id}'
+    elif parts[0] == 'user' and len(parts) > 1:
+        parts[1] = '{username}'
+    elif len(parts) > 2:
+        parts[2:] = ['*']
+    return ':'.join(parts)
+
+def tally_memory(keys, sizes):
+    """{pattern: [keys, bytes]} from MEMORY USAGE replies of sampled keys."""
+    patterns = {}
+    for key, size in zip(keys, sizes):
+        if size is None: continue  # expired meanwhile
+        entry = patterns.setdefault(key_pattern(key), [0, 0])
+        entry[0] += 1
+        entry[1] += size
+    return patterns
+
+def memory_report(samples):
+    """Body of /matches/admin/memory from {node: (dbsize, used_memory, tally_memory(...))}."""
+    report, totals = {}, {}
+    for node, (keys, used_memory, patterns) in samples.items():
+        sampled = sum(count for count, _ in patterns.values())
+        # Scale the sample up to the whole keyspace of the node
+        scale = keys / sampled if sampled else 0
+        report[node] = {
+            "keys": keys,
+            "sampled": sampled,
+            "used_memory": used_memory,
+            "patterns": {p: {"keys": round(c * scale), "bytes": round(b * scale), "avg_bytes": round(b / c)}
+                         for p, (c, b) in sorted(patterns.items())}
+        }
+        for p, stats in report[node]["patterns"].items():
+            entry = totals.setdefault(p, {"keys": 0, "bytes": 0})
+            entry["keys"] += stats["keys"]
+            entry["bytes"] += stats["bytes"]
+
+    # Footprint of one match: its record plus its share of the per-match streams
+    records = totals.get("match:{id}", {}).get("keys", 0)
+    per_match = sum(totals.get(p, {}).get("bytes", 0)
+                    for p in ("match:{id}", "match:{id}:moves", "match:{id}:reactions"))
+    return {
+        "bytes_per_match": round(per_match / records) if records else 0,
+        "patterns": totals,
+        "nodes": report
+    }
+
+def match_view(record, requesting_player):
+    """JSON view of a match for one player, as (body, status code).
+
+    The JSON document is built only here, at the API boundary.
+    """
+    if record is None: return {"error": "Match not found"}, 404
+    if not isinstance(record, MatchState): return record, 200
+    state = record.to_dict()
+    if state['status'] == 'finished': return state, 200
+    
+    players = state['players']
+    
+    # Se è partita locale (Guest), NON nascondere le carte
+    is_local_game = "Guest" in players
+    
+    if not requesting_player and not is_local_game: return state, 200
+    if requesting_player and requesting_player not in players and not is_local_game:
+        return {"error": "Player not in this match"}, 403
+
+    sanitized_state = state.copy()
+    sanitized_state['cards_remaining'] = len(record.deck)
+    current_scores, _ = calculate_scores(record)
+    sanitized_state['current_scores'] = current_scores
+    deadline = turn_deadline(record)
+    if deadline is not None:
+        sanitized_state['turn_deadline'] = utc_isoformat(deadline)
+
+    if not is_local_game:
+        for p_name in players:
+            if p_name != requesting_player:
+                sanitized_state['players'][p_name]['hand'] = ["hidden"] * len(players[p_name]['hand'])
+                sanitized_state.pop('deck', None)
+
+    return sanitized_state, 200
+
+def parse_match_ids(raw):
+    """Ids of ?ids=a,b,c without blanks and duplicates, in request order."""
+    return list(dict.fromkeys(i.strip() for i in (raw or '').split(',') if i.strip()))
+
+def batch_views(match_ids, records, requesting_player):
+    """Body of GET /matches?ids=: views of the readable matches, errors for the others."""
+    matches, errors = {}, {}
+    for match_id, record in zip(match_ids, records):
+        body, status = match_view(record, requesting_player)
+        if status == 200:
+            matches[match_id] = body
+        else:
+            errors[match_id] = body['error']
+    return {"matches": matches, "errors": errors}
+
+def pending_lists(username, match_ids, records):
+    """Body of /matches/pending from the raw records, plus the ids that expired."""
+    active_matches = []
+    invites_received = []
+    invites_sent = []
+    expired = []
+    for match_id, raw in zip(match_ids, records):
+        try:
+            if not raw:
+                expired.append(match_id)
+                continue
+            state = load_record(raw)
+            
+            if isinstance(state, MatchState):
+                if state.status == 'active' and state.seat(username) is not None:
+                    players = state.names()
+                    opponent = players[1] if players[0] == username else players[0]
+                    current_scores, _ = calculate_scores(state)
+                    active_matches.append({
+                        "match_id": state.match_id,
+                        "opponent": opponent,
+                        "turn": state.turn_name,
+                        "scores": current_scores
+                    })
+            elif state.get('status') == 'pending' and state.get('player2') == username:
+                invites_received.append({
+                    "match_id": state['match_id'],
+                    "challenger": state['player1']
+                })
+            elif state.get('status') == 'pending' and state.get('player1') == username:
+                invites_sent.append({
+                    "match_id": state['match_id'],
+                    "opponent": state['player2']
+                })
+        except Exception as e:
+            print(f"Error reading match {match_id}: {e}")
+
+    return {
+        "active": active_matches,
+        "invites_received": invites_received,
+        "invites_sent": invites_sent
+    }, expired
+
+def memory_sample_size(requested):
+    """Keys to sample per node for /matches/admin/memory: 1 to MEMORY_SAMPLE_KEYS."""
+    # The route is reachable through the gateway: a caller can only lower it
+    return min(MEMORY_SAMPLE_KEYS, max(1, requested))
+
+def timer_report(shards):
+    """Body of /matches/admin/timers from {node: {"now": ..., "worker": ...}}."""
+    return {
+        "overdue": sum(s["now"]["overdue"] for s in shards.values()),
+        "scheduled": sum(s["now"]["scheduled"] for s in shards.values()),
+        "shards": shards
+    }
+
+def reactions_limit(requested):
+    return max(1, min(requested, REACTIONS_MAXLEN))
+
+def reactions_body(entries, after):
+    """Body of GET /matches/<id>/reactions from XRANGE entries."""
+    reactions = [reaction_dict(entry_id, fields) for entry_id, fields in entries]
+    return {
+        "reactions": reactions,
+        "last_id": reactions[-1]["id"] if reactions else after
+    }
+
+# --- REQUEST CHECKS ---
+# Each returns the error response as (body, status), or None when the
+# request may go on.
+
+def players_error(player1, player2):
+    if not player1 or not player2: return {"error": "Two players required"}, 400
+    return None
+
+def new_invite(player1, player2):
+    return {"match_id": str(uuid.uuid4()), "player1": player1, "player2": player2, "status": "pending"}
+
+def invite_answer_error(record, player, accepting):
+    """Checks an accept (only the invited player) or a reject (either player) of an invite."""
+    if record is None: return {"error": "Invite not found"}, 404
+    if accepting:
+        if isinstance(record, MatchState) or record['status'] != 'pending': return {"error": "Match already active"}, 400
+        if record['player2'] != player: return {"error": "Not authorized"}, 403
+    else:
+        if isinstance(record, MatchState): return {"error": "Match already active"}, 400
+        if record['player2'] != player and record['player1'] != player:
+            return {"error": "Not authorized"}, 403
+    return None
+
+def batch_ids_error(match_ids):
+    if not match_ids:
+        return {"error": "ids required"}, 400
+    if len(match_ids) > MATCH_BATCH_MAX:
+        return {"error": f"At most {MATCH_BATCH_MAX} ids per request"}, 400
+    return None
+
+def reaction_error(reaction):
+    if not isinstance(reaction, str) or not reaction or len(reaction) > REACTION_MAX_LENGTH:
+        return {"error": f"Reaction must be 1-{REACTION_MAX_LENGTH} characters"}, 400
+    return None
+
+def reactor_error(record, player):
+    """Only the players of an active match react."""
+    if record is None: return {"error": "Match not found"}, 404
+    if not isinstance(record, MatchState) or record.status != 'active': return {"error": "Match finished/pending"}, 400
+    if record.seat(player) is None: return {"error": "Player not in this match"}, 403
+    return None
+
+# --- MOVES ---
+# A move applied to the record just loaded. `state` is the record to commit
+# (compare-and-set against the raw bytes it came from) before answering
+# `body`; None means nothing to write. `deadline` tells, for an answer
+# without a write, where the match's turn deadline goes: False leaves it, None
+# removes it, a timestamp puts it back.
+
+MoveOutcome = namedtuple('MoveOutcome', 'body status state deadline', defaults=(None, False))
+
+def play_card_move(record, player, card_id):
+    if record is None: return MoveOutcome({"error": "Match not found"}, 404)
+    if not isinstance(record, MatchState) or record.status != 'active': return MoveOutcome({"error": "Match finished/pending"}, 400)
+    if record.turn_name != player: return MoveOutcome({"error": "Not your turn"}, 400)
+    seat = record.turn
+    if not isinstance(card_id, int) or not 1 <= card_id <= 40 or not record.players[seat].hand & card_bit(card_id):
+        return MoveOutcome({"error": "Card not in hand"}, 400)
+
+    captured_cards, escoba, message, finished = play_move(record, seat, card_id)
+    record.bump_version()
+    response = {
+        "message": message,
+        "captured": captured_cards,
+        "escoba": escoba,
+        "state_snapshot": {"table": record.table_cards(), "your_hand": record.players[seat].hand_cards()}
+    }
+    if record.status == 'finished':
+        response['final_result'] = record.result
+    return MoveOutcome(response, 200, record)
+
+def surrender_move(record, player):
+    if record is None: return MoveOutcome({"error": "Match not found"}, 404)
+    if not isinstance(record, MatchState) or record.status != 'active': return MoveOutcome({"error": "Match finished"}, 400)
+    seat = record.seat(player)
+    if seat is None: return MoveOutcome({"error": "Player not in this match"}, 403)
+
+    winner = surrender(record, seat)['winner']
+    record.bump_version()
+    return MoveOutcome({"message": "Match surrendered", "winner": winner}, 200, record)
+
+def timeout_move(record, now):
+    """Auto-plays or forfeits a turn whose deadline passed (POST /matches/<id>/timeout)."""
+    if not isinstance(record, MatchState) or record.status != 'active':
+        return MoveOutcome({"result": "gone"}, 200, deadline=None)
+
+    # The turn may have moved on since the entry was claimed: put the
+    # real deadline back (the claim pushed it ahead by a lease)
+    deadline = turn_deadline(record)
+    if deadline is None or deadline > now:
+        return MoveOutcome({"result": "not_due"}, 200, deadline=deadline)
+
+    message, finished, forfeited = play_timeout(record)
+    record.bump_version()
+    return MoveOutcome({"result": "forfeited" if forfeited else "autoplayed", "message": message}, 200, record)
@@ -0,0 +1,274 @@
+import os
+import time
+from collections import namedtuple
+
+import httpx
+import requests
+
+# --- MATCHMAKING ---
+# Waiting players live in one sorted set per rating bucket (score = join
+# time in ms) plus a hash username -> "bucket:joined_ms", so membership and
+# status checks are O(1). Pairing runs in a Lua script: it looks at the
+# oldest player of the nearest buckets only, so its cost depends on the
+# number of buckets, never on the queue length. The bucket range a player
+# accepts widens the longer they wait; a waiting player's range is applied
+# when someone joins, and when the player asks for a retry (POST
+# /matchmaking/retry). Status reads never pair.
+#
+# Matchmaking keys are global; they all live on the node `client` points to.
+
+PLAYER_SERVICE_URL = "https://player-service:5000/players"
+
+MEMBERS_KEY = "matchmaking:members"
+BUCKET_KEY_PREFIX = "matchmaking:bucket:"
+RESULT_KEY_PREFIX = "matchmaking:user:"
+RATING_KEY_PREFIX = "matchmaking:rating:"
+
+NUM_BUCKETS = int(os.environ.get('MATCHMAKING_BUCKETS', '10'))
+BASE_WIDTH = int(os.environ.get('MATCHMAKING_BASE_WIDTH', '1'))
+MAX_WIDTH = int(os.environ.get('MATCHMAKING_MAX_WIDTH', str(NUM_BUCKETS - 1)))
+WIDEN_EVERY_MS = int(os.environ.get('MATCHMAKING_WIDEN_EVERY_MS', '10000'))
+RESULT_TTL = 60
+RATING_TTL = 300
+PENDING = "pending"
+
+# KEYS[1]     members hash
+# KEYS[2..]   bucket sorted sets, bucket b is KEYS[b + 2]
+# ARGV[1]     player
+# ARGV[2]     player's bucket
+# ARGV[3]     now (ms)
+# ARGV[4..6]  base width, max width, ms of waiting per extra bucket
+# ARGV[7]     result key prefix, ARGV[8] result ttl, ARGV[9] pending marker
+# ARGV[10]    "1" to pair the player only if already queued (a retry)
+# Returns {opponent, opponent's "bucket:joined_ms", player's "bucket:joined_ms"},
+# or false when the player was queued (or, on a retry, was not in the queue).
+PAIR_LUA = """
+local player = ARGV[1]
+local bucket = tonumber(ARGV[2])
+local now = tonumber(ARGV[3])
+local base_width = tonumber(ARGV[4])
+local max_width = tonumber(ARGV[5])
+local widen_ms = tonumber(ARGV[6])
+local num_buckets = #KEYS - 1
+
+local function width(joined)
+    return math.min(max_width, base_width + math.floor((now - joined) / widen_ms))
+end
+
+local joined = now
+local existing = redis.call('HGET', KEYS[1], player)
+if not existing and ARGV[10] == '1' then
+    return false
+end
+if existing then
+    local sep = string.find(existing, ':')
+    local old_bucket = tonumber(string.sub(existing, 1, sep - 1))
+    joined = tonumber(string.sub(existing, sep + 1))
+    redis.call('ZREM', KEYS[old_bucket + 2], player)
+end
+local my_width = width(joined)
+
+for d = 0, max_width do
+    local candidates = {bucket - d}
+    if d > 0 then candidates[2] = bucket + d end
+    for _, b in ipairs(candidates) do
+        if b >= 0 and b < num_buckets then
+            local oldest = redis.call('ZRANGE', KEYS[b + 2], 0, 0, 'WITHSCORES')
+            if #oldest > 0 and d <= math.max(my_width, width(tonumber(oldest[2]))) then
+                local opponent = oldest[1]
+                redis.call('ZREM', KEYS[b + 2], opponent)
+                redis.call('HDEL', KEYS[1], opponent, player)
+                redis.call('SET', ARGV[7] .. opponent, ARGV[9], 'EX', ARGV[8])
+                redis.call('SET', ARGV[7] .. player, ARGV[9], 'EX', ARGV[8])
+                return {opponent, b .. ':' .. oldest[2], bucket .. ':' .. joined}
+            end
+        end
+    end
+end
+
+redis.call('ZADD', KEYS[bucket + 2], joined, player)
+redis.call('HSET', KEYS[1], player, bucket .. ':' .. joined)
+return false
+"""
+
+# KEYS[1] members hash, KEYS[2..] bucket sorted sets; ARGV[1] player
+LEAVE_LUA = """
+local existing = redis.call('HGET', KEYS[1], ARGV[1])
+if not existing then return 0 end
+local bucket = tonumber(string.sub(existing, 1, string.find(existing, ':') - 1))
+redis.call('ZREM', KEYS[bucket + 2], ARGV[1])
+redis.call('HDEL', KEYS[1], ARGV[1])
+return 1
+"""
+
+
+def bucket_key(bucket):
+    return f"{BUCKET_KEY_PREFIX}{bucket}"
+
+
+def result_key(username):
+    return f"{RESULT_KEY_PREFIX}{username}"
+
+
+def matchmaking_channel(username):
+    return f"{RESULT_KEY_PREFIX}{username}:events"
+
+
+def _text(value):
+    return value.decode() if isinstance(value, bytes) else value
+
+
+def rating_to_bucket(stats):
+    rate = (stats.get('matches_won', 0) + 1) / (stats.get('matches_played', 0) + 2)
+    return min(NUM_BUCKETS - 1, int(rate * NUM_BUCKETS))
+
+
+def pair_arguments(username, bucket, queued_only):
+    return [
+        username, bucket, int(time.time() * 1000),
+        BASE_WIDTH, MAX_WIDTH, WIDEN_EVERY_MS,
+        RESULT_KEY_PREFIX, RESULT_TTL, PENDING, '1' if queued_only else '0'
+    ]
+
+
+# Two players taken out of the queue by PAIR_LUA; entries holds the
+# "bucket:joined_ms" of both, to put them back if the match cannot be created
+Pairing = namedtuple('Pairing', 'opponent entries')
+
+
+def pairing(username, reply):
+    if not reply:
+        return None
+    opponent, opponent_entry, entry = (_text(value) for value in reply)
+    return Pairing(opponent, {opponent: opponent_entry, username: entry})
+
+
+def requeue_commands(pipe, entries):
+    for username, entry in entries.items():
+        bucket, joined = entry.split(":", 1)
+        pipe.zadd(bucket_key(int(bucket)), {username: float(joined)})
+        pipe.hset(MEMBERS_KEY, username, entry)
+        pipe.delete(result_key(username))
+
+
+class Matchmaker:
+    def __init__(self, client, session=None):
+        self.client = client
+        self.session = session or requests.Session()
+        self.pair_script = client.register_script(PAIR_LUA)
+        self.leave_script = client.register_script(LEAVE_LUA)
+        self.keys = [MEMBERS_KEY] + [bucket_key(b) for b in range(NUM_BUCKETS)]
+
+    # --- rating ---
+    def rating_bucket(self, username):
+        """Bucket of a player's win rate, cached for a few minutes.
+
+        The rate is smoothed ((won + 1) / (played + 2)) so new players start in
+        the middle instead of next to players who lost every game.
+        """
+        cached = self.client.get(f"{RATING_KEY_PREFIX}{username}")
+        if cached is not None:
+            return int(cached)
+        bucket = NUM_BUCKETS // 2
+        try:
+            resp = self.session.get(f"{PLAYER_SERVICE_URL}/{username}", timeout=2, verify=False)
+            if resp.status_code == 200:
+                bucket = rating_to_bucket(resp.json())
+        except (requests.RequestException, ValueError) as e:
+            print(f"Error fetching rating for {username}: {e}")
+        self.client.setex(f"{RATING_KEY_PREFIX}{username}", RATING_TTL, bucket)
+        return bucket
+
+    # --- queue ---
+    def queued_bucket(self, username):
+        entry = self.client.hget(MEMBERS_KEY, username)
+        if entry is None:
+            return None
+        return int(_text(entry).split(":", 1)[0])
+
+    def try_pair(self, username, bucket, queued_only=False):
+        """Pairs `username` atomically or (re)queues them. Returns a Pairing or None.
+
+        With queued_only, a player who is no longer queued (paired meanwhile,
+        or gone) is left out instead of being queued again.
+        """
+        reply = self.pair_script(keys=self.keys, args=pair_arguments(username, bucket, queued_only))
+        return pairing(username, reply)
+
+    def requeue(self, entries):
+        """Puts the players of a Pairing back in the queue as they were, without the pending marker."""
+        with self.client.pipeline() as pipe:
+            requeue_commands(pipe, entries)
+            pipe.execute()
+
+    def leave(self, username):
+        self.leave_script(keys=self.keys, args=[username])
+
+    # --- results ---
+    def result(self, username):
+        """Match id the player was paired into, PENDING while it is created, or None."""
+        return _text(self.client.get(result_key(username)))
+
+    def clear_result(self, username):
+        self.client.delete(result_key(username))
+
+    def record_match(self, player1, player2, match_id):
+        with self.client.pipeline() as pipe:
+            pipe.setex(result_key(player1), RESULT_TTL, match_id)
+            pipe.setex(result_key(player2), RESULT_TTL, match_id)
+            pipe.publish(matchmaking_channel(player1), match_id)
+            pipe.publish(matchmaking_channel(player2), match_id)
+            pipe.execute()
+
+
+class AsyncMatchmaker(Matchmaker):
+    """Matchmaker over a redis.asyncio client, fetching ratings with httpx (asgi_app.py)."""
+
+    def __init__(self, client, session=None):
+        super().__init__(client, session or httpx.AsyncClient(verify=False, timeout=2))
+
+    async def rating_bucket(self, username):
+        cached = await self.client.get(f"{RATING_KEY_PREFIX}{username}")
+        if cached is not None:
+            return int(cached)
+        bucket = NUM_BUCKETS // 2
+        try:
+            resp = await self.session.get(f"{PLAYER_SERVICE_URL}/{username}")
+            if resp.status_code == 200:
+                bucket = rating_to_bucket(resp.json())
+        except (httpx.HTTPError, ValueError) as e:
+            print(f"Error fetching rating for {username}: {e}")
+        await self.client.setex(f"{RATING_KEY_PREFIX}{username}", RATING_TTL, bucket)
+        return bucket
+
+    async def queued_bucket(self, username):
+        entry = await self.client.hget(MEMBERS_KEY, username)
+        if entry is None:
+            return None
+        return int(_text(entry).split(":", 1)[0])
+
+    async def try_pair(self, username, bucket, queued_only=False):
+        reply = await self.pair_script(keys=self.keys, args=pair_arguments(username, bucket, queued_only))
+        return pairing(username, reply)
+
+    async def requeue(self, entries):
+        async with self.client.pipeline() as pipe:
+            requeue_commands(pipe, entries)
+            await pipe.execute()
+
+    async def leave(self, username):
+        await self.leave_script(keys=self.keys, args=[username])
+
+    async def result(self, username):
+        return _text(await self.client.get(result_key(username)))
+
+    async def clear_result(self, username):
+        await self.client.delete(result_key(username))
+
+    async def record_match(self, player1, player2, match_id):
+        async with self.client.pipeline() as pipe:
+            pipe.setex(result_key(player1), RESULT_TTL, match_id)
+            pipe.setex(result_key(player2), RESULT_TTL, match_id)
+            pipe.publish(matchmaking_channel(player1), match_id)
+            pipe.publish(matchmaking_channel(player2), match_id)
+            await pipe.execute()
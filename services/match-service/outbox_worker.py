@@ -0,0 +1,260 @@
+import json
+import os
+import socket
+import threading
+import time
+
+import redis
+import requests
+from requests.adapters import HTTPAdapter
+from requests.packages.urllib3.exceptions import InsecureRequestWarning
+
+from atomic_moves import OUTBOX_KEY, move_log_key
+from match_state import MatchState, load_record
+from sharded_store import connect, nodes_from_env
+
+requests.packages.urllib3.disable_warnings(InsecureRequestWarning)
+
+# --- OUTBOX WORKER ---
+# Drains the finalize outbox written by match-service together with the
+# final state of a match: one history record (with the match's move log)
+# and one stats update per real player. Entries are acked only once every
+# side effect went through; the rest stay pending in the consumer group and
+# are retried with backoff. Every shard has its own outbox, drained by its
+# own thread.
+#
+# Once a match is archived its record is compacted: piles, deck and move log
+# are dropped and only a result stub (players, result) is kept, for
+# FINISHED_MATCH_TTL seconds instead of the full MATCH_TTL.
+#
+# Delivered stats change the leaderboard the api-gateway caches, so the
+# worker then asks the gateway to purge it (and any cached copy of the
+# archived matches) over the gateway cache's Redis channel, see
+# api-gateway/response_cache.py. Without GATEWAY_CACHE_REDIS_URL the cached
+# entries only expire by their TTL.
+
+HISTORY_BATCH_URL = "https://history-service:5000/history/matches/batch"
+PLAYER_SERVICE_URL = "https://player-service:5000/players"
+
+OUTBOX_GROUP = "finalize-deliverers"
+DEAD_LETTER_KEY = "outbox:finalize:dead"
+
+BATCH_SIZE = int(os.environ.get('OUTBOX_BATCH_SIZE', '50'))
+BLOCK_MS = int(os.environ.get('OUTBOX_BLOCK_MS', '2000'))
+MAX_DELIVERIES = int(os.environ.get('OUTBOX_MAX_DELIVERIES', '10'))
+RETRY_BASE = float(os.environ.get('OUTBOX_RETRY_BASE', '1.0'))
+RETRY_CAP = float(os.environ.get('OUTBOX_RETRY_CAP', '300'))
+REQUEST_TIMEOUT = float(os.environ.get('OUTBOX_REQUEST_TIMEOUT', '5'))
+FINISHED_MATCH_TTL = int(os.environ.get('FINISHED_MATCH_TTL', '600'))
+GATEWAY_CACHE_REDIS_URL = os.environ.get('GATEWAY_CACHE_REDIS_URL')
+GATEWAY_PURGE_CHANNEL = "gwcache:purge"
+
+
+def retry_delay(times_delivered):
+    """Seconds an entry must sit pending before delivery attempt n + 1."""
+    return min(RETRY_CAP, RETRY_BASE * (2 ** (times_delivered - 1)))
+
+
+def stats_idempotency_key(match_id, player):
+    return f"{match_id}:stats:{player}"
+
+
+def compact_match(records, match_id, ttl=FINISHED_MATCH_TTL):
+    """Replaces an archived finished match with its result stub. Returns True if compacted.
+
+    `records` is a binary client of the match's shard (the state is not UTF-8).
+    """
+    key = f"match:{match_id}"
+    with records.pipeline() as pipe:
+        try:
+            pipe.watch(key)
+            raw = pipe.get(key)
+            state = load_record(raw) if raw else None
+            if not isinstance(state, MatchState) or state.status != 'finished':
+                return False
+            pipe.multi()
+            pipe.set(key, state.result_stub().encode(), ex=ttl)
+            pipe.delete(move_log_key(match_id), f"{key}:reactions")
+            # Hot caches of match-service drop their copy
+            pipe.publish(f"{key}:events", json.dumps({"type": "compacted"}))
+            pipe.execute()
+            return True
+        except redis.WatchError:
+            # Only rebalance.py touches a finished match: leave it alone
+            return False
+
+
+class OutboxWorker:
+    def __init__(self, client, session=None, consumer=None, records=None, gateway_cache=None):
+        self.client = client
+        # Redis of the gateway's response cache, for the purge messages
+        if gateway_cache is None and GATEWAY_CACHE_REDIS_URL:
+            gateway_cache = redis.Redis.from_url(GATEWAY_CACHE_REDIS_URL, socket_timeout=1)
+        self.gateway_cache = gateway_cache
+        # Binary client of the same node, for the encoded match states
+        self.records = records
+        self.consumer = consumer or f"{socket.gethostname()}-{os.getpid()}"
+        # Where retry_pending goes on reading the pending entries
+        self.pending_cursor = '-'
+        if session is None:
+            # One keep-alive session for every delivery of this worker
+            session = requests.Session()
+            session.mount("https://", HTTPAdapter(pool_connections=2, pool_maxsize=4))
+            session.verify = False
+        self.session = session
+
+    def ensure_group(self):
+        try:
+            self.client.xgroup_create(OUTBOX_KEY, OUTBOX_GROUP, id='0', mkstream=True)
+        except redis.ResponseError as e:
+            if "BUSYGROUP" not in str(e):
+                raise
+
+    def run_forever(self):
+        self.ensure_group()
+        print(f"Outbox worker {self.consumer} draining {OUTBOX_KEY}")
+        while True:
+            try:
+                self.poll_once()
+            except redis.ConnectionError as e:
+                print(f"Redis unavailable: {e}")
+                time.sleep(1)
+
+    def poll_once(self):
+        entries = self.client.xreadgroup(OUTBOX_GROUP, self.consumer, {OUTBOX_KEY: '>'},
+                                         count=BATCH_SIZE, block=BLOCK_MS)
+        for _, messages in entries or []:
+            self.deliver_batch(messages)
+        self.retry_pending()
+
+    def retry_pending(self):
+        """Re-delivers pending entries whose backoff expired, dead-letters the hopeless ones.
+
+        The pending entries are read a page at a time from where the previous
+        call stopped, until BATCH_SIZE of them are due or the end is reached
+        (the next call then starts over), so entries that keep failing at the
+        head cannot hold back the retries of those behind them.
+        """
+        due, dead = [], []
+        while len(due) < BATCH_SIZE:
+            page = self.client.xpending_range(OUTBOX_KEY, OUTBOX_GROUP, min=self.pending_cursor, max='+',
+                                              count=BATCH_SIZE)
+            for entry in page:
+                if entry['time_since_delivered'] < retry_delay(entry['times_delivered']) * 1000:
+                    continue
+                if entry['times_delivered'] >= MAX_DELIVERIES:
+                    dead.append(entry['message_id'])
+                else:
+                    due.append(entry['message_id'])
+            if len(page) < BATCH_SIZE:
+                self.pending_cursor = '-'
+                break
+            self.pending_cursor = f"({page[-1]['message_id']}"
+
+        if dead:
+            for message_id, fields in self.client.xclaim(OUTBOX_KEY, OUTBOX_GROUP, self.consumer, 0, dead):
+                self.client.xadd(DEAD_LETTER_KEY, fields)
+                self.client.xack(OUTBOX_KEY, OUTBOX_GROUP, message_id)
+                print(f"Outbox entry {message_id} moved to {DEAD_LETTER_KEY}")
+        if due:
+            self.deliver_batch(self.client.xclaim(OUTBOX_KEY, OUTBOX_GROUP, self.consumer, 0, due))
+
+    def deliver_batch(self, messages):
+        events = []
+        for message_id, fields in messages:
+            if not fields:
+                # Trimmed from the stream before it could be delivered
+                self.client.xack(OUTBOX_KEY, OUTBOX_GROUP, message_id)
+                continue
+            events.append((message_id, json.loads(fields['event'])))
+        if not events:
+            return
+
+        # History records of the whole batch go in a single request;
+        # history-service ignores match ids it already stored.
+        self.attach_move_logs(events)
+        history_ok = self.post_history([event['history'] for _, event in events])
+
+        delivered = []
+        for message_id, event in events:
+            if history_ok and self.put_stats(event):
+                delivered.append(message_id)
+        if delivered:
+            self.client.xack(OUTBOX_KEY, OUTBOX_GROUP, *delivered)
+            # Archived: only the result stays in Redis
+            for message_id, event in events:
+                if message_id in delivered:
+                    self.compact(event['match_id'])
+            self.purge_gateway_cache([event for message_id, event in events if message_id in delivered])
+
+    def compact(self, match_id):
+        if self.records is None or not compact_match(self.records, match_id):
+            # The move log is archived in any case
+            self.client.delete(move_log_key(match_id))
+
+    def purge_gateway_cache(self, events):
+        """Drops the gateway's cached leaderboard and archived matches that these deliveries changed."""
+        if self.gateway_cache is None:
+            return
+        purges = [{"policy": "history_match", "prefix": f"/history/match/{event['match_id']}"} for event in events]
+        if any(event['stats'] for event in events):
+            purges.append({"policy": "leaderboard", "prefix": "/players/leaderboard"})
+        try:
+            with self.gateway_cache.pipeline(transaction=False) as pipe:
+                for purge in purges:
+                    pipe.publish(GATEWAY_PURGE_CHANNEL, json.dumps(purge))
+                pipe.execute()
+        except redis.RedisError as e:
+            # The entries still expire by their TTL
+            print(f"Gateway cache purge failed: {e}")
+
+    def attach_move_logs(self, events):
+        with self.client.pipeline(transaction=False) as pipe:
+            for _, event in events:
+                pipe.xrange(move_log_key(event['match_id']))
+            logs = pipe.execute()
+        for (_, event), log in zip(events, logs):
+            event['history']['moves'] = [json.loads(fields['e']) for _, fields in log]
+
+    def post_history(self, records):
+        try:
+            resp = self.session.post(HISTORY_BATCH_URL, json=records, timeout=REQUEST_TIMEOUT)
+            if resp.status_code in (200, 201):
+                return True
+            print(f"History Service rejected batch: {resp.status_code} {resp.text}")
+        except requests.RequestException as e:
+            print(f"Error contacting History Service: {e}")
+        return False
+
+    def put_stats(self, event):
+        ok = True
+        for player, payload in event['stats'].items():
+            try:
+                resp = self.session.put(
+                    f"{PLAYER_SERVICE_URL}/{player}/stats",
+                    json=payload,
+                    headers={"Idempotency-Key": stats_idempotency_key(event['match_id'], player)},
+                    timeout=REQUEST_TIMEOUT
+                )
+                # A missing profile will never appear by retrying
+                if resp.status_code not in (200, 404):
+                    print(f"Player Service rejected stats for {player}: {resp.status_code}")
+                    ok = False
+            except requests.RequestException as e:
+                print(f"Error contacting Player Service for {player}: {e}")
+                ok = False
+        return ok
+
+
+if __name__ == '__main__':
+    threads = [
+        threading.Thread(
+            target=OutboxWorker(connect(node, decode_responses=True),
+                                consumer=f"{socket.gethostname()}-{os.getpid()}-{node}",
+                                records=connect(node)).run_forever,
+            name=f"outbox-{node}"
+        )
+        for node in nodes_from_env()
+    ]
+    for t in threads: t.start()
+    for t in threads: t.join()
@@ -0,0 +1,116 @@
+"""Moves match keys to the shard that owns them after REDIS_NODES changed.
+
+    python rebalance.py --from redis-0:6379 --to redis-0:6379,redis-1:6379 --dry-run
+    python rebalance.py --from redis-0:6379 --to redis-0:6379,redis-1:6379
+
+Every node of --from and --to is scanned for match:{id} records; the ones
+whose owner on the new ring is another node are copied there (record, move
+log, reactions and turn deadline) with DUMP/RESTORE and then deleted from
+the source. The delete runs in a WATCH/MULTI transaction on the source
+record, so a match that was written while being copied is copied again.
+
+Run it while match-service is stopped, or restart match-service with the
+new REDIS_NODES right after it: until then, moved matches are looked up on
+their old node. Nodes being removed keep their outbox stream until the
+outbox worker drained it.
+"""
+import argparse
+
+import redis
+
+from atomic_moves import DEADLINES_KEY, OUTBOX_KEY, move_log_key
+from sharded_store import HashRing, connect
+
+MATCH_KEY_PREFIX = "match:"
+SCAN_COUNT = 500
+MAX_COPY_ATTEMPTS = 5
+
+
+def match_ids(client):
+    """Ids of the match records on a node (SCAN, not KEYS: the node stays responsive)."""
+    for key in client.scan_iter(match=f"{MATCH_KEY_PREFIX}*", count=SCAN_COUNT):
+        match_id = key.decode()[len(MATCH_KEY_PREFIX):]
+        # match:{id}:moves and other per-match keys travel with the record
+        if ":" not in match_id:
+            yield match_id
+
+
+def copy_key(source, target, key):
+    dump = source.dump(key)
+    if dump is None:
+        target.delete(key)
+        return
+    ttl = source.pttl(key)
+    target.restore(key, ttl if ttl > 0 else 0, dump, replace=True)
+
+
+def move_match(source, target, match_id):
+    """Copies a match to `target`, then deletes it from `source` if it did not change meanwhile."""
+    match_key = f"{MATCH_KEY_PREFIX}{match_id}"
+    log_key = move_log_key(match_id)
+    reactions_key = f"{match_key}:reactions"
+    for _ in range(MAX_COPY_ATTEMPTS):
+        with source.pipeline() as pipe:
+            try:
+                pipe.watch(match_key)
+                copy_key(source, target, match_key)
+                copy_key(source, target, log_key)
+                copy_key(source, target, reactions_key)
+                deadline = source.zscore(DEADLINES_KEY, match_id)
+                if deadline is not None:
+                    target.zadd(DEADLINES_KEY, {match_id: deadline})
+                pipe.multi()
+                pipe.delete(match_key, log_key, reactions_key)
+                pipe.zrem(DEADLINES_KEY, match_id)
+                pipe.execute()
+                return True
+            except redis.WatchError:
+                continue
+    return False
+
+
+def rebalance(old_nodes, new_nodes, dry_run=False):
+    ring = HashRing(new_nodes)
+    clients = {node: connect(node) for node in dict.fromkeys(old_nodes + new_nodes)}
+    moved, failed, seen = {}, [], set()
+
+    for node in dict.fromkeys(old_nodes + new_nodes):
+        source = clients[node]
+        for match_id in list(match_ids(source)):
+            owner = ring.node_for(match_id)
+            seen.add(match_id)
+            if owner == node:
+                continue
+            if dry_run or move_match(source, clients[owner], match_id):
+                moved[(node, owner)] = moved.get((node, owner), 0) + 1
+            else:
+                failed.append(match_id)
+    kept = len(seen) - sum(moved.values()) - len(failed)
+
+    for (src, dst), count in sorted(moved.items()):
+        print(f"{src} -> {dst}: {count} matches{' (dry run)' if dry_run else ''}")
+    print(f"{kept} matches already on their shard, {len(failed)} failed")
+    for match_id in failed:
+        print(f"  busy, not moved: {match_id}")
+
+    for node in old_nodes:
+        if node not in new_nodes:
+            print(f"{node} leaves the ring: {clients[node].xlen(OUTBOX_KEY)} outbox entries, "
+                  f"{clients[node].zcard(DEADLINES_KEY)} deadlines still to drain")
+    return not failed
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Rebalance match keys across Redis shards")
+    parser.add_argument("--from", dest="old", required=True, help="current REDIS_NODES")
+    parser.add_argument("--to", dest="new", required=True, help="new REDIS_NODES")
+    parser.add_argument("--dry-run", action="store_true", help="only report what would move")
+    args = parser.parse_args()
+
+    split = lambda value: [n.strip() for n in value.split(",") if n.strip()]
+    ok = rebalance(split(args.old), split(args.new), args.dry_run)
+    raise SystemExit(0 if ok else 1)
+
+
+if __name__ == '__main__':
+    main()
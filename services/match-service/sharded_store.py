@@ -0,0 +1,114 @@
+import asyncio
+import bisect
+import hashlib
+import os
+
+import redis
+import redis.asyncio
+
+# --- SHARDED MATCH STORE ---
+# Every key of a match (match:{id}, match:{id}:moves, match:{id}:reactions,
+# the match:{id}:events channel) lives on the node the match id hashes to on
+# a consistent-hash ring over REDIS_NODES. Scripts, pipelines and WATCH/MULTI
+# transactions on one match therefore always run against a single node. The shard-wide keys the
+# commit script writes next to the state (stats:moves, outbox:finalize,
+# deadlines:turns) exist on every node under the same name, so each shard
+# has its own outbox and deadlines, drained by one worker thread per node.
+#
+# Adding or removing a node moves only the matches whose ring segment
+# changes owner; rebalance.py migrates them.
+
+VNODES = int(os.environ.get('REDIS_VNODES', '160'))
+
+
+def nodes_from_env():
+    """REDIS_NODES="host:port,host:port"; defaults to the single REDIS_HOST node."""
+    raw = os.environ.get('REDIS_NODES') or f"{os.environ.get('REDIS_HOST', 'redis')}:6379"
+    return [node.strip() for node in raw.split(",") if node.strip()]
+
+
+def ring_hash(value):
+    # Stable across processes, unlike hash()
+    return int.from_bytes(hashlib.md5(value.encode("utf-8")).digest()[:8], "big")
+
+
+def connect(node, **kwargs):
+    host, _, port = node.rpartition(":")
+    return redis.Redis(host=host, port=int(port), db=0, **kwargs)
+
+
+def connect_async(node, **kwargs):
+    host, _, port = node.rpartition(":")
+    return redis.asyncio.Redis(host=host, port=int(port), db=0, **kwargs)
+
+
+class HashRing:
+    def __init__(self, nodes, vnodes=VNODES):
+        if not nodes:
+            raise ValueError("At least one Redis node is required")
+        self.nodes = list(nodes)
+        points = sorted((ring_hash(f"{node}#{i}"), node) for node in self.nodes for i in range(vnodes))
+        self._hashes = [h for h, _ in points]
+        self._owners = [node for _, node in points]
+
+    def node_for(self, match_id):
+        idx = bisect.bisect(self._hashes, ring_hash(match_id)) % len(self._hashes)
+        return self._owners[idx]
+
+
+class ShardedStore:
+    """Binary Redis clients for the match keys, routed by match id."""
+
+    connect = staticmethod(connect)
+
+    def __init__(self, nodes=None, vnodes=VNODES, **client_kwargs):
+        self.ring = HashRing(nodes or nodes_from_env(), vnodes)
+        self.clients = {node: self.connect(node, **client_kwargs) for node in self.ring.nodes}
+
+    @property
+    def nodes(self):
+        return self.ring.nodes
+
+    def node_for(self, match_id):
+        return self.ring.node_for(match_id)
+
+    def client(self, match_id):
+        return self.clients[self.ring.node_for(match_id)]
+
+    def pipeline(self, match_id, transaction=True):
+        """Pipeline (MULTI/EXEC, WATCH) on the shard of `match_id`."""
+        return self.client(match_id).pipeline(transaction=transaction)
+
+    def group(self, match_ids):
+        """{node: [match ids]} preserving the order of `match_ids` within a node."""
+        groups = {}
+        for match_id in match_ids:
+            groups.setdefault(self.ring.node_for(match_id), []).append(match_id)
+        return groups
+
+    def mget(self, match_ids, key_fn):
+        """Values of key_fn(id) for every id, one MGET per shard, in input order."""
+        values = {}
+        for node, ids in self.group(match_ids).items():
+            values.update(zip(ids, self.clients[node].mget([key_fn(m) for m in ids])))
+        return [values[m] for m in match_ids]
+
+
+class AsyncShardedStore(ShardedStore):
+    """Same routing over redis.asyncio clients (asgi_app.py); pipelines are used with `async with`."""
+
+    connect = staticmethod(connect_async)
+
+    async def mget(self, match_ids, key_fn):
+        """Values of key_fn(id) for every id, the shards' MGETs run concurrently, in input order."""
+        groups = self.group(match_ids)
+        replies = await asyncio.gather(*(self.clients[node].mget([key_fn(m) for m in ids])
+                                         for node, ids in groups.items()))
+        values = {}
+        for ids, reply in zip(groups.values(), replies):
+            values.update(zip(ids, reply))
+        return [values[m] for m in match_ids]
+
+    async def close(self):
+        for client in self.clients.values():
+            await client.aclose()
@@ -0,0 +1,208 @@
+"""Headless match simulator and throughput benchmark.
+
+Plays full matches in memory with the same rules module the service uses
+(game_rules.py), without Redis or HTTP, and reports throughput, per-function
+latency percentiles and the cost of the capture search by table size.
+
+    python simulate.py --matches 2000 --players cpu cpu --seed 1
+    python simulate.py --matches 500 --players cpu random --json baseline.json
+    CPU_TIME_BUDGET_MS=5 python simulate.py --matches 200 --players search cpu
+"""
+import argparse
+import json
+import random
+import time
+from collections import Counter, defaultdict
+
+import capture_solver
+import cpu_search
+import game_rules
+from match_state import MatchState
+
+# Functions of game_rules whose every call is timed
+TIMED_FUNCTIONS = ("apply_play", "handle_turn_change", "execute_cpu_turn",
+                   "find_capture_combination", "calculate_scores", "finalize_match")
+
+
+# --- BOTS ---
+# A bot plays one card for `seat` (the turn change is done by the simulator)
+
+def cpu_bot(state, seat, rng):
+    game_rules.execute_cpu_turn(state, seat, strategy="greedy")
+
+def search_bot(state, seat, rng):
+    game_rules.execute_cpu_turn(state, seat, strategy="search")
+
+def random_bot(state, seat, rng):
+    game_rules.apply_play(state, seat, rng.choice(state.players[seat].hand_cards()))
+
+BOTS = {
+    "cpu": cpu_bot,
+    "search": search_bot,
+    "random": random_bot
+}
+
+
+# --- INSTRUMENTATION ---
+
+class Profiler:
+    """Wraps game_rules functions in place and collects call durations (ns)."""
+
+    def __init__(self):
+        self.samples = defaultdict(list)
+        # table size -> durations of find_capture_combination
+        self.capture_cost = defaultdict(list)
+        self._originals = {}
+
+    def install(self):
+        for name in TIMED_FUNCTIONS:
+            original = getattr(game_rules, name)
+            self._originals[name] = original
+            setattr(game_rules, name, self._timed(name, original))
+
+    def uninstall(self):
+        for name, original in self._originals.items():
+            setattr(game_rules, name, original)
+        self._originals.clear()
+
+    def _timed(self, name, original):
+        samples = self.samples[name]
+        capture_cost = self.capture_cost if name == "find_capture_combination" else None
+
+        def timed(*args, **kwargs):
+            start = time.perf_counter_ns()
+            try:
+                return original(*args, **kwargs)
+            finally:
+                elapsed = time.perf_counter_ns() - start
+                samples.append(elapsed)
+                if capture_cost is not None:
+                    capture_cost[len(args[1])].append(elapsed)
+        return timed
+
+
+def percentile(sorted_values, pct):
+    if not sorted_values:
+        return 0
+    idx = min(len(sorted_values) - 1, int(round(pct / 100 * (len(sorted_values) - 1))))
+    return sorted_values[idx]
+
+
+def summarize(values_ns):
+    values = sorted(values_ns)
+    return {
+        "calls": len(values),
+        "mean_us": (sum(values) / len(values) / 1000) if values else 0,
+        "p50_us": percentile(values, 50) / 1000,
+        "p95_us": percentile(values, 95) / 1000,
+        "p99_us": percentile(values, 99) / 1000,
+        "max_us": (values[-1] / 1000) if values else 0
+    }
+
+
+# --- SIMULATION ---
+
+def play_match(index, bots, rng, profiler, move_samples, codec_samples):
+    state = game_rules.deal_new_match("Bot-1", "Bot-2", match_id=f"sim-{index}", rng=rng)
+    moves = 0
+    while state.status == 'active':
+        seat = state.turn
+        start = time.perf_counter_ns()
+        bots[seat](state, seat, rng)
+        state, _, _ = game_rules.handle_turn_change(state)
+        move_samples.append(time.perf_counter_ns() - start)
+
+        # Every move of the real service is a codec round trip through Redis
+        start = time.perf_counter_ns()
+        MatchState.decode(state.encode())
+        codec_samples.append(time.perf_counter_ns() - start)
+        moves += 1
+    return state, moves
+
+
+def run(matches, bot_names, seed=None):
+    rng = random.Random(seed)
+    bots = [BOTS[name] for name in bot_names]
+    profiler = Profiler()
+    move_samples, codec_samples = [], []
+    outcomes = Counter()
+    total_moves = 0
+
+    profiler.install()
+    try:
+        started = time.perf_counter()
+        for i in range(matches):
+            state, moves = play_match(i, bots, rng, profiler, move_samples, codec_samples)
+            total_moves += moves
+            winner = state.result['winner']
+            outcomes[winner if winner == "Draw" else f"seat{state.seat(winner) + 1}:{bot_names[state.seat(winner)]}"] += 1
+        elapsed = time.perf_counter() - started
+    finally:
+        profiler.uninstall()
+
+    return {
+        "matches": matches,
+        "players": list(bot_names),
+        "seed": seed,
+        "elapsed_s": elapsed,
+        "matches_per_s": matches / elapsed if elapsed else 0,
+        "moves_per_s": total_moves / elapsed if elapsed else 0,
+        "moves": total_moves,
+        "outcomes": dict(outcomes),
+        "move_latency": summarize(move_samples),
+        "codec_roundtrip": summarize(codec_samples),
+        "functions": {name: summarize(profiler.samples[name]) for name in TIMED_FUNCTIONS},
+        "capture_cost_by_table_size": {
+            size: summarize(samples) for size, samples in sorted(profiler.capture_cost.items())
+        },
+        "capture_solver_cache": capture_solver.cache_info()._asdict(),
+        "cpu_search": cpu_search.stats()
+    }
+
+
+def print_report(report):
+    print(f"{report['matches']} matches ({' vs '.join(report['players'])}), "
+          f"{report['moves']} moves in {report['elapsed_s']:.2f}s")
+    print(f"  {report['matches_per_s']:.1f} matches/s, {report['moves_per_s']:.1f} moves/s")
+    print(f"  outcomes: {report['outcomes']}")
+
+    header = f"  {'':28}{'calls':>10}{'mean':>10}{'p50':>10}{'p95':>10}{'p99':>10}{'max':>10}  (us)"
+    print()
+    print(header)
+    rows = [("move (bot + turn change)", report['move_latency']), ("codec round trip", report['codec_roundtrip'])]
+    rows += list(report['functions'].items())
+    for name, s in rows:
+        print(f"  {name:28}{s['calls']:>10}{s['mean_us']:>10.2f}{s['p50_us']:>10.2f}"
+              f"{s['p95_us']:>10.2f}{s['p99_us']:>10.2f}{s['max_us']:>10.2f}")
+
+    print()
+    print("  capture search cost by table size")
+    for size, s in report['capture_cost_by_table_size'].items():
+        print(f"  {'table=' + str(size):28}{s['calls']:>10}{s['mean_us']:>10.2f}{s['p50_us']:>10.2f}"
+              f"{s['p95_us']:>10.2f}{s['p99_us']:>10.2f}{s['max_us']:>10.2f}")
+    cache = report['capture_solver_cache']
+    print(f"  solver memo: {cache['currsize']} entries, {cache['hits']} hits, {cache['misses']} misses")
+    search = report['cpu_search']
+    if search['searches']:
+        print(f"  cpu search: {search['searches']} searches, {search['samples'] / search['searches']:.1f} samples/search, "
+              f"transposition table {search['entries']} entries, {search['hits']} hits, {search['misses']} misses")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Headless La Escoba match simulator")
+    parser.add_argument("--matches", type=int, default=1000)
+    parser.add_argument("--players", nargs=2, choices=sorted(BOTS), default=["cpu", "cpu"],
+                        help="bot for seat 1 and seat 2")
+    parser.add_argument("--seed", type=int, default=None)
+    parser.add_argument("--json", metavar="FILE", help="also write the report as JSON")
+    args = parser.parse_args()
+
+    report = run(args.matches, args.players, args.seed)
+    print_report(report)
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(report, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
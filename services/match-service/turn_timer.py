@@ -0,0 +1,137 @@
+import os
+import socket
+import threading
+import time
+
+import redis
+import requests
+from requests.adapters import HTTPAdapter
+from requests.packages.urllib3.exceptions import InsecureRequestWarning
+
+from atomic_moves import DEADLINES_KEY
+from sharded_store import connect, nodes_from_env
+
+requests.packages.urllib3.disable_warnings(InsecureRequestWarning)
+
+# --- TURN TIMER ---
+# The commit script keeps one entry per running turn in the DEADLINES_KEY
+# sorted set (score = deadline), so scheduling costs O(log n) per turn change.
+# This worker only ever reads the due head of the set: due entries are
+# claimed by pushing their score LEASE_SECONDS ahead (a crashed worker's
+# claims come back by themselves) and handed to match-service, which checks
+# the deadline against the state and auto-plays or forfeits the turn.
+# Every shard has its own deadlines set, watched by its own thread.
+
+MATCH_SERVICE_URL = "https://match-service:5000/matches"
+
+TIMER_STATS_KEY = "stats:turn_timer"
+
+BATCH_SIZE = int(os.environ.get('TURN_TIMER_BATCH_SIZE', '50'))
+POLL_SECONDS = float(os.environ.get('TURN_TIMER_POLL_SECONDS', '1'))
+LEASE_SECONDS = float(os.environ.get('TURN_TIMER_LEASE_SECONDS', '30'))
+REQUEST_TIMEOUT = float(os.environ.get('TURN_TIMER_REQUEST_TIMEOUT', '5'))
+
+# KEYS[1] deadlines; ARGV[1] now, ARGV[2] batch size, ARGV[3] lease expiry
+# Returns [match id, deadline, ...] of the claimed entries.
+CLAIM_LUA = """
+local due = redis.call('ZRANGEBYSCORE', KEYS[1], '-inf', ARGV[1], 'WITHSCORES', 'LIMIT', 0, ARGV[2])
+for i = 1, #due, 2 do
+    redis.call('ZADD', KEYS[1], ARGV[3], due[i])
+end
+return due
+"""
+
+
+def _queue_overdue(pipe, now):
+    pipe.zcard(DEADLINES_KEY)
+    pipe.zcount(DEADLINES_KEY, '-inf', now)
+    pipe.zrange(DEADLINES_KEY, 0, 0, withscores=True)
+
+
+def _overdue_summary(now, scheduled, overdue, oldest):
+    return {
+        "scheduled": scheduled,
+        "overdue": overdue,
+        "oldest_overdue_ms": int((now - oldest[0][1]) * 1000) if overdue and oldest else 0
+    }
+
+
+def overdue_metrics(client, now=None):
+    """Scheduled turns, overdue turns and age of the oldest one, without scanning."""
+    now = time.time() if now is None else now
+    with client.pipeline(transaction=False) as pipe:
+        _queue_overdue(pipe, now)
+        return _overdue_summary(now, *pipe.execute())
+
+
+async def overdue_metrics_async(client, now=None):
+    """overdue_metrics for a redis.asyncio client."""
+    now = time.time() if now is None else now
+    async with client.pipeline(transaction=False) as pipe:
+        _queue_overdue(pipe, now)
+        return _overdue_summary(now, *await pipe.execute())
+
+
+class TurnTimer:
+    def __init__(self, client, session=None, consumer=None):
+        self.client = client
+        self.consumer = consumer or f"{socket.gethostname()}-{os.getpid()}"
+        self.claim_script = client.register_script(CLAIM_LUA)
+        if session is None:
+            session = requests.Session()
+            session.mount("https://", HTTPAdapter(pool_connections=1, pool_maxsize=2))
+            session.verify = False
+        self.session = session
+
+    def run_forever(self):
+        print(f"Turn timer {self.consumer} watching {DEADLINES_KEY}")
+        while True:
+            try:
+                if self.poll_once() < BATCH_SIZE:
+                    time.sleep(POLL_SECONDS)
+            except redis.ConnectionError as e:
+                print(f"Redis unavailable: {e}")
+                time.sleep(1)
+
+    def poll_once(self):
+        """Fires every turn that expired by now. Returns how many were claimed."""
+        now = time.time()
+        metrics = overdue_metrics(self.client, now)
+        self.client.hset(TIMER_STATS_KEY, mapping={
+            "overdue": metrics["overdue"],
+            "oldest_overdue_ms": metrics["oldest_overdue_ms"]
+        })
+
+        claimed = self.claim_script(keys=[DEADLINES_KEY], args=[now, BATCH_SIZE, now + LEASE_SECONDS])
+        for i in range(0, len(claimed), 2):
+            self.fire(claimed[i], float(claimed[i + 1]), now)
+        return len(claimed) // 2
+
+    def fire(self, match_id, deadline, now):
+        try:
+            resp = self.session.post(f"{MATCH_SERVICE_URL}/{match_id}/timeout", timeout=REQUEST_TIMEOUT)
+            outcome = resp.json().get('result', 'error') if resp.status_code == 200 else 'error'
+            if outcome == 'error':
+                print(f"Timeout of match {match_id} rejected: {resp.status_code}")
+        except (requests.RequestException, ValueError) as e:
+            # The lease brings the entry back after LEASE_SECONDS
+            print(f"Error contacting Match Service for {match_id}: {e}")
+            outcome = 'error'
+
+        with self.client.pipeline(transaction=False) as pipe:
+            pipe.hincrby(TIMER_STATS_KEY, outcome, 1)
+            pipe.hset(TIMER_STATS_KEY, "last_lag_ms", int((now - deadline) * 1000))
+            pipe.execute()
+
+
+if __name__ == '__main__':
+    threads = [
+        threading.Thread(
+            target=TurnTimer(connect(node, decode_responses=True),
+                             consumer=f"{socket.gethostname()}-{os.getpid()}-{node}").run_forever,
+            name=f"turn-timer-{node}"
+        )
+        for node in nodes_from_env()
+    ]
+    for t in threads: t.start()
+    for t in threads: t.join()
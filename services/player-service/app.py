@@ -1,6 +1,7 @@
 from flask import Flask, jsonify, request
 from flask_sqlalchemy import SQLAlchemy
 from sqlalchemy import or_, and_
+from sqlalchemy.exc import IntegrityError
 import os
 from datetime import datetime, timedelta
 
@@ -45,6 +46,13 @@ class Friendship(db.Model):
     receiver = db.Column(db.String(50), db.ForeignKey('players.username'), nullable=False)
     status = db.Column(db.String(20), default='pending')
 
+class StatsUpdate(db.Model):
+    """Idempotency keys of stats updates already applied (sent by the match outbox)."""
+    __tablename__ = 'stats_updates'
+    idempotency_key = db.Column(db.String(120), primary_key=True)
+    username = db.Column(db.String(50), nullable=False)
+    applied_at = db.Column(db.DateTime, default=datetime.utcnow)
+
 with app.app_context():
     db.create_all()
 
@@ -90,13 +98,25 @@ def update_stats(username):
     if not player:
         return jsonify({"error": "Player not found"}), 404
     
+    # Retried deliveries carry the same key and must not count twice
+    idempotency_key = request.headers.get('Idempotency-Key')
+    if idempotency_key and StatsUpdate.query.get(idempotency_key):
+        return jsonify(player.to_dict()), 200
+    
     data = request.get_json()
     if data.get('won', False):
         player.matches_won += 1
     player.matches_played += 1
     player.total_score += data.get('score_delta', 0)
+    if idempotency_key:
+        db.session.add(StatsUpdate(idempotency_key=idempotency_key, username=username))
     
-    db.session.commit()
+    try:
+        db.session.commit()
+    except IntegrityError:
+        # A concurrent delivery with the same key won the race
+        db.session.rollback()
+        player = Player.query.get(username)
     return jsonify(player.to_dict()), 200
 
 @app.route('/players/leaderboard/top', methods=['GET'])
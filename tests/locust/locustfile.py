@@ -19,6 +19,7 @@ class EscobaPlayer(HttpUser):
         self.email = f"{self.username}@test.com"
         self.token = None
         self.user_id = None # Initialize user_id
+        self.match_ids = [] # Matches created by this user, for the batch view
 
         # 1. Registration
         with self.client.post("/auth/register", json={
@@ -57,6 +58,16 @@ class EscobaPlayer(HttpUser):
         if self.token:
             self.client.get(f"/players/{self.username}")
 
+    @task(1)
+    def view_my_matches(self):
+        """Weight 1: Dashboard-like listing, all known matches in one request"""
+        if self.token and self.match_ids:
+            headers = {"Authorization": f"Bearer {self.token}"}
+            self.client.get("/matches", params={
+                "ids": ",".join(self.match_ids[-20:]),
+                "player": self.username
+            }, headers=headers, name="/matches?ids=[batch]")
+
     @task(3)
     def play_match_flow(self):
         """Weight 3: Match lifecycle (Create match and check status)"""
@@ -75,6 +86,7 @@ class EscobaPlayer(HttpUser):
 
         if res.status_code == 201:
             match_id = res.json().get("match_id")
+            self.match_ids.append(match_id)
             
             # Control the match state until it ends (Max 10 attempts)
             for attempt in range(10): 